@@ -0,0 +1,193 @@
+"""
+Search-as-you-type completions served from an in-memory prefix index.
+
+Product and category names are stored as lowercase keys in one sorted array,
+so the completions for a prefix are the contiguous slice found with two
+bisects. Every word start of a name is indexed too, so "corn" completes
+"Sweet Corn" as well as "Corn Lovers Set". Entries are weighted by units sold
+(products) and catalog size (categories).
+"""
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from django.urls import reverse
+
+from .index_generation import Generation
+from .search import tokenize
+
+
+GENERATION_CACHE_KEY = 'autocomplete_index:generation'
+
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+MEMO_SIZE = 2048
+
+Completion = namedtuple('Completion', ('kind', 'id', 'name', 'url', 'weight'))
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+def _keys_for(name):
+    """The full name plus every suffix that starts at a word boundary"""
+    words = tokenize(name)
+    return {' '.join(words[i:]) for i in range(len(words))}
+
+
+class AutocompleteIndex:
+    """
+    Sorted (key, kind, id) array plus a completion record per entity.
+
+    Short prefixes match many keys, so results are memoized per
+    (prefix, limit); the memo is cleared whenever the index changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._changes = Generation(GENERATION_CACHE_KEY)
+        self._generation = None
+        self._reset()
+
+    def _reset(self):
+        self._keys = []
+        self._entries = {}
+        self._entry_keys = {}
+        self._memo = {}
+
+    def build(self):
+        from django.db.models import Count, Sum
+        from .models import Category, OrderItem, Product
+
+        generation = self._changes.current()
+        units_sold = dict(
+            OrderItem.objects.order_by().values('product_id')
+            .annotate(units=Sum('quantity')).values_list('product_id', 'units')
+        )
+        products = Product.objects.order_by().values_list('id', 'name', 'slug')
+        categories = (
+            Category.objects.order_by().annotate(product_count=Count('products'))
+            .values_list('id', 'name', 'slug', 'product_count')
+        )
+        with self._lock:
+            self._reset()
+            for product_id, name, slug in products:
+                self._add(self._product_entry(product_id, name, slug, units_sold.get(product_id, 0)))
+            for category_id, name, slug, product_count in categories:
+                self._add(self._category_entry(category_id, name, slug, product_count))
+            self._built = True
+            self._generation = generation
+
+    def ensure_built(self):
+        if not self._built or self._changes.current() != self._generation:
+            self.build()
+
+    @staticmethod
+    def _product_entry(product_id, name, slug, weight):
+        return Completion('product', product_id, name, reverse('product_detail', kwargs={'slug': slug}), weight)
+
+    @staticmethod
+    def _category_entry(category_id, name, slug, weight):
+        return Completion('category', category_id, name, f"{reverse('products')}?category_slug={slug}", weight)
+
+    def update_product(self, product):
+        with self._lock:
+            if not self._built:
+                self._changed()
+                return
+            # Keep the sales weight computed at build time
+            previous = self._entries.get(('product', product.id))
+            weight = previous.weight if previous else 0
+            self._remove(('product', product.id))
+            self._add(self._product_entry(product.id, product.name, product.slug, weight))
+            self._changed()
+
+    def remove_product(self, product_id):
+        with self._lock:
+            if not self._built:
+                self._changed()
+                return
+            self._remove(('product', product_id))
+            self._changed()
+
+    def update_category(self, category):
+        with self._lock:
+            if not self._built:
+                self._changed()
+                return
+            previous = self._entries.get(('category', category.id))
+            weight = previous.weight if previous else 0
+            self._remove(('category', category.id))
+            self._add(self._category_entry(category.id, category.name, category.slug, weight))
+            self._changed()
+
+    def remove_category(self, category_id):
+        with self._lock:
+            if not self._built:
+                self._changed()
+                return
+            self._remove(('category', category_id))
+            self._changed()
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+            self._changed()
+
+    def _changed(self):
+        """Tell every other process to rebuild; this one too if it missed a change"""
+        self._memo = {}
+        self._generation = self._changes.bump(self._generation)
+        if self._generation is None:
+            self._built = False
+
+    def _add(self, entry):
+        entity = (entry.kind, entry.id)
+        keys = _keys_for(entry.name)
+        self._entries[entity] = entry
+        self._entry_keys[entity] = keys
+        for key in keys:
+            insort(self._keys, (key, entry.kind, entry.id))
+
+    def _remove(self, entity):
+        self._entries.pop(entity, None)
+        for key in self._entry_keys.pop(entity, ()):
+            item = (key, entity[0], entity[1])
+            position = bisect_left(self._keys, item)
+            if position < len(self._keys) and self._keys[position] == item:
+                del self._keys[position]
+
+    def complete(self, prefix, limit=DEFAULT_LIMIT):
+        """Top `limit` completions for `prefix`, heaviest first"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self.ensure_built()
+        memo_key = (prefix, limit)
+        with self._lock:
+            cached = self._memo.get(memo_key)
+            if cached is not None:
+                return cached
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + '\uffff',), start)
+            entities = {(kind, entity_id) for _key, kind, entity_id in self._keys[start:end]}
+            entries = [self._entries[entity] for entity in entities]
+            results = heapq.nsmallest(
+                limit, entries,
+                # Heaviest first; full-name prefix matches before word matches
+                key=lambda entry: (
+                    -entry.weight,
+                    not normalize(entry.name).startswith(prefix),
+                    entry.name.lower(),
+                ),
+            )
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[memo_key] = results
+            return results
+
+
+autocomplete_index = AutocompleteIndex()
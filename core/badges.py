@@ -0,0 +1,118 @@
+"""
+Header badge counters.
+
+Every page a signed-in shopper sees shows how many items are in their cart
+and how many admin replies to their messages they have not read. Both
+counters are kept in the cache, per cart and per user, and moved by the
+CartItem and ContactReply writes that change them (see signals) instead of
+being recounted on each page. A counter missing from the cache is recounted
+with one query. The timeout bounds how long a counter can drift after a write
+that raced with a recount or skipped the signals.
+
+Moving a counter in place needs an atomic increment, which Redis, memcached
+and the memory cache have. The database and file caches read and then write,
+which could lose a step between two processes, so on those a change drops
+the counter instead and the next page recounts it.
+"""
+import re
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from .models import CartItem, ContactReply
+
+
+TIMEOUT = getattr(settings, 'BADGE_CACHE_TIMEOUT', 60 * 60)
+
+# Replies to feedback are shown with the feedback, not in the messages inbox
+FEEDBACK_RESPONSE_SUBJECT = r'^\s*response to your feedback:'
+
+
+def _cart_key(cart_id):
+    return f'badge:cart_items:{cart_id}'
+
+
+def _unread_key(user_id):
+    return f'badge:contact_unread:{user_id}'
+
+
+def count_cart_items(cart_id):
+    return CartItem.objects.filter(cart_id=cart_id).aggregate(total=Coalesce(Sum('quantity'), 0))['total']
+
+
+def count_unread_replies(user_id):
+    return (
+        ContactReply.objects
+        .filter(contact__user_id=user_id, is_admin=True, is_read=False)
+        .exclude(contact__subject__iregex=FEEDBACK_RESPONSE_SUBJECT)
+        .count()
+    )
+
+
+def is_feedback_response(subject):
+    return bool(re.match(FEEDBACK_RESPONSE_SUBJECT, subject or '', re.IGNORECASE))
+
+
+def header_counts(user_id, cart_id):
+    """(items in the cart, unread message replies), read from the cache in one round trip"""
+    keys = [_unread_key(user_id)]
+    if cart_id is not None:
+        keys.append(_cart_key(cart_id))
+    found = cache.get_many(keys)
+
+    unread = found.get(_unread_key(user_id))
+    if unread is None:
+        unread = count_unread_replies(user_id)
+        cache.add(_unread_key(user_id), unread, TIMEOUT)
+    cart_items = 0
+    if cart_id is not None:
+        cart_items = found.get(_cart_key(cart_id))
+        if cart_items is None:
+            cart_items = count_cart_items(cart_id)
+            cache.add(_cart_key(cart_id), cart_items, TIMEOUT)
+    return max(cart_items, 0), max(unread, 0)
+
+
+def cart_items(cart_id):
+    """Items in the cart, from the cache when possible"""
+    count = cache.get(_cart_key(cart_id))
+    if count is None:
+        count = count_cart_items(cart_id)
+        cache.add(_cart_key(cart_id), count, TIMEOUT)
+    return max(count, 0)
+
+
+def _atomic_incr():
+    return isinstance(caches['default'], (RedisCache, BaseMemcachedCache, LocMemCache))
+
+
+def _adjust(key, delta):
+    if not delta:
+        return
+    if not _atomic_incr():
+        cache.delete(key)
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Not cached: the next read recounts
+        pass
+
+
+def cart_items_changed(cart_id, delta):
+    _adjust(_cart_key(cart_id), delta)
+
+
+def unread_replies_changed(user_id, delta):
+    if user_id is not None:
+        _adjust(_unread_key(user_id), delta)
+
+
+def reset_unread_replies(user_id):
+    if user_id is not None:
+        cache.delete(_unread_key(user_id))
@@ -0,0 +1,207 @@
+"""
+Batch cart changes.
+
+apply_operations() applies a list of add / set / remove operations to a cart
+in one transaction. The touched products and the cart's lines for them are
+read with one query each, stock is checked for every line before anything is
+written, and the writes are one bulk_create, one bulk_update and one delete.
+reorder() puts an order's items back into the cart through the same path.
+
+add_item() is the add-to-cart button: one INSERT ... ON CONFLICT DO UPDATE
+that adds to the line and checks stock in the same statement, so parallel
+adds are summed by the database instead of overwriting each other.
+remove_lines() deletes the lines an order took, with one statement.
+
+Bulk and raw writes skip the CartItem signals, so the cart summary and the
+header badge counter are updated here once the transaction commits.
+"""
+from django.db import connection, transaction
+
+from . import badges, cart_summary
+from .models import Cart, CartItem, Product
+
+
+OPERATIONS = ('add', 'set', 'remove')
+MAX_OPERATIONS = 100
+
+
+class CartOperationError(ValueError):
+    """The operations were rejected; the cart was not changed"""
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors) or [{'error': message}]
+
+
+def parse_operations(raw):
+    """
+    Validate a list of {"op", "product_id", "quantity"} dicts.
+
+    Returns (op, product_id, quantity) tuples; raises CartOperationError.
+    """
+    if not isinstance(raw, list) or not raw:
+        raise CartOperationError('Expected a non-empty list of operations.')
+    if len(raw) > MAX_OPERATIONS:
+        raise CartOperationError(f'At most {MAX_OPERATIONS} operations per request.')
+    operations = []
+    for index, entry in enumerate(raw):
+        if not isinstance(entry, dict):
+            raise CartOperationError(f'Operation {index}: expected an object.')
+        op = entry.get('op')
+        if op not in OPERATIONS:
+            raise CartOperationError(f'Operation {index}: op must be one of {", ".join(OPERATIONS)}.')
+        try:
+            product_id = int(entry.get('product_id'))
+            quantity = int(entry.get('quantity', 1 if op == 'add' else 0))
+        except (TypeError, ValueError):
+            raise CartOperationError(f'Operation {index}: product_id and quantity must be whole numbers.')
+        if quantity < 0 or (op == 'add' and quantity == 0):
+            raise CartOperationError(f'Operation {index}: quantity must be positive.')
+        operations.append((op, product_id, 0 if op == 'remove' else quantity))
+    return operations
+
+
+def apply_operations(cart, operations, clamp_to_stock=False):
+    """
+    Apply (op, product_id, quantity) operations to `cart` all at once.
+
+    Without `clamp_to_stock`, a line asking for more than is in stock rejects
+    the whole batch with CartOperationError. With it, such lines are lowered
+    to the stock left (or skipped when there is none) and reported. Returns
+    (CartSummary, adjustments), where adjustments lists the lowered lines.
+    """
+    product_ids = {product_id for _op, product_id, _quantity in operations}
+    with transaction.atomic():
+        # Serializes batches on the same cart (a no-op on SQLite, which locks the database)
+        Cart.objects.select_for_update().only('id').get(pk=cart.pk)
+        products = Product.objects.only('id', 'name', 'stock_quantity').in_bulk(product_ids)
+        unknown = product_ids - products.keys()
+        if unknown:
+            raise CartOperationError(
+                'Some products no longer exist.',
+                [{'product_id': product_id, 'error': 'Product not found.'} for product_id in sorted(unknown)],
+            )
+        lines = {item.product_id: item for item in CartItem.objects.filter(cart=cart, product_id__in=product_ids)}
+
+        quantities = {product_id: item.quantity for product_id, item in lines.items()}
+        for op, product_id, quantity in operations:
+            if op == 'add':
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+            else:
+                quantities[product_id] = quantity
+
+        errors, adjustments = [], []
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            if quantity <= product.stock_quantity:
+                continue
+            if not clamp_to_stock:
+                errors.append({
+                    'product_id': product_id,
+                    'error': f'Only {product.stock_quantity} in stock for {product.name}.',
+                    'max_quantity': product.stock_quantity,
+                })
+                continue
+            adjustments.append({
+                'product_id': product_id,
+                'requested': quantity,
+                'quantity': product.stock_quantity,
+                'message': (
+                    f'{product.name} is out of stock.' if not product.stock_quantity
+                    else f'Only {product.stock_quantity} of {product.name} added (limited stock).'
+                ),
+            })
+            quantities[product_id] = product.stock_quantity
+        if errors:
+            raise CartOperationError('Not enough stock for some items.', errors)
+
+        created, changed, removed = [], [], []
+        delta = 0
+        for product_id, quantity in quantities.items():
+            line = lines.get(product_id)
+            if line is None:
+                if quantity > 0:
+                    created.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+                    delta += quantity
+            elif quantity <= 0:
+                removed.append(line.pk)
+            elif quantity != line.quantity:
+                delta += quantity - line.quantity
+                line.quantity = quantity
+                changed.append(line)
+        if created:
+            CartItem.objects.bulk_create(created)
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity'])
+        if removed:
+            # Deletes still send the CartItem signals, which update the summary and badge
+            CartItem.objects.filter(pk__in=removed).delete()
+
+        if created or changed:
+            _cart_items_written(cart.pk, delta)
+        summary = cart_summary.compute(cart.pk)
+    return summary, adjustments
+
+
+def _cart_items_written(cart_id, delta):
+    cart_summary.invalidate(cart_id)
+    transaction.on_commit(lambda: cart_summary.invalidate(cart_id))
+    transaction.on_commit(lambda: badges.cart_items_changed(cart_id, delta))
+
+
+def _add_item_sql():
+    quote = connection.ops.quote_name
+    item_table, product_table = quote(CartItem._meta.db_table), quote(Product._meta.db_table)
+    # SQLite and PostgreSQL both read this upsert the same way. The SELECT
+    # only yields a row while the stock covers a new line; the DO UPDATE only
+    # applies while it covers the summed quantity. RETURNING nothing means no
+    # write happened.
+    return (
+        f'INSERT INTO {item_table} (cart_id, product_id, quantity) '
+        f'SELECT %s, id, %s FROM {product_table} WHERE id = %s AND stock_quantity >= %s '
+        f'ON CONFLICT (cart_id, product_id) DO UPDATE '
+        f'SET quantity = {item_table}.quantity + excluded.quantity '
+        f'WHERE {item_table}.quantity + excluded.quantity <= '
+        f'(SELECT stock_quantity FROM {product_table} WHERE id = excluded.product_id) '
+        f'RETURNING quantity'
+    )
+
+
+def add_item(cart_id, product_id, quantity):
+    """
+    Add `quantity` of a product to a cart in one statement.
+
+    Returns the line's new quantity, or None when the total would exceed the
+    product's stock, in which case nothing was written.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_add_item_sql(), [cart_id, quantity, product_id, quantity])
+        # Reading to the end finishes the statement (and its autocommit) here
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    _cart_items_written(cart_id, quantity)
+    return rows[0][0]
+
+
+def remove_lines(cart_id, lines):
+    """Delete the cart's (line id, quantity) `lines` with one statement"""
+    if not lines:
+        return
+    line_ids = [line_id for line_id, _quantity in lines]
+    # _raw_delete() skips delete() collecting the rows first and sending
+    # post_delete per line; nothing references a cart item, and the cart
+    # summary and badge are updated once below instead.
+    items = CartItem.objects.filter(cart_id=cart_id, pk__in=line_ids)
+    items._raw_delete(items.db)
+    _cart_items_written(cart_id, -sum(quantity for _line_id, quantity in lines))
+
+
+def reorder(cart, order):
+    """Add every item of `order` to `cart`, as far as stock allows"""
+    operations = [
+        ('add', product_id, quantity)
+        for product_id, quantity in order.items.values_list('product_id', 'quantity')
+    ]
+    if not operations:
+        return cart_summary.compute(cart.pk), []
+    return apply_operations(cart, operations, clamp_to_stock=True)
@@ -0,0 +1,70 @@
+"""
+Cart totals.
+
+The cart badge on every page, the cart and checkout pages and the cart AJAX
+endpoints all need the number of items and the subtotal. Both come from one
+aggregate query over the cart's items joined to their product prices, and the
+result is cached per cart.
+
+Cart item saves and deletes drop the cached summary (see signals). Cached
+summaries are also tagged with the catalog version, so a price change,
+including one made by a bulk import, is picked up without tracking which
+carts hold the product. That relies on the cache being shared by every
+process (settings.CACHES): an import run from the command line bumps the
+same catalog version the web workers read.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import Coalesce
+
+from . import page_cache
+from .models import CartItem
+
+
+TIMEOUT = getattr(settings, 'CART_SUMMARY_CACHE_TIMEOUT', 60 * 60)
+TAGS = (page_cache.CATALOG,)
+
+CartSummary = namedtuple('CartSummary', ('item_count', 'subtotal', 'line_count'))
+EMPTY = CartSummary(0, Decimal('0.00'), 0)
+
+
+def _key(cart_id):
+    return f'cart_summary:{cart_id}'
+
+
+def compute(cart_id):
+    """The summary straight from the database, in one query"""
+    line_total = ExpressionWrapper(
+        F('quantity') * F('product__price'), output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+    totals = CartItem.objects.filter(cart_id=cart_id).aggregate(
+        item_count=Coalesce(Sum('quantity'), 0),
+        subtotal=Sum(line_total),
+        line_count=Count('id'),
+    )
+    subtotal = totals['subtotal']
+    return CartSummary(
+        totals['item_count'],
+        EMPTY.subtotal if subtotal is None else Decimal(subtotal).quantize(EMPTY.subtotal),
+        totals['line_count'],
+    )
+
+
+def cart_summary(cart_id):
+    """Item count, subtotal and number of lines of a cart, cached"""
+    if cart_id is None:
+        return EMPTY
+    key = _key(cart_id)
+    summary, versions = page_cache.get_tagged(key, TAGS)
+    if summary is None:
+        summary = compute(cart_id)
+        page_cache.set_tagged(key, summary, versions, TIMEOUT)
+    return summary
+
+
+def invalidate(cart_id):
+    cache.delete(_key(cart_id))
@@ -0,0 +1,357 @@
+"""
+In-process faceted index over the product catalog.
+
+The products listing page filters on product type, category, free delivery and
+price, then sorts and paginates the result. The catalog is small enough to keep
+a compact copy of those columns in memory, so the listing can be answered
+without building a fresh QuerySet (plus COUNT) for every filter combination.
+"""
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from .index_generation import Generation
+
+
+GENERATION_CACHE_KEY = 'catalog_index:generation'
+
+# Buckets offered as quick price filters; any "min-max" range is accepted too.
+PRICE_BUCKETS = [
+    ('0-100', 'Under ₱100'),
+    ('100-500', '₱100 - ₱500'),
+    ('500-', '₱500 and up'),
+]
+
+# Minimum star ratings offered as quick filters ("4 stars & up").
+RATING_THRESHOLDS = (4, 3)
+
+SORT_ORDERINGS = ('newest', 'bestseller', 'price-low-high', 'price-high-low', 'top-rated')
+
+_ENTRY_FIELDS = (
+    'id', 'product_type', 'category_id', 'free_delivery', 'is_featured',
+    'is_bestseller', 'price', 'created_at', 'rating_average', 'review_count',
+    'sales_score',
+)
+
+_Entry = namedtuple('_Entry', _ENTRY_FIELDS)
+_Category = namedtuple('_Category', ('id', 'name', 'slug'))
+
+
+def parse_min_rating(value):
+    """Parse a minimum star rating filter ("4" -> 4.0), clamped to 1-5"""
+    if not value or value == 'all':
+        return None
+    try:
+        rating = float(value)
+    except ValueError:
+        return None
+    return min(max(rating, 1.0), 5.0)
+
+
+def parse_price_range(value):
+    """Parse a "min-max" price filter ("100-500", "500-", "-100") into bounds"""
+    if not value or value == 'all':
+        return None
+    value = value.strip().replace('+', '-')
+    low, sep, high = value.partition('-')
+    if not sep:
+        return None
+    try:
+        low = Decimal(low) if low.strip() else None
+        high = Decimal(high) if high.strip() else None
+    except InvalidOperation:
+        return None
+    if low is None and high is None:
+        return None
+    if low is not None and high is not None and low > high:
+        low, high = high, low
+    return low, high
+
+
+def _sort_keys(entry):
+    """Presorted ordering keys; every list is kept in ascending key order"""
+    created = entry.created_at.timestamp() if entry.created_at else 0
+    return {
+        'newest': (-created, -entry.id),
+        'bestseller': (-entry.sales_score, not entry.is_bestseller, -created, -entry.id),
+        'price': (entry.price, entry.id),
+        'rating': (-entry.rating_average, -entry.review_count, -entry.id),
+    }
+
+
+class CatalogIndex:
+    """
+    Facet sets and presorted orderings over every product.
+
+    Each facet value maps to the set of product ids carrying it, and each sort
+    order is a list of (key, id) tuples kept sorted so that a filtered listing is
+    a single ordered scan with set membership checks. Updates are applied one
+    product at a time from model signals; other processes notice the bumped
+    generation in the cache and rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._changes = Generation(GENERATION_CACHE_KEY)
+        self._generation = None
+        self._reset()
+
+    def _reset(self):
+        self._entries = {}
+        self._by_type = {}
+        self._by_category = {}
+        self._free_delivery = set()
+        self._featured = set()
+        self._orderings = {'newest': [], 'bestseller': [], 'price': [], 'rating': []}
+        self._categories = {}
+
+    # ------------------------------------------------------------------
+    # Building and maintenance
+    # ------------------------------------------------------------------
+
+    def build(self):
+        """Load the whole catalog from the database"""
+        from .models import Category, Product
+
+        generation = self._changes.current()
+        rows = Product.objects.order_by().values_list(*_ENTRY_FIELDS)
+        categories = Category.objects.order_by('name').values_list('id', 'name', 'slug')
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(_Entry(*row))
+            for row in categories:
+                self._categories[row[0]] = _Category(*row)
+            self._built = True
+            self._generation = generation
+
+    def ensure_built(self):
+        """Build on first use, or rebuild when another process changed the catalog"""
+        if not self._built or self._changes.current() != self._generation:
+            self.build()
+
+    def update_product(self, product_id):
+        """Insert or replace a single product, as saved in the database"""
+        from .models import Product
+
+        if not self._built:
+            with self._lock:
+                self._bump_generation()
+            return
+        # The saved row, not the instance: a view may have assigned raw form input
+        row = Product.objects.filter(pk=product_id).values_list(*_ENTRY_FIELDS).first()
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._remove(product_id)
+            if row is not None:
+                self._add(_Entry(*row))
+            self._bump_generation()
+
+    def remove_product(self, product_id):
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._remove(product_id)
+            self._bump_generation()
+
+    def update_category(self, category):
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._categories[category.id] = _Category(category.id, category.name, category.slug)
+            self._bump_generation()
+
+    def remove_category(self, category_id):
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._categories.pop(category_id, None)
+            self._bump_generation()
+
+    def invalidate(self):
+        """Drop everything; the next query rebuilds (used after bulk writes)"""
+        with self._lock:
+            self._built = False
+            self._bump_generation()
+
+    def _bump_generation(self):
+        """Tell every other process to rebuild; this one too if it missed a change"""
+        self._generation = self._changes.bump(self._generation)
+        if self._generation is None:
+            self._built = False
+
+    def _add(self, entry):
+        self._entries[entry.id] = entry
+        self._by_type.setdefault(entry.product_type, set()).add(entry.id)
+        self._by_category.setdefault(entry.category_id, set()).add(entry.id)
+        if entry.free_delivery:
+            self._free_delivery.add(entry.id)
+        if entry.is_featured:
+            self._featured.add(entry.id)
+        for name, key in _sort_keys(entry).items():
+            insort(self._orderings[name], (key, entry.id))
+
+    def _remove(self, product_id):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        self._by_type.get(entry.product_type, set()).discard(entry.id)
+        self._by_category.get(entry.category_id, set()).discard(entry.id)
+        self._free_delivery.discard(entry.id)
+        self._featured.discard(entry.id)
+        for name, key in _sort_keys(entry).items():
+            ordering = self._orderings[name]
+            position = bisect_left(ordering, (key, entry.id))
+            if position < len(ordering) and ordering[position] == (key, entry.id):
+                del ordering[position]
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def _price_ids(self, price_range):
+        low, high = price_range
+        ordering = self._orderings['price']
+        start = 0 if low is None else bisect_left(ordering, ((low,),))
+        if high is None:
+            end = len(ordering)
+        else:
+            # Keys are (price, id) tuples; (high, inf) sorts after every id at that price.
+            end = bisect_right(ordering, ((high, float('inf')),))
+        return {product_id for _key, product_id in ordering[start:end]}
+
+    def _rating_ids(self, min_rating):
+        # Keys start with -rating_average, so qualifying products form a prefix
+        ordering = self._orderings['rating']
+        end = bisect_right(ordering, ((-min_rating, float('inf')),))
+        return {product_id for _key, product_id in ordering[:end]}
+
+    def _filter_sets(self, product_type=None, category_id=None, free_delivery=False,
+                     featured=False, price_range=None, min_rating=None, ids=None):
+        filters = {}
+        if product_type:
+            filters['product_type'] = self._by_type.get(product_type, set())
+        if category_id is not None:
+            filters['category'] = self._by_category.get(category_id, set())
+        if free_delivery:
+            filters['free_delivery'] = self._free_delivery
+        if featured:
+            filters['featured'] = self._featured
+        if price_range:
+            filters['price'] = self._price_ids(price_range)
+        if min_rating:
+            filters['rating'] = self._rating_ids(min_rating)
+        if ids is not None:
+            filters['ids'] = set(ids)
+        return filters
+
+    @staticmethod
+    def _intersect(filters, universe, skip=None):
+        sets = [ids for name, ids in filters.items() if name != skip]
+        if not sets:
+            return universe
+        sets.sort(key=len)
+        result = set(sets[0])
+        for ids in sets[1:]:
+            result &= ids
+        return result
+
+    def filter_ids(self, sort='newest', **filters):
+        """Return product ids matching the filters, in the requested order"""
+        self.ensure_built()
+        with self._lock:
+            matches = self._intersect(self._filter_sets(**filters), self._entries.keys())
+            if sort == 'price-high-low':
+                ordering = reversed(self._orderings['price'])
+            elif sort == 'price-low-high':
+                ordering = self._orderings['price']
+            elif sort == 'bestseller':
+                ordering = self._orderings['bestseller']
+            elif sort == 'top-rated':
+                ordering = self._orderings['rating']
+            else:
+                ordering = self._orderings['newest']
+            return [product_id for _key, product_id in ordering if product_id in matches]
+
+    def facet_counts(self, **filters):
+        """
+        Count products per facet value.
+
+        Each facet is counted against the other active filters only, so picking
+        a product type still shows how many products the other types have.
+        """
+        self.ensure_built()
+        with self._lock:
+            active = self._filter_sets(**filters)
+            universe = self._entries.keys()
+
+            base = self._intersect(active, universe, skip='product_type')
+            product_types = {
+                value: len(base & self._by_type.get(value, set()))
+                for value, _label in self._product_types()
+            }
+
+            base = self._intersect(active, universe, skip='category')
+            categories = {
+                category_id: len(base & self._by_category.get(category_id, set()))
+                for category_id in self._categories
+            }
+
+            base = self._intersect(active, universe, skip='free_delivery')
+            free_delivery = len(base & self._free_delivery)
+
+            base = self._intersect(active, universe, skip='price')
+            prices = {
+                bucket: len(base & self._price_ids(parse_price_range(bucket)))
+                for bucket, _label in PRICE_BUCKETS
+            }
+
+            base = self._intersect(active, universe, skip='rating')
+            ratings = {
+                threshold: len(base & self._rating_ids(threshold))
+                for threshold in RATING_THRESHOLDS
+            }
+
+            return {
+                'product_type': product_types,
+                'category': categories,
+                'free_delivery': free_delivery,
+                'price': prices,
+                'rating': ratings,
+                'total': len(self._intersect(active, universe)),
+            }
+
+    def categories(self):
+        """Categories ordered by name, as lightweight (id, name, slug) tuples"""
+        self.ensure_built()
+        with self._lock:
+            return sorted(self._categories.values(), key=lambda category: category.name)
+
+    def category_id_for_slug(self, slug):
+        for category in self.categories():
+            if category.slug == slug:
+                return category.id
+        return None
+
+    @staticmethod
+    def _product_types():
+        from .models import Product
+        return Product.PRODUCT_TYPES
+
+
+catalog_index = CatalogIndex()
+
+
+def load_products(product_ids):
+    """Fetch products by id with one query, preserving the given order"""
+    from .models import Product
+
+    products = Product.objects.in_bulk(product_ids)
+    return [products[product_id] for product_id in product_ids if product_id in products]
@@ -0,0 +1,22 @@
+"""
+System checks for what the storefront needs from its settings in production.
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+PER_PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """The gunicorn workers and management commands only stay in step through a shared cache"""
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PER_PROCESS_CACHES:
+        return []
+    return [Error(
+        'The default cache is per process: index generations, page cache tags, cart summaries '
+        'and badge counters written by one process are never seen by the others.',
+        hint='Set REDIS_URL to use a shared Redis cache (see CACHES in settings.py).',
+        id='core.E001',
+    )]
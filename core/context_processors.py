@@ -1,8 +1,6 @@
+from . import badges, customer_session
 from .models import (
     Contact,
-    ContactReply,
-    Customer,
-    Cart,
     CustomerFeedback,
     CustomerSupport,
 )
@@ -35,14 +33,10 @@ def customer_context(request):
     
     if request.user.is_authenticated:
         try:
-            customer, created = Customer.objects.get_or_create(user=request.user)
-            cart, created = Cart.objects.get_or_create(customer=customer)
-            context['cart_items_count'] = cart.get_total_items()
-            context['contact_unread_count'] = ContactReply.objects.filter(
-                contact__user=request.user,
-                is_admin=True,
-                is_read=False
-            ).exclude(contact__subject__iregex=r'^\s*response to your feedback:').count()
+            # Cached counters: no queries on a normal page view (see core.badges)
+            context['cart_items_count'], context['contact_unread_count'] = badges.header_counts(
+                request.user.pk, customer_session.cart_id(request),
+            )
         except:
             context['cart_items_count'] = 0
             context['contact_unread_count'] = 0
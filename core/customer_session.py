@@ -0,0 +1,84 @@
+"""
+The signed-in shopper's Customer and Cart, resolved once per request.
+
+CustomerMiddleware puts lazy request.customer and request.cart on requests
+from signed-in users (None for anonymous ones). The first access loads both
+with one joined query, and views, context processors and templates share the
+result. Reading never writes: a user without a Customer or Cart row gets an
+unsaved instance (pk None), and only the views that store something call
+save_customer() or save_cart().
+
+The customer and cart ids are remembered in the session, so the header's cart
+badge can be drawn on later requests without resolving anything. Any request
+that does resolve them refreshes the remembered ids.
+"""
+from django.utils.functional import SimpleLazyObject
+
+from .models import Cart, Customer
+
+
+SESSION_KEY = '_customer_ids'
+
+
+def _remember(request, customer, cart):
+    ids = [request.user.pk, customer.pk, cart.pk]
+    if request.session.get(SESSION_KEY) != ids:
+        request.session[SESSION_KEY] = ids
+
+
+def resolve(request):
+    """[customer, cart] for the signed-in user, loaded with one query and memoized"""
+    state = getattr(request, '_customer_state', None)
+    if state is None:
+        user = request.user
+        customer = Customer.objects.select_related('cart').filter(user=user).first()
+        if customer is None:
+            customer, cart = Customer(user=user), None
+        else:
+            customer.user = user
+            # select_related() already knows whether there is a cart
+            cart = getattr(customer, 'cart', None)
+        if cart is None:
+            cart = Cart(customer=customer)
+        state = request._customer_state = [customer, cart]
+        _remember(request, customer, cart)
+    return state
+
+
+def attach(request):
+    """Set the lazy request.customer and request.cart"""
+    if request.user.is_authenticated:
+        request.customer = SimpleLazyObject(lambda: resolve(request)[0])
+        request.cart = SimpleLazyObject(lambda: resolve(request)[1])
+    else:
+        request.customer = request.cart = None
+
+
+def save_customer(request):
+    """The user's Customer, created if it does not exist yet"""
+    state = resolve(request)
+    if state[0].pk is None:
+        customer, _created = Customer.objects.get_or_create(user=request.user)
+        state[0] = request.customer = customer
+        state[1] = Cart(customer=customer)
+        _remember(request, customer, state[1])
+    return state[0]
+
+
+def save_cart(request):
+    """The user's Cart, created (with the Customer) if it does not exist yet"""
+    customer = save_customer(request)
+    state = resolve(request)
+    if state[1].pk is None:
+        cart, _created = Cart.objects.get_or_create(customer=customer)
+        state[1] = request.cart = cart
+        _remember(request, customer, cart)
+    return state[1]
+
+
+def cart_id(request):
+    """The signed-in user's cart id (None without a cart), from the session when it is known"""
+    ids = request.session.get(SESSION_KEY)
+    if ids and ids[0] == request.user.pk:
+        return ids[2]
+    return resolve(request)[1].pk
@@ -0,0 +1,83 @@
+"""
+Cached product card fragments.
+
+Every product grid renders the same card markup per product. Cards are
+rendered once per (variant, product id, updated_at) and reused on every page
+that shows them; a grid fetches all of its cards with one get_many() and only
+renders the misses. Saving a product moves its updated_at, so stale cards are
+simply never looked up again and age out of the cache. Category renames,
+which do not touch products, move a shared generation instead.
+"""
+import uuid
+
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+
+# Bump when the card templates change so cached markup is not reused.
+CARD_VERSION = 2
+CARD_TIMEOUT = 60 * 60 * 24
+
+GENERATION_CACHE_KEY = 'product_card:generation'
+
+CARD_TEMPLATES = {
+    'listing': 'core/cards/listing.html',
+    'featured': 'core/cards/featured.html',
+    'combo': 'core/cards/combo.html',
+    'seasonal': 'core/cards/seasonal.html',
+    'bundle': 'core/cards/bundle.html',
+    'related': 'core/cards/related.html',
+    'search': 'core/cards/search.html',
+}
+
+# Per-request text (e.g. a search snippet) is rendered as this marker and
+# substituted after the cached card is fetched.
+SLOT = '\ue002'
+
+
+def card_key(variant, product, authenticated, generation):
+    updated = product.updated_at.timestamp() if product.updated_at else 0
+    return f'product_card:v{CARD_VERSION}:{generation}:{variant}:{int(authenticated)}:{product.id}:{updated}'
+
+
+def invalidate():
+    """Retire every cached card (used when shared data such as categories change)"""
+    cache.set(GENERATION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def render_product_cards(products, variant, user=None, slot=None):
+    """
+    Rendered cards for `products`, concatenated in order.
+
+    `slot` names a per-request product attribute (such as `search_snippet`)
+    that is filled into the cached card instead of being cached with it.
+    """
+    products = list(products)
+    if not products:
+        return mark_safe('')
+    authenticated = bool(user is not None and user.is_authenticated)
+    generation = cache.get_or_set(GENERATION_CACHE_KEY, uuid.uuid4().hex, None)
+    keys = [card_key(variant, product, authenticated, generation) for product in products]
+    found = cache.get_many(keys)
+
+    missing = {}
+    template = None
+    for key, product in zip(keys, products):
+        if key in found:
+            continue
+        if template is None:
+            template = get_template(CARD_TEMPLATES[variant])
+        html = template.render({'product': product, 'user': user, 'slot': mark_safe(SLOT)})
+        found[key] = missing[key] = html
+    if missing:
+        cache.set_many(missing, CARD_TIMEOUT)
+
+    cards = []
+    for key, product in zip(keys, products):
+        html = found[key]
+        if slot is not None:
+            html = html.replace(SLOT, str(conditional_escape(getattr(product, slot, ''))))
+        cards.append(html)
+    return mark_safe(''.join(cards))
@@ -0,0 +1,214 @@
+"""
+Typo-tolerant matching over the catalog vocabulary.
+
+Every word from product names, descriptions and category names is indexed by
+its character trigrams. A misspelt query word ("swet", "mais") is matched to
+vocabulary words sharing enough trigrams, which are then used to rank products
+and to suggest a corrected query when the exact search finds nothing.
+"""
+import threading
+from collections import Counter
+
+from .index_generation import Generation
+from .search import query_terms, tokenize
+
+
+GENERATION_CACHE_KEY = 'fuzzy_index:generation'
+
+MIN_SIMILARITY = 0.35
+MAX_EXPANSIONS = 5
+MIN_WORD_LENGTH = 2
+
+# Field weights used when ranking fuzzy matches.
+NAME_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+
+
+def trigrams(word):
+    """Character trigrams of a word padded with boundary markers"""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _indexable_words(text):
+    return [word for word in tokenize(text) if len(word) >= MIN_WORD_LENGTH]
+
+
+class FuzzyIndex:
+    """
+    Trigram index over the catalog vocabulary.
+
+    `_postings` maps each vocabulary word to {product_id: weight}; `_trigrams`
+    maps each trigram to the set of words containing it. Product writes are
+    applied incrementally; category renames and writes made in other processes
+    trigger a lazy rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._changes = Generation(GENERATION_CACHE_KEY)
+        self._generation = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}
+        self._trigrams = {}
+        self._word_trigrams = {}
+        self._product_words = {}
+        self._categories = {}
+
+    def build(self):
+        from .models import Category, Product
+
+        generation = self._changes.current()
+        categories = dict(Category.objects.values_list('id', 'name'))
+        rows = Product.objects.order_by().values_list('id', 'name', 'description', 'category_id')
+        with self._lock:
+            self._reset()
+            self._categories = categories
+            for row in rows:
+                self._add(*row)
+            self._built = True
+            self._generation = generation
+
+    def ensure_built(self):
+        if not self._built or self._changes.current() != self._generation:
+            self.build()
+
+    def update_product(self, product):
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._remove(product.id)
+            self._add(product.id, product.name, product.description, product.category_id)
+            self._bump_generation()
+
+    def remove_product(self, product_id):
+        with self._lock:
+            if not self._built:
+                self._bump_generation()
+                return
+            self._remove(product_id)
+            self._bump_generation()
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+            self._bump_generation()
+
+    def _bump_generation(self):
+        """Tell every other process to rebuild; this one too if it missed a change"""
+        self._generation = self._changes.bump(self._generation)
+        if self._generation is None:
+            self._built = False
+
+    def _document_weights(self, name, description, category_id):
+        weights = Counter()
+        for field, weight in (
+            (name, NAME_WEIGHT),
+            (self._categories.get(category_id), CATEGORY_WEIGHT),
+            (description, DESCRIPTION_WEIGHT),
+        ):
+            for word in set(_indexable_words(field)):
+                weights[word] = max(weights[word], weight)
+        return weights
+
+    def _add(self, product_id, name, description, category_id):
+        weights = self._document_weights(name, description, category_id)
+        self._product_words[product_id] = list(weights)
+        for word, weight in weights.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                grams = trigrams(word)
+                self._word_trigrams[word] = len(grams)
+                for gram in grams:
+                    self._trigrams.setdefault(gram, set()).add(word)
+            postings[product_id] = weight
+
+    def _remove(self, product_id):
+        for word in self._product_words.pop(product_id, ()):
+            postings = self._postings.get(word)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[word]
+                del self._word_trigrams[word]
+                for gram in trigrams(word):
+                    words = self._trigrams.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self._trigrams[gram]
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def similar_words(self, term, limit=MAX_EXPANSIONS):
+        """Vocabulary words closest to `term` as [(word, similarity)], best first"""
+        self.ensure_built()
+        with self._lock:
+            if term in self._postings:
+                return [(term, 1.0)]
+            grams = trigrams(term)
+            shared = Counter()
+            for gram in grams:
+                for word in self._trigrams.get(gram, ()):
+                    shared[word] += 1
+            scored = []
+            for word, common in shared.items():
+                # Dice coefficient over trigram sets
+                similarity = 2.0 * common / (len(grams) + self._word_trigrams[word])
+                if similarity >= MIN_SIMILARITY:
+                    scored.append((similarity, len(self._postings[word]), word))
+            scored.sort(reverse=True)
+            return [(word, similarity) for similarity, _frequency, word in scored[:limit]]
+
+    def suggest(self, query):
+        """A corrected query, or None when every word is known or uncorrectable"""
+        terms = query_terms(query)
+        corrected = []
+        changed = False
+        for term in terms:
+            matches = self.similar_words(term, limit=1)
+            if matches and matches[0][0] != term:
+                corrected.append(matches[0][0])
+                changed = True
+            else:
+                corrected.append(term)
+        return ' '.join(corrected) if changed else None
+
+    def search_ids(self, query, limit=None):
+        """
+        Product ids ranked by fuzzy relevance.
+
+        Each query word contributes its best (similarity x field weight) over
+        its near-matching vocabulary words, so products matching every word
+        rank above products matching only some of them.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        self.ensure_built()
+        scores = Counter()
+        with self._lock:
+            for term in terms:
+                best = {}
+                for word, similarity in self.similar_words(term):
+                    for product_id, weight in self._postings.get(word, {}).items():
+                        score = similarity * weight
+                        if score > best.get(product_id, 0):
+                            best[product_id] = score
+                for product_id, score in best.items():
+                    scores[product_id] += score
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        ids = [product_id for product_id, _score in ranked]
+        return ids[:limit] if limit is not None else ids
+
+
+fuzzy_index = FuzzyIndex()
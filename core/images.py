@@ -0,0 +1,231 @@
+"""
+Responsive image derivatives for product and banner images.
+
+Uploaded images are served to phones that only need a few hundred pixels, so
+every upload is re-encoded as WebP and JPEG at a fixed set of widths. The
+renditions are EXIF-stripped (after applying the EXIF orientation) and stored
+under the source's content hash, so an identical upload reuses existing
+files. The resulting manifest is stored on the model instance and rendered as
+srcset by the {% responsive_image %} tag.
+
+Encoding runs after the upload's transaction commits, on a small thread pool
+(Pillow releases the GIL while resizing and encoding), so admin saves return
+without waiting for it.
+"""
+import hashlib
+import logging
+import os
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import page_cache
+
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (320, 640, 960, 1280)
+FORMATS = (
+    # (manifest key, Pillow format, extension, save options)
+    ('webp', 'WEBP', 'webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+DERIVATIVES_DIR = 'derivatives'
+
+MANIFEST_VERSION = 1
+
+_executor = None
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+
+def _target_widths(width):
+    """Configured widths below the source width, plus the source itself if not larger than the biggest"""
+    widths = [target for target in WIDTHS if target < width]
+    if width <= WIDTHS[-1]:
+        widths.append(width)
+    return widths
+
+
+def _open(data):
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _encode(image, pil_format, options):
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if image.mode == 'RGBA' else None)
+        image = background
+    buffer = BytesIO()
+    # No exif/icc arguments: the renditions carry no metadata
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def build_derivatives(data, folder, storage=None):
+    """
+    Encode every rendition of the image bytes `data` under `folder`.
+
+    Returns the manifest: {'hash', 'width', 'height', 'webp': {width: name}, 'jpeg': {...}}.
+    Renditions that already exist (same source hash) are not re-encoded.
+    """
+    storage = storage or default_storage
+    digest = content_hash(data)
+    image = _open(data)
+    width, height = image.size
+    manifest = {'version': MANIFEST_VERSION, 'hash': digest, 'width': width, 'height': height}
+    for key, _pil_format, extension, _options in FORMATS:
+        manifest[key] = {}
+
+    base = posixpath.join(DERIVATIVES_DIR, folder.strip('/'), digest[:2], digest)
+    for target in _target_widths(width):
+        resized = None
+        for key, pil_format, extension, options in FORMATS:
+            name = f'{base}-{target}w.{extension}'
+            if not storage.exists(name):
+                if resized is None:
+                    resized = image if target == width else image.resize(
+                        (target, max(1, round(height * target / width))), Image.LANCZOS,
+                    )
+                name = storage.save(name, ContentFile(_encode(resized, pil_format, options)))
+            manifest[key][str(target)] = name
+    return manifest
+
+
+def derivatives_for_field(field_file, storage=None):
+    """Build the manifest for an ImageField value, recording its source name"""
+    with field_file.open('rb') as source:
+        data = source.read()
+    folder = posixpath.dirname(field_file.name) or 'images'
+    manifest = build_derivatives(data, folder, storage=storage)
+    manifest['source'] = field_file.name
+    return manifest
+
+
+def needs_derivatives(instance):
+    manifest = instance.image_derivatives or {}
+    if not instance.image:
+        return bool(manifest)
+    return manifest.get('source') != instance.image.name or manifest.get('version') != MANIFEST_VERSION
+
+
+def refresh_derivatives(model, pk):
+    """Regenerate and store the manifest for one row, if its image still needs it"""
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not needs_derivatives(instance):
+        return None
+    if instance.image:
+        try:
+            manifest = derivatives_for_field(instance.image)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            logger.exception('Could not build image derivatives for %s %s', model.__name__, pk)
+            return None
+        source = instance.image.name
+    else:
+        manifest, source = {}, ''
+    # Only store the manifest if the image was not replaced meanwhile; moving
+    # updated_at retires cached product cards built without it.
+    updates = {'image_derivatives': manifest}
+    if any(field.name == 'updated_at' for field in model._meta.concrete_fields):
+        updates['updated_at'] = timezone.now()
+    model.objects.filter(pk=pk, image=source).update(**updates)
+    page_cache.bump(page_cache.CATALOG, page_cache.ADS)
+    return manifest
+
+
+# Originals are recompressed in place by the optimize_images command.
+OPTIMIZE_FORMATS = {
+    'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 85, 'method': 6},
+}
+
+
+def hash_file(path):
+    """(path, size, content hash); runs in optimize_images worker processes"""
+    with open(path, 'rb') as source:
+        data = source.read()
+    return path, len(data), content_hash(data)
+
+
+def optimize_file(path, max_size=1920, quality=None, write=True):
+    """
+    Recompress the image at `path` in its own format, downscaled to fit
+    `max_size` pixels and without metadata other than the colour profile.
+
+    The file is only replaced (atomically) when the result is smaller.
+    Returns (path, bytes_before, bytes_after, error). Runs in worker
+    processes, so it must not touch the database.
+    """
+    with open(path, 'rb') as source:
+        data = source.read()
+    try:
+        original = Image.open(BytesIO(data))
+        pil_format = original.format
+        if pil_format not in OPTIMIZE_FORMATS or getattr(original, 'is_animated', False):
+            return path, len(data), len(data), None
+        icc_profile = original.info.get('icc_profile')
+        image = ImageOps.exif_transpose(original)
+        if max_size and max(image.size) > max_size:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        options = dict(OPTIMIZE_FORMATS[pil_format])
+        if quality and 'quality' in options:
+            options['quality'] = quality
+        if icc_profile:
+            options['icc_profile'] = icc_profile
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        buffer = BytesIO()
+        image.save(buffer, pil_format, **options)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        return path, len(data), len(data), str(error)
+
+    optimized = buffer.getvalue()
+    if len(optimized) >= len(data):
+        return path, len(data), len(data), None
+    if write:
+        temporary = f'{path}.optimizing'
+        with open(temporary, 'wb') as target:
+            target.write(optimized)
+        os.replace(temporary, path)
+    return path, len(data), len(optimized), None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2),
+            thread_name_prefix='image-derivatives',
+        )
+    return _executor
+
+
+def _run_in_background(model, pk):
+    try:
+        refresh_derivatives(model, pk)
+    except Exception:
+        logger.exception('Image derivative job failed for %s %s', model.__name__, pk)
+    finally:
+        # Pool threads would otherwise keep their own connections open
+        connections.close_all()
+
+
+def schedule_derivatives(model, pk):
+    """Queue derivative generation for one row on the background pool"""
+    if getattr(settings, 'IMAGE_DERIVATIVES_SYNC', False):
+        return refresh_derivatives(model, pk)
+    return _get_executor().submit(_run_in_background, model, pk)
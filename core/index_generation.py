@@ -0,0 +1,48 @@
+"""
+Change counters that keep the in-process indexes of every process in step.
+
+The catalog, fuzzy and autocomplete indexes each hold a copy of catalog data
+in every process. A counter in the shared cache counts the changes made to
+that data. An index remembers the value it was built from and rebuilds once
+the counter has moved on. A process that changes the data increments the
+counter; it only stays current when nothing else changed in between.
+"""
+from django.core.cache import cache
+
+
+class Generation:
+    """A change counter stored under `key` in the shared cache"""
+
+    def __init__(self, key):
+        self.key = key
+
+    def current(self):
+        """
+        The counter's value.
+
+        Read it before loading the rows an index is built from, so a change
+        committed while they load moves the counter past the built value.
+        """
+        value = cache.get(self.key)
+        if value is None:
+            # Evicted or never set; add() keeps a value another process set first
+            cache.add(self.key, 0, None)
+            value = cache.get(self.key)
+        return value
+
+    def bump(self, seen):
+        """
+        Count a change applied on top of generation `seen`.
+
+        Returns the new generation when no other change came in since `seen`,
+        or None when the caller's copy is missing one and must be rebuilt.
+        """
+        cache.add(self.key, 0, None)
+        try:
+            value = cache.incr(self.key)
+        except ValueError:
+            # Evicted between add() and incr()
+            return None
+        if seen is None or value != seen + 1:
+            return None
+        return value
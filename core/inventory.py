@@ -0,0 +1,83 @@
+"""
+Stock reservations for orders.
+
+Placing an order takes its quantities out of stock as one batch of sale
+movements in the stock ledger (see core.stock_ledger). The ledger applies
+them with a single conditional UPDATE covering every product in the order:
+
+    UPDATE product SET stock_quantity = stock_quantity + CASE id WHEN ... END
+    WHERE id IN (...) AND stock_quantity >= CASE id WHEN ... END
+
+The UPDATE locks the rows it changes and re-checks the WHERE against the
+latest committed stock, so concurrent checkouts of the same product queue
+up and can never take it below zero. If fewer rows changed than there are
+products, something ran short: the savepoint is rolled back and
+InsufficientStock is raised, so a failed checkout takes nothing.
+
+Order.stock_reserved_at records that an order holds stock. Cancelling or
+returning it puts the stock back as return movements; clearing the flag is
+a conditional UPDATE, so that happens exactly once however many requests
+race. Orders placed before reservations existed hold nothing and release
+nothing.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from . import stock_ledger
+from .models import Order, StockMovement
+from .stock_ledger import InsufficientStock  # noqa: F401
+
+
+# Orders in these states hold no stock
+RELEASING_STATUSES = ('cancelled', 'returned')
+
+
+def _quantities(lines):
+    quantities = defaultdict(int)
+    for product_id, quantity in lines:
+        quantities[product_id] += quantity
+    return dict(quantities)
+
+
+def _movements(order, quantities, kind, sign):
+    return [
+        StockMovement(product_id=product_id, kind=kind, quantity=sign * quantity, order=order)
+        for product_id, quantity in quantities.items()
+    ]
+
+
+def reserve(order, lines):
+    """
+    Take (product_id, quantity) `lines` out of stock for `order`, as it is placed.
+
+    Call it in the transaction that creates the order, and create the order
+    with stock_reserved_at set so cancelling it gives the stock back.
+    """
+    stock_ledger.record(
+        _movements(order, _quantities(lines), StockMovement.SALE, -1), require_stock=True,
+    )
+
+
+def reserve_order(order):
+    """Take an existing order's items out of stock again, e.g. when it is reopened"""
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order.pk, stock_reserved_at__isnull=True).update(stock_reserved_at=Now()):
+            return False
+        quantities = _quantities(order.items.values_list('product_id', 'quantity'))
+        stock_ledger.record(_movements(order, quantities, StockMovement.SALE, -1), require_stock=True)
+    order.stock_reserved_at = timezone.now()
+    return True
+
+
+def release(order):
+    """Put a cancelled or returned order's items back in stock; False if it held none"""
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order.pk, stock_reserved_at__isnull=False).update(stock_reserved_at=None):
+            return False
+        quantities = _quantities(order.items.values_list('product_id', 'quantity'))
+        stock_ledger.record(_movements(order, quantities, StockMovement.RETURN, 1))
+    order.stock_reserved_at = None
+    return True
@@ -0,0 +1,327 @@
+import json
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime, timezone as dt_timezone
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from core import cart_summary
+from core.models import Cart, CartItem, Customer, Order, Product
+
+
+# Latency percentiles reported per scenario
+PERCENTILES = (50, 90, 95, 99)
+
+# Metrics compared against a baseline; query counts are exact, so any rise counts
+LATENCY_METRICS = ('p50_ms', 'p95_ms')
+ALLOCATION_METRICS = ('alloc_peak_kb',)
+
+
+def percentile(ordered, percent):
+    """Linearly interpolated percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the storefront hot paths (latency, queries, allocations) and compare against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help='Scenario names to run (default: all)')
+        parser.add_argument('--iterations', type=int, default=50, help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per scenario first')
+        parser.add_argument('--alloc-iterations', type=int, default=5,
+                            help='Requests per scenario traced with tracemalloc (0 to skip)')
+        parser.add_argument('--username', help='Customer to log in as (default: whoever placed the latest order)')
+        parser.add_argument('--clear-cache', action='store_true',
+                            help='Clear the cache before every request, to time the uncached path')
+        parser.add_argument('--seed', type=int, default=42, help='Seed for picking products and search terms')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='Results file of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed slowdown before a metric counts as a regression (0.25 = 25%%)')
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help='Latency changes smaller than this are noise, whatever the percentage')
+        parser.add_argument('--list', action='store_true', help='List the scenarios and exit')
+
+    def handle(self, *args, **options):
+        scenarios = self.scenarios()
+        if options['list']:
+            for name, description, _user, _request in scenarios:
+                self.stdout.write(f'{name:<24} {description}')
+            return
+        if options['scenarios']:
+            unknown = set(options['scenarios']) - {scenario[0] for scenario in scenarios}
+            if unknown:
+                raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))} (see --list)')
+            scenarios = [scenario for scenario in scenarios if scenario[0] in options['scenarios']]
+        baseline = self.load_baseline(options['baseline']) if options['baseline'] else None
+
+        self.options = options
+        self.random = random.Random(options['seed'])
+        results = {}
+        # Everything the scenarios write (carts, sessions) is rolled back, so
+        # repeated runs see the same data and stay comparable. Requests run
+        # their on_commit callbacks as if they had committed (see send()).
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=['testserver']):
+            with transaction.atomic():
+                self.prepare()
+                for name, _description, user, request in scenarios:
+                    results[name] = self.run_scenario(user, request)
+                    self.stdout.write(self.format_row(name, results[name]))
+                meta = self.meta()
+                transaction.set_rollback(True)
+
+        report = {'meta': meta, 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+                output.write('\n')
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        if baseline is None:
+            self.stdout.write(self.style.SUCCESS(f'Benchmarked {len(results)} scenarios.'))
+            return
+        regressions = self.compare(baseline, results, options['threshold'])
+        if regressions:
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Benchmarked {len(results)} scenarios; no regressions against {options["baseline"]}.'
+        ))
+
+    def scenarios(self):
+        """(name, description, 'anonymous' or 'customer', callable(client) -> response)"""
+        return [
+            ('home_anonymous', 'Home page, anonymous (page cache)', 'anonymous',
+             lambda client: client.get(reverse('home'))),
+            ('home', 'Home page, logged in', 'customer',
+             lambda client: client.get(reverse('home'))),
+            ('products', 'Product listing, default sort', 'customer',
+             lambda client: client.get(reverse('products'))),
+            ('products_filtered', 'Product listing, rotating filter and sort combinations', 'customer',
+             lambda client: client.get(reverse('products'), self.next_filters())),
+            ('products_search', 'Product listing with a search term', 'customer',
+             lambda client: client.get(reverse('products'), {'search': self.next_term()})),
+            ('product_detail_anonymous', 'Product page, anonymous (page cache)', 'anonymous',
+             lambda client: client.get(reverse('product_detail', args=[self.next_slug()]))),
+            ('product_detail', 'Product page, logged in', 'customer',
+             lambda client: client.get(reverse('product_detail', args=[self.next_slug()]))),
+            ('search', 'Search page', 'customer',
+             lambda client: client.get(reverse('search'), {'q': self.next_term()})),
+            ('add_to_cart', 'AJAX add to cart', 'customer',
+             lambda client: client.post(reverse('add_to_cart', args=[self.next_product_id()]), {'quantity': 1},
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')),
+            ('cart', 'Cart page', 'customer',
+             lambda client: client.get(reverse('cart'))),
+            ('checkout', 'Checkout page', 'customer',
+             lambda client: client.get(reverse('checkout'))),
+            ('my_orders', 'My orders, all', 'customer',
+             lambda client: client.get(reverse('my_orders_all'))),
+            ('my_orders_completed', 'My orders, completed tab', 'customer',
+             lambda client: client.get(reverse('my_orders', args=['completed']))),
+            # Last, as they empty the cart the checkout page needs
+            ('place_order', 'Place a cash order from a 1-line cart', 'customer',
+             lambda client: self.place_order(client, 1)),
+            ('place_order_20', 'Place a cash order from a 20-line cart', 'customer',
+             lambda client: self.place_order(client, 20)),
+        ]
+
+    def prepare(self):
+        """Pick the customer, products and search terms the scenarios use"""
+        username = self.options['username']
+        if username is None:
+            username = Order.objects.order_by('-id').values_list('customer__user__username', flat=True).first()
+        customer = Customer.objects.select_related('user').filter(user__username=username).first() \
+            if username else Customer.objects.select_related('user').order_by('id').first()
+        if customer is None:
+            raise CommandError('No customer to log in as; run generate_load_data or populate_db first')
+
+        products = list(Product.objects.filter(stock_quantity__gte=1000).values_list('id', 'slug', 'name')[:200])
+        if not products:
+            products = list(Product.objects.values_list('id', 'slug', 'name')[:200])
+        if not products:
+            raise CommandError('No products to benchmark; run generate_load_data or populate_db first')
+        self.random.shuffle(products)
+        self.products = products
+        # Each order takes one of every product in it, so those need stock to spare
+        self.stocked = list(Product.objects.filter(stock_quantity__gte=100).values_list('id', flat=True)[:200])
+        self.terms = sorted({word.lower() for _id, _slug, name in products for word in name.split() if len(word) > 3})
+        self.random.shuffle(self.terms)
+        self.filters = [
+            {'category': product_type} for product_type, _label in Product.PRODUCT_TYPES
+        ] + [
+            {'price': '0-200', 'sort': 'price-low-high'},
+            {'price': '200-', 'sort': 'price-high-low'},
+            {'rating': '4', 'sort': 'top-rated'},
+            {'free_delivery': '1', 'sort': 'bestseller'},
+            {'category': Product.PRODUCT_TYPES[0][0], 'rating': '3', 'page': '2'},
+        ]
+        self.position = 0
+
+        self.anonymous = Client()
+        self.customer_client = Client()
+        self.customer_client.force_login(customer.user)
+        self.username = customer.user.username
+        # Checkout redirects away from an empty cart
+        product_id = self.products[0][0]
+        self.customer_client.post(reverse('add_to_cart', args=[product_id]), {'quantity': 1},
+                                  HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.cart_id = Cart.objects.values_list('id', flat=True).get(customer=customer)
+
+    def next_item(self, items):
+        self.position += 1
+        return items[self.position % len(items)]
+
+    def next_slug(self):
+        return self.next_item(self.products)[1]
+
+    def next_product_id(self):
+        return self.next_item(self.products)[0]
+
+    def next_term(self):
+        return self.next_item(self.terms) if self.terms else 'corn'
+
+    def next_filters(self):
+        return self.next_item(self.filters)
+
+    def place_order(self, client, lines):
+        """Fill the cart with `lines` products in one query, then check out"""
+        if not self.stocked:
+            raise CommandError('No product has 100 in stock to place orders with')
+        CartItem.objects.bulk_create([
+            CartItem(cart_id=self.cart_id, product_id=self.next_item(self.stocked), quantity=1) for _ in range(lines)
+        ], ignore_conflicts=True)
+        cart_summary.invalidate(self.cart_id)
+        return client.post(reverse('checkout'), {'delivery_method': 'pickup', 'payment_method': 'cash'})
+
+    def send(self, request, client):
+        """
+        Make one request and run the on_commit callbacks it registered.
+
+        The run's transaction never commits, so otherwise cache invalidation
+        and the other post-commit work would be neither done nor measured.
+        """
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            return request(client)
+
+    def run_scenario(self, user, request):
+        client = self.customer_client if user == 'customer' else self.anonymous
+        clear_cache = self.options['clear_cache']
+        self.position = 0
+        for _ in range(self.options['warmup']):
+            if clear_cache:
+                cache.clear()
+            self.send(request, client)
+
+        timings, query_counts, statuses = [], [], {}
+        for _ in range(self.options['iterations']):
+            if clear_cache:
+                cache.clear()
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = self.send(request, client)
+                elapsed = time.perf_counter() - started
+            timings.append(elapsed * 1000)
+            query_counts.append(len(queries.captured_queries))
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+        # Tracing slows every allocation down, so it gets its own pass
+        peaks, retained = [], []
+        if self.options['alloc_iterations'] > 0:
+            tracemalloc.start()
+            try:
+                for _ in range(self.options['alloc_iterations']):
+                    if clear_cache:
+                        cache.clear()
+                    before, _peak = tracemalloc.get_traced_memory()
+                    tracemalloc.reset_peak()
+                    self.send(request, client)
+                    after, peak = tracemalloc.get_traced_memory()
+                    peaks.append(peak - before)
+                    retained.append(after - before)
+            finally:
+                tracemalloc.stop()
+
+        timings.sort()
+        result = {
+            'iterations': len(timings),
+            'statuses': statuses,
+            'mean_ms': round(sum(timings) / len(timings), 3) if timings else 0.0,
+            'min_ms': round(timings[0], 3) if timings else 0.0,
+            'max_ms': round(timings[-1], 3) if timings else 0.0,
+            'queries_mean': round(sum(query_counts) / len(query_counts), 2) if query_counts else 0.0,
+            'queries_max': max(query_counts, default=0),
+            'alloc_peak_kb': round(max(peaks) / 1024, 1) if peaks else None,
+            'alloc_retained_kb': round(max(retained) / 1024, 1) if retained else None,
+        }
+        for percent in PERCENTILES:
+            result[f'p{percent}_ms'] = round(percentile(timings, percent), 3)
+        return result
+
+    def format_row(self, name, result):
+        statuses = ','.join(sorted(result['statuses']))
+        alloc = '-' if result['alloc_peak_kb'] is None else f'{result["alloc_peak_kb"]:.0f} KB'
+        return (
+            f'{name:<24} p50 {result["p50_ms"]:8.2f} ms  p95 {result["p95_ms"]:8.2f} ms  '
+            f'p99 {result["p99_ms"]:8.2f} ms  queries {result["queries_max"]:3}  alloc {alloc:>9}  [{statuses}]'
+        )
+
+    def meta(self):
+        return {
+            'created_at': datetime.now(dt_timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'cache': settings.CACHES['default']['BACKEND'],
+            'username': self.username,
+            'products': Product.objects.count(),
+            'orders': Order.objects.count(),
+            'iterations': self.options['iterations'],
+            'warmup': self.options['warmup'],
+            'clear_cache': self.options['clear_cache'],
+            'seed': self.options['seed'],
+        }
+
+    def load_baseline(self, path):
+        try:
+            with open(path) as baseline:
+                return json.load(baseline)
+        except (OSError, ValueError) as error:
+            raise CommandError(f'Cannot read baseline {path}: {error}')
+
+    def compare(self, baseline, results, threshold):
+        """Messages for every metric that got worse than the baseline by more than `threshold`"""
+        regressions = []
+        if baseline.get('meta', {}).get('clear_cache') != self.options['clear_cache']:
+            self.stdout.write(self.style.WARNING('Baseline was recorded with a different --clear-cache setting.'))
+        for name, result in results.items():
+            before = baseline.get('results', {}).get(name)
+            if before is None:
+                self.stdout.write(self.style.WARNING(f'{name}: not in the baseline'))
+                continue
+            if result['queries_max'] > before['queries_max']:
+                regressions.append(f'{name}: queries {before["queries_max"]} -> {result["queries_max"]}')
+            for metric in LATENCY_METRICS + ALLOCATION_METRICS:
+                old, new = before.get(metric), result.get(metric)
+                if not old or new is None or new <= old * (1 + threshold):
+                    continue
+                if metric in LATENCY_METRICS and new - old < self.options['min_delta_ms']:
+                    continue
+                regressions.append(f'{name}: {metric} {old} -> {new} (+{(new / old - 1) * 100:.0f}%)')
+        return regressions
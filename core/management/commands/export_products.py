@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from core.product_io import FORMATS, detect_format, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Export every product as CSV or JSON Lines (the format import_products reads)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Output file (default: standard output)')
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: from the file extension, else csv)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or detect_format(path)
+        target = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        count = -1 if file_format == 'csv' else 0
+        try:
+            for line in export_lines(file_format):
+                target.write(line)
+                count += 1
+        finally:
+            if target is not sys.stdout:
+                target.close()
+        if target is not sys.stdout:
+            self.stdout.write(self.style.SUCCESS(f'Exported {count} products to {path}.'))
@@ -0,0 +1,449 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from core import page_cache, stock_ledger
+from core.autocomplete import autocomplete_index
+from core.catalog_index import catalog_index
+from core.fuzzy_search import fuzzy_index
+from core.models import (
+    Advertisement, Cart, CartItem, Category, Contact, ContactReply, Customer, CustomerFeedback,
+    CustomerSupport, Order, OrderItem, OrderTracking, Product, Review, SupportMessage,
+)
+from core.ratings import rebuild_product_ratings
+
+
+# Every generated user's username starts with this, so runs can be detected
+USERNAME_PREFIX = 'load_'
+
+CATEGORIES = [
+    ('Fresh Corn', 'fresh-corn', 'fresh-corn'),
+    ('Bundles & Combos', 'bundles-combos', 'bundles'),
+    ('Snacks', 'snacks', 'snacks'),
+    ('Farm Goods', 'farm-goods', 'farm-goods'),
+]
+ADJECTIVES = ['Sweet', 'Golden', 'Purple', 'Buttered', 'Grilled', 'Roasted', 'Organic', 'Baby', 'Smoky',
+              'Creamy', 'Spicy', 'Honey', 'Salted', 'Cheesy', 'Native', 'Highland']
+NOUNS = ['Corn', 'Corn Cups', 'Cornbread', 'Corn Chips', 'Popcorn', 'Corn Flour', 'Corn Silk Tea',
+         'Corn Pack', 'Corn Bundle', 'Polenta', 'Cornmeal', 'Corn Soup']
+SIZES = ['250g', '500g', '1kg', '6 pcs', '12 pcs', 'Family Pack', 'Party Tray', 'Snack Size']
+FIRST_NAMES = ['Juan', 'Maria', 'Jose', 'Ana', 'Mark', 'Angel', 'John', 'Mary', 'Paolo', 'Andrea',
+               'Miguel', 'Bea', 'Carlo', 'Nicole', 'Rafael', 'Camille', 'Joshua', 'Kristine', 'Daniel', 'Patricia']
+LAST_NAMES = ['Santos', 'Reyes', 'Cruz', 'Bautista', 'Ocampo', 'Garcia', 'Mendoza', 'Torres', 'Tomas',
+              'Andrada', 'Castillo', 'Flores', 'Villanueva', 'Ramos', 'Castro', 'Rivera', 'Aquino', 'Navarro']
+CITIES = ['Quezon City', 'Manila', 'Davao City', 'Caloocan', 'Cebu City', 'Zamboanga City', 'Taguig',
+          'Antipolo', 'Pasig', 'Cagayan de Oro', 'Paranaque', 'Makati', 'Bacolod', 'Baguio', 'Iloilo City']
+REVIEW_COMMENTS = {
+    5: ['Super sweet and fresh, will order again!', 'Best corn in town.', 'Arrived quickly and tasted amazing.'],
+    4: ['Very good, a bit pricey.', 'Fresh and tasty, packaging could be better.', 'Kids loved it.'],
+    3: ['Okay lang, nothing special.', 'Some pieces were small.', 'Decent for the price.'],
+    2: ['Not as sweet as expected.', 'Delivery was late and corn was dry.'],
+    1: ['Arrived spoiled.', 'Wrong item delivered.'],
+}
+SUBJECTS = ['Delivery schedule', 'Order not received', 'Wrong item', 'Refund request', 'Bulk order inquiry',
+            'Change delivery address', 'Payment issue', 'Product availability', 'Partnership', 'Feedback']
+
+# Share of each line count, quantity and star rating
+ITEM_COUNT_WEIGHTS = {1: 35, 2: 28, 3: 18, 4: 10, 5: 6, 6: 3}
+QUANTITY_WEIGHTS = {1: 60, 2: 25, 3: 10, 4: 3, 6: 2}
+RATING_WEIGHTS = {5: 45, 4: 30, 3: 12, 2: 6, 1: 7}
+# Order status mix by age: under a day, under four days, older
+NEW_ORDER_STATUSES = {'pending': 50, 'confirmed': 30, 'processing': 20}
+RECENT_ORDER_STATUSES = {'processing': 40, 'shipped': 40, 'delivered': 20}
+OLD_ORDER_STATUSES = {'delivered': 88, 'cancelled': 7, 'returned': 5}
+REPLY_COUNT_WEIGHTS = {0: 30, 1: 35, 2: 20, 3: 10, 4: 5}
+NEW_TICKET_STATUSES = {'open': 40, 'in_progress': 60}
+OLD_TICKET_STATUSES = {'resolved': 60, 'closed': 35, 'open': 5}
+TICKET_PRIORITIES = {'low': 30, 'medium': 45, 'high': 20, 'urgent': 5}
+AD_TYPES = {'banner': 75, 'video': 25}
+AD_STATUSES = {'active': 40, 'inactive': 20, 'archived': 30, 'draft': 10}
+
+
+def zipf_cum_weights(count, exponent):
+    """Cumulative weights where item i is picked in proportion to 1 / (i + 1) ** exponent"""
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(count)))
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let bulk_create keep the created_at/updated_at values set on the instances"""
+    saved = []
+    for model in models:
+        for field in model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                saved.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with a large, skewed, reproducible synthetic dataset for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=100000)
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--reviews', type=int, default=150000)
+        parser.add_argument('--contacts', type=int, default=20000)
+        parser.add_argument('--tickets', type=int, default=20000)
+        parser.add_argument('--feedback', type=int, default=10000)
+        parser.add_argument('--ads', type=int, default=40)
+        parser.add_argument('--carts', type=float, default=0.2, help='Share of customers with a filled cart')
+        parser.add_argument('--days', type=int, default=730, help='Days of history to spread the data over')
+        parser.add_argument('--seed', type=int, default=42, help='Same seed, same dataset')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk_create batch')
+        parser.add_argument('--password', default='loadtest', help='Password of every generated user')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError('Load data has already been generated in this database; use a fresh database.')
+
+        self.rng = random.Random(options['seed'])
+        self._tables = {}
+        self.batch_size = options['batch_size']
+        self.now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.start = self.now - timedelta(days=options['days'])
+        started = time.monotonic()
+
+        models = (Product, Customer, Order, OrderTracking, Review, Contact, ContactReply,
+                  CustomerSupport, SupportMessage, CustomerFeedback, Cart, Advertisement)
+        with explicit_timestamps(*models):
+            self.staff = self.create_staff(options['password'])
+            products = self.phase('products', self.create_products, options['products'])
+            customers = self.phase('customers', self.create_customers, options['customers'], options['password'])
+            self.phase('orders', self.create_orders, options['orders'], customers, products)
+            self.phase('reviews', self.create_reviews, options['reviews'], customers, products)
+            self.phase('carts', self.create_carts, options['carts'], customers, products)
+            self.phase('contacts', self.create_contacts, options['contacts'], customers)
+            self.phase('support tickets', self.create_tickets, options['tickets'], customers)
+            self.phase('feedback', self.create_feedback, options['feedback'], customers)
+            self.phase('advertisements', self.create_ads, options['ads'])
+
+        self.phase('rating summaries', rebuild_product_ratings)
+        # bulk_create skips the model signals that keep these in sync
+        catalog_index.invalidate()
+        fuzzy_index.invalidate()
+        autocomplete_index.invalidate()
+        page_cache.bump(page_cache.CATALOG, page_cache.REVIEWS, page_cache.ADS)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated load data in {time.monotonic() - started:.0f}s. '
+            f'Customers log in as {USERNAME_PREFIX}customer<N> with password "{options["password"]}"; '
+            f'run rank_sales and rebuild_recommendations to derive rankings.'
+        ))
+
+    def phase(self, label, function, *args):
+        started = time.monotonic()
+        result = function(*args)
+        self.stdout.write(f'  {label}: {time.monotonic() - started:.1f}s')
+        return result
+
+    # Helpers
+
+    def moment_after(self, earliest, recent_bias=1.0):
+        """A time between `earliest` and now; recent_bias > 1 favours recent times"""
+        span = (self.now - earliest).total_seconds()
+        return earliest + timedelta(seconds=span * self.rng.random() ** (1 / recent_bias))
+
+    def weighted(self, weights, k=1):
+        key = id(weights)
+        if key not in self._tables:
+            self._tables[key] = (list(weights), list(accumulate(weights.values())))
+        population, cum_weights = self._tables[key]
+        return self.rng.choices(population, cum_weights=cum_weights, k=k)
+
+    def bulk(self, model, rows):
+        model.objects.bulk_create(rows, batch_size=self.batch_size)
+        return rows
+
+    # Phases
+
+    def create_staff(self, password):
+        staff = User(
+            username=f'{USERNAME_PREFIX}staff', email='staff@load.test', first_name='Load', last_name='Staff',
+            password=make_password(password), is_staff=True,
+        )
+        staff.save()
+        return staff
+
+    def create_products(self, count):
+        categories = []
+        for name, slug, product_type in CATEGORIES:
+            category, _created = Category.objects.get_or_create(slug=slug, defaults={'name': name})
+            categories.append((category, product_type))
+        images = list(Product.objects.exclude(image='').values_list('image', flat=True).distinct()[:20]) or ['']
+
+        rows = []
+        for number in range(count):
+            category, product_type = self.rng.choice(categories)
+            name = f'{self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)} ({self.rng.choice(SIZES)})'
+            created = self.moment_after(self.start, recent_bias=0.8)
+            rows.append(Product(
+                name=name, slug=f'{USERNAME_PREFIX.rstrip("_")}-product-{number}',
+                description=f'{name}, farm-fresh from our partner growers. Great for family meals and merienda.',
+                price=Decimal(self.rng.choice([35, 49, 60, 85, 99, 120, 150, 180, 250, 320, 450, 600, 999])),
+                category=category, product_type=product_type, image=self.rng.choice(images),
+                is_featured=self.rng.random() < 0.03, is_bestseller=self.rng.random() < 0.02,
+                is_new=created > self.now - timedelta(days=30), free_delivery=self.rng.random() < 0.15,
+                stock_quantity=self.rng.choice([0, 3, 10, 25, 50, 100, 250, 500]),
+                created_at=created, updated_at=created,
+            ))
+        self.bulk(Product, rows)
+        stock_ledger.open_balances()
+        # A few products sell most of the volume
+        products = list(Product.objects.values_list('id', 'price'))
+        self.rng.shuffle(products)
+        return products
+
+    def create_customers(self, count, password):
+        password_hash = make_password(password)
+        customers = []
+        for start in range(0, count, self.batch_size):
+            users, profiles = [], []
+            for number in range(start, min(count, start + self.batch_size)):
+                first, last = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+                # Sign-ups accelerate over time
+                joined = self.start + (self.now - self.start) * (number / count) ** 0.7
+                users.append(User(
+                    username=f'{USERNAME_PREFIX}customer{number}', email=f'customer{number}@load.test',
+                    first_name=first, last_name=last, password=password_hash, date_joined=joined,
+                ))
+            with transaction.atomic():
+                self.bulk(User, users)
+                for user in users:
+                    profiles.append(Customer(
+                        user_id=user.id, phone=f'09{self.rng.randrange(10 ** 9):09d}',
+                        address=f'{self.rng.randrange(1, 999)} Mabini St.', city=self.rng.choice(CITIES),
+                        created_at=user.date_joined,
+                    ))
+                self.bulk(Customer, profiles)
+            customers.extend((profile.id, profile.user_id, profile.created_at, profile.phone) for profile in profiles)
+        return customers
+
+    def order_timeline(self, order, status):
+        """OrderTracking rows leading up to the order's current status"""
+        if status == 'cancelled':
+            path = ['pending', 'cancelled']
+        else:
+            flow = ['pending', 'confirmed', 'processing',
+                    'ready_for_pickup' if order.delivery_method == 'pickup' else 'shipped', 'delivered']
+            path = flow[:flow.index('delivered' if status == 'returned' else status) + 1]
+            if status == 'returned':
+                path.append('returned')
+        moment = order.created_at
+        rows = []
+        for step in path:
+            rows.append(OrderTracking(
+                order_id=order.id, status=step, message=f'Order status updated to {step.replace("_", " ")}',
+                location='' if step in ('pending', 'confirmed') else self.rng.choice(CITIES),
+                created_at=min(moment, self.now),
+            ))
+            moment += timedelta(hours=self.rng.uniform(1, 30))
+        return rows
+
+    def order_status(self, created, method):
+        age = (self.now - created).days
+        if age < 1:
+            return self.weighted(NEW_ORDER_STATUSES)[0]
+        if age < 4:
+            status = self.weighted(RECENT_ORDER_STATUSES)[0]
+            if status == 'shipped' and method == 'pickup':
+                return 'ready_for_pickup'
+            return status
+        return self.weighted(OLD_ORDER_STATUSES)[0]
+
+    def create_orders(self, count, customers, products):
+        # Early customers are the loyal ones who order most
+        customer_weights = zipf_cum_weights(len(customers), 0.6)
+        product_weights = zipf_cum_weights(len(products), 1.1)
+        item_counts = self.weighted(ITEM_COUNT_WEIGHTS, k=count)
+        for start in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - start)
+            buyers = self.rng.choices(customers, cum_weights=customer_weights, k=size)
+            orders, lines = [], []
+            for offset, (customer_id, _user_id, joined, phone) in enumerate(buyers):
+                number = start + offset
+                created = self.moment_after(joined, recent_bias=1.5)
+                method = 'pickup' if self.rng.random() < 0.25 else 'delivery'
+                status = self.order_status(created, method)
+                basket = {}
+                for product_id, price in self.rng.choices(products, cum_weights=product_weights,
+                                                          k=item_counts[number]):
+                    basket[product_id] = (price, self.weighted(QUANTITY_WEIGHTS)[0])
+                subtotal = sum(price * quantity for price, quantity in basket.values())
+                fee = Decimal('0') if method == 'pickup' or subtotal >= 1000 else Decimal('50')
+                orders.append(Order(
+                    customer_id=customer_id, order_number=f'LD{number:09d}', status=status,
+                    delivery_method=method, delivery_address='' if method == 'pickup' else 'Mabini St.',
+                    phone=phone, subtotal=subtotal, delivery_fee=fee, total=subtotal + fee,
+                    delivered_at=created + timedelta(days=2) if status in ('delivered', 'returned') else None,
+                    created_at=created, updated_at=created,
+                ))
+                lines.append(basket)
+
+            with transaction.atomic():
+                self.bulk(Order, orders)
+                items, tracking = [], []
+                for order, basket in zip(orders, lines):
+                    items.extend(
+                        OrderItem(order_id=order.id, product_id=product_id, quantity=quantity, price=price)
+                        for product_id, (price, quantity) in basket.items()
+                    )
+                    tracking.extend(self.order_timeline(order, order.status))
+                self.bulk(OrderItem, items)
+                self.bulk(OrderTracking, tracking)
+            if (start // self.batch_size) % 20 == 19:
+                self.stdout.write(f'    {start + size} orders')
+
+    def create_reviews(self, count, customers, products):
+        product_weights = zipf_cum_weights(len(products), 1.0)
+        count = min(count, len(customers) * len(products) // 2)
+        seen = set()
+        for start in range(0, count, self.batch_size):
+            rows = []
+            while len(rows) < min(self.batch_size, count - start):
+                product_id, _price = self.rng.choices(products, cum_weights=product_weights)[0]
+                customer_id, _user_id, joined, _phone = self.rng.choice(customers)
+                if (product_id, customer_id) in seen:
+                    continue
+                seen.add((product_id, customer_id))
+                rating = self.weighted(RATING_WEIGHTS)[0]
+                rows.append(Review(
+                    product_id=product_id, customer_id=customer_id, rating=rating,
+                    comment=self.rng.choice(REVIEW_COMMENTS[rating]), is_featured=self.rng.random() < 0.01,
+                    created_at=self.moment_after(joined),
+                ))
+            with transaction.atomic():
+                self.bulk(Review, rows)
+
+    def create_carts(self, share, customers, products):
+        product_weights = zipf_cum_weights(len(products), 1.0)
+        shoppers = self.rng.sample(customers, int(len(customers) * share))
+        for start in range(0, len(shoppers), self.batch_size):
+            carts = [
+                Cart(customer_id=customer_id, created_at=self.now, updated_at=self.now)
+                for customer_id, _user_id, _joined, _phone in shoppers[start:start + self.batch_size]
+            ]
+            with transaction.atomic():
+                self.bulk(Cart, carts)
+                items = []
+                for cart in carts:
+                    picked = self.rng.choices(products, cum_weights=product_weights, k=self.rng.randint(1, 4))
+                    items.extend(
+                        CartItem(cart_id=cart.id, product_id=product_id, quantity=self.rng.randint(1, 3))
+                        for product_id in {product_id for product_id, _price in picked}
+                    )
+                self.bulk(CartItem, items)
+
+    def create_contacts(self, count, customers):
+        for start in range(0, count, self.batch_size):
+            contacts = []
+            for number in range(start, min(count, start + self.batch_size)):
+                registered = self.rng.random() < 0.7
+                _customer_id, user_id, joined, _phone = self.rng.choice(customers)
+                created = self.moment_after(joined if registered else self.start, recent_bias=1.3)
+                contacts.append(Contact(
+                    name=f'{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}',
+                    email=f'contact{number}@load.test', user_id=user_id if registered else None,
+                    subject=self.rng.choice(SUBJECTS), message='Hello, I have a question about my order.',
+                    is_read=created < self.now - timedelta(days=2) or self.rng.random() < 0.5,
+                    created_at=created, last_updated=created,
+                ))
+            with transaction.atomic():
+                self.bulk(Contact, contacts)
+                replies = []
+                for contact in contacts:
+                    moment = contact.created_at
+                    for turn in range(self.weighted(REPLY_COUNT_WEIGHTS)[0]):
+                        moment = min(self.now, moment + timedelta(hours=self.rng.uniform(1, 48)))
+                        from_admin = turn % 2 == 0
+                        replies.append(ContactReply(
+                            contact_id=contact.id, sender_id=self.staff.id if from_admin else contact.user_id,
+                            sender_name='Golden Mais Support' if from_admin else contact.name,
+                            message='Thanks for reaching out, we are looking into it.' if from_admin
+                            else 'Thank you, any update?',
+                            is_admin=from_admin, is_read=moment < self.now - timedelta(days=1), created_at=moment,
+                        ))
+                self.bulk(ContactReply, replies)
+
+    def create_tickets(self, count, customers):
+        for start in range(0, count, self.batch_size):
+            tickets = []
+            for number in range(start, min(count, start + self.batch_size)):
+                customer_id, user_id, joined, _phone = self.rng.choice(customers)
+                created = self.moment_after(joined, recent_bias=1.3)
+                age = (self.now - created).days
+                status = (self.weighted(NEW_TICKET_STATUSES)[0] if age < 3
+                          else self.weighted(OLD_TICKET_STATUSES)[0])
+                ticket = CustomerSupport(
+                    ticket_number=f'LT{number:08d}', customer_id=customer_id, subject=self.rng.choice(SUBJECTS),
+                    description='Please help me with my recent order.',
+                    priority=self.weighted(TICKET_PRIORITIES)[0],
+                    status=status, assigned_to=self.staff if status != 'open' else None,
+                    created_at=created, updated_at=created,
+                    resolved_at=created + timedelta(days=1) if status in ('resolved', 'closed') else None,
+                )
+                ticket.customer_user_id = user_id
+                tickets.append(ticket)
+            with transaction.atomic():
+                self.bulk(CustomerSupport, tickets)
+                messages = []
+                for ticket in tickets:
+                    moment = ticket.created_at
+                    for turn in range(self.rng.randint(1, 6)):
+                        moment = min(self.now, moment + timedelta(hours=self.rng.uniform(0.5, 24)))
+                        messages.append(SupportMessage(
+                            ticket_id=ticket.id,
+                            sender_id=ticket.customer_user_id if turn % 2 == 0 else self.staff.id,
+                            message='Any update on this?' if turn % 2 == 0 else 'We are on it.',
+                            is_internal=turn % 2 == 1 and self.rng.random() < 0.1, created_at=moment,
+                        ))
+                self.bulk(SupportMessage, messages)
+
+    def create_feedback(self, count, customers):
+        for start in range(0, count, self.batch_size):
+            rows = []
+            for _number in range(start, min(count, start + self.batch_size)):
+                customer_id, _user_id, joined, _phone = self.rng.choice(customers)
+                created = self.moment_after(joined)
+                responded = self.rng.random() < 0.4
+                rows.append(CustomerFeedback(
+                    customer_id=customer_id,
+                    feedback_type=self.rng.choice([value for value, _label in CustomerFeedback.FEEDBACK_TYPES]),
+                    subject=self.rng.choice(SUBJECTS), message='Overall a good experience.',
+                    rating=self.weighted(RATING_WEIGHTS)[0], is_published=self.rng.random() < 0.2,
+                    admin_response='Thank you for your feedback!' if responded else '',
+                    responded_by=self.staff if responded else None,
+                    responded_at=created + timedelta(days=1) if responded else None, created_at=created,
+                ))
+            with transaction.atomic():
+                self.bulk(CustomerFeedback, rows)
+
+    def create_ads(self, count):
+        rows = []
+        for number in range(count):
+            created = self.moment_after(self.start)
+            starts = created + timedelta(days=self.rng.randint(0, 10))
+            rows.append(Advertisement(
+                title=f'Promo {number}: {self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)} Sale',
+                description='Limited time only.', ad_type=self.weighted(AD_TYPES)[0],
+                status=self.weighted(AD_STATUSES)[0],
+                display_order=number, start_date=starts,
+                end_date=starts + timedelta(days=self.rng.choice([7, 14, 30, 365])),
+                views=int(self.rng.paretovariate(1.2) * 100), clicks=int(self.rng.paretovariate(1.5) * 5),
+                created_by=self.staff, created_at=created, updated_at=created,
+            ))
+        self.bulk(Advertisement, rows)
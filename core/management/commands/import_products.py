@@ -0,0 +1,41 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from core.product_io import FORMATS, detect_format, import_products
+
+
+class Command(BaseCommand):
+    help = 'Create or update products from a CSV or JSON Lines file, matching existing products by slug'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - for standard input')
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: from the file extension, else csv)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per upsert')
+        parser.add_argument(
+            '--stock', action='store_true',
+            help='Also set stock levels from stock_quantity (blank cells leave a product unchanged)',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Validate and roll back instead of saving')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or detect_format(path)
+        try:
+            source = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        except OSError as error:
+            raise CommandError(f'Cannot read {path}: {error}')
+        with source:
+            result = import_products(
+                source, file_format=file_format,
+                batch_size=options['batch_size'], dry_run=options['dry_run'], stock=options['stock'],
+            )
+
+        for line, message in result.errors[:50]:
+            self.stderr.write(self.style.WARNING(f'Line {line}: {message}'))
+        if len(result.errors) > 50:
+            self.stderr.write(self.style.WARNING(f'... and {len(result.errors) - 50} more invalid rows'))
+        verb = 'Would import' if options['dry_run'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {result.written} products ({result.created} new, {result.updated} updated); '
+            f'{len(result.errors)} rows skipped.'
+        ))
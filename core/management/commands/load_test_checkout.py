@@ -0,0 +1,175 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from core import inventory, stock_ledger
+from core.models import Cart, CartItem, Customer, Order, OrderItem, Product
+
+
+class Command(BaseCommand):
+    help = 'Check out hundreds of carts at once against one scarce product and check that it is never oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=300, help='Customers checking out at the same time')
+        parser.add_argument('--workers', type=int, default=32, help='Threads sending the checkouts')
+        parser.add_argument('--stock', type=int, default=100, help='Units of the product on offer')
+        parser.add_argument('--quantity', type=int, default=1, help='Units in each cart')
+
+    def handle(self, *args, **options):
+        if min(options['buyers'], options['workers'], options['quantity']) < 1 or options['stock'] < 0:
+            raise CommandError('--buyers, --workers and --quantity must be positive, --stock not negative')
+        tag = uuid.uuid4().hex[:12]
+        # A throwaway product and buyers, so the run leaves the real catalog alone
+        product = Product.objects.create(
+            name=f'Load test SKU {tag}', slug=f'load-test-{tag}', description='Checkout load test',
+            price=Decimal('10.00'), product_type=Product.PRODUCT_TYPES[0][0], stock_quantity=options['stock'],
+        )
+        stock_ledger.open_balances(Product.objects.filter(pk=product.pk))
+        users = self.create_buyers(tag, product, options)
+        session_keys = []
+        try:
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                outcomes, elapsed = self.fire(users, options, session_keys)
+            self.report(product, options, outcomes, elapsed)
+            self.check_release(product, options)
+        finally:
+            Session.objects.filter(session_key__in=session_keys).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+            product.delete()
+
+    def create_buyers(self, tag, product, options):
+        users = User.objects.bulk_create([
+            User(username=f'load-{tag}-{number}', password=make_password(None))
+            for number in range(options['buyers'])
+        ])
+        if users and users[0].pk is None:
+            users = list(User.objects.filter(username__startswith=f'load-{tag}-'))
+        customers = Customer.objects.bulk_create([Customer(user=user, phone='09170000000') for user in users])
+        carts = Cart.objects.bulk_create([Cart(customer=customer) for customer in customers])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=options['quantity']) for cart in carts
+        ])
+        return users
+
+    def fire(self, users, options, session_keys):
+        url = reverse('checkout')
+        pending = iter(users)
+        lock = threading.Lock()
+        outcomes = Counter()
+        start = threading.Barrier(options['workers'])
+
+        def worker():
+            start.wait()
+            try:
+                while True:
+                    with lock:
+                        user = next(pending, None)
+                    if user is None:
+                        return
+                    client = Client(raise_request_exception=True)
+                    client.force_login(user)
+                    with lock:
+                        session_keys.append(client.session.session_key)
+                    try:
+                        response = client.post(url, {'delivery_method': 'pickup', 'payment_method': 'cash'})
+                        if response.status_code == 302 and 'order-success' in response.url:
+                            outcome = 'placed'
+                        elif response.status_code == 200:
+                            outcome = 'refused'
+                        else:
+                            outcome = f'HTTP {response.status_code}'
+                    except Exception as error:
+                        outcome = type(error).__name__
+                    with lock:
+                        outcomes[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['workers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes, time.perf_counter() - started
+
+    def report(self, product, options, outcomes, elapsed):
+        stock = Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+        sold = OrderItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+        orders = Order.objects.filter(items__product=product).distinct().count()
+        expected = min(options['buyers'], options['stock'] // options['quantity'])
+
+        self.stdout.write(
+            f'{options["buyers"]} checkouts of {options["quantity"]} against {options["stock"]} in stock '
+            f'in {elapsed:.2f}s ({options["buyers"] / elapsed:.0f} req/s)'
+        )
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome:<20} {count}')
+        self.stdout.write(f'  {"units sold":<20} {sold}')
+        self.stdout.write(f'  {"stock left":<20} {stock}')
+
+        problems = []
+        errors = sum(count for outcome, count in outcomes.items() if outcome not in ('placed', 'refused'))
+        if errors:
+            problems.append(f'{errors} checkouts failed')
+        if sold > options['stock']:
+            problems.append(f'{sold} units sold but only {options["stock"]} were in stock (oversold)')
+        if stock != options['stock'] - sold:
+            problems.append(f'{stock} left in stock after selling {sold} of {options["stock"]}')
+        # A failed request may still have committed its order before failing
+        if not outcomes['placed'] <= orders <= outcomes['placed'] + errors:
+            problems.append(f'{orders} orders exist but {outcomes["placed"]} checkouts succeeded')
+        if not errors and outcomes['placed'] != expected:
+            problems.append(f'{outcomes["placed"]} checkouts succeeded, expected {expected}')
+        self.finish(problems, 'No oversold stock, lost orders or errors.')
+
+    def check_release(self, product, options):
+        """Cancel every order twice at once; the stock must come back exactly once"""
+        orders = list(Order.objects.filter(items__product=product).distinct())
+        released = Counter()
+        lock = threading.Lock()
+
+        def worker(batch):
+            try:
+                for order in batch:
+                    result = inventory.release(order)
+                    with lock:
+                        released[result] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(orders,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stock = Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+        self.stdout.write(f'Released {len(orders)} orders from two threads: stock back to {stock}')
+        problems = []
+        if stock_ledger.stock_drift(Product.objects.filter(pk=product.pk)):
+            problems.append('stock disagrees with the stock ledger')
+        if released[True] != len(orders):
+            problems.append(f'{released[True]} releases took effect for {len(orders)} orders')
+        if stock != options['stock']:
+            problems.append(f'stock is {stock} after releasing everything, expected {options["stock"]}')
+        self.finish(problems, 'Every order released exactly once.')
+
+    def finish(self, problems, success):
+        if problems:
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(problem))
+            raise CommandError(f'{len(problems)} problems under concurrent checkouts')
+        self.stdout.write(self.style.SUCCESS(success))
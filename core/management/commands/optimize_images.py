@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from core import page_cache
+from core.images import DERIVATIVES_DIR, hash_file, optimize_file, schedule_derivatives
+from core.models import Product
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def _optimize(job):
+    path, max_size, quality, write = job
+    return optimize_file(path, max_size=max_size, quality=quality, write=write)
+
+
+class Command(BaseCommand):
+    help = 'Recompress and downscale media and static images in parallel, deduplicating identical files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Worker processes')
+        parser.add_argument('--max-size', type=int, default=1920, help='Longest side in pixels after resizing')
+        parser.add_argument('--quality', type=int, default=None, help='JPEG/WebP quality (default 85)')
+        parser.add_argument('--manifest', default=str(settings.BASE_DIR / '.optimize_images.jsonl'),
+                            help='Record of processed files; files already in it are skipped')
+        parser.add_argument('--dry-run', action='store_true', help='Report savings without writing anything')
+        parser.add_argument('roots', nargs='*',
+                            help='Directories to process (default: MEDIA_ROOT and the static img directories)')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.media_root = Path(settings.MEDIA_ROOT).resolve()
+        roots = [Path(root).resolve() for root in options['roots']] or self.default_roots()
+        manifest_path = Path(options['manifest'])
+        done = self.load_manifest(manifest_path)
+
+        pending = [path for path in self.walk(roots) if not self.is_done(path, done)]
+        self.stdout.write(f'{len(pending)} images to process ({len(done)} already in the manifest).')
+
+        # Workers never use the database; do not let them inherit open connections
+        connections.close_all()
+        manifest = None if self.dry_run else manifest_path.open('a')
+        saved_before = saved_after = failures = 0
+        try:
+            with Pool(options['workers']) as pool:
+                groups = {}
+                for path, size, digest in pool.imap_unordered(hash_file, pending, chunksize=16):
+                    groups.setdefault(digest, []).append(path)
+
+                # Identical files are encoded once, through their canonical copy.
+                known = {entry['source_hash']: entry['canonical'] for entry in done.values()
+                         if os.path.exists(entry['canonical']) and self.is_done(entry['canonical'], done)}
+                jobs, copies, reused = [], {}, {}
+                for digest, paths in groups.items():
+                    paths.sort(key=lambda path: (not self.in_media(path), path))
+                    if digest in known:
+                        reused[known[digest]] = (digest, paths)
+                    else:
+                        jobs.append((paths[0], options['max_size'], options['quality'], not self.dry_run))
+                        copies[paths[0]] = (digest, paths[1:])
+
+                for path, before, after, error in pool.imap_unordered(_optimize, jobs, chunksize=4):
+                    if error:
+                        failures += 1
+                        self.stdout.write(self.style.WARNING(f'Skipped {path}: {error}'))
+                        continue
+                    digest, duplicates = copies.pop(path)
+                    saved_before += before
+                    saved_after += after
+                    self.record(manifest, path, digest, path)
+                    saved_before, saved_after = self.copy_duplicates(
+                        manifest, path, digest, duplicates, before, after, saved_before, saved_after,
+                    )
+
+                # Copies of files already optimized by an earlier run
+                for canonical, (digest, duplicates) in reused.items():
+                    after = os.stat(canonical).st_size
+                    for duplicate in duplicates:
+                        saved_before, saved_after = self.copy_duplicates(
+                            manifest, canonical, digest, [duplicate], os.stat(duplicate).st_size, after,
+                            saved_before, saved_after,
+                        )
+        finally:
+            if manifest is not None:
+                manifest.close()
+
+        repointed = 0 if self.dry_run else self.repoint_products(self.load_manifest(manifest_path))
+        saved = saved_before - saved_after
+        percent = saved * 100 / saved_before if saved_before else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Would save" if self.dry_run else "Saved"} {saved / 1048576:.1f} MB of '
+            f'{saved_before / 1048576:.1f} MB ({percent:.0f}%); '
+            f'{repointed} products repointed to deduplicated images, {failures} files skipped.'
+        ))
+
+    def default_roots(self):
+        roots = [self.media_root] + [Path(directory).resolve() / 'img' for directory in settings.STATICFILES_DIRS]
+        return [root for root in roots if root.is_dir()]
+
+    def in_media(self, path):
+        return Path(path).is_relative_to(self.media_root)
+
+    def walk(self, roots):
+        derivatives = self.media_root / DERIVATIVES_DIR
+        seen = set()
+        for root in roots:
+            for directory, subdirectories, files in os.walk(root):
+                if Path(directory) == derivatives:
+                    # Renditions are regenerated from the originals, not optimized
+                    subdirectories[:] = []
+                    continue
+                subdirectories.sort()
+                for name in sorted(files):
+                    path = os.path.join(directory, name)
+                    if name.lower().endswith(IMAGE_EXTENSIONS) and path not in seen:
+                        seen.add(path)
+                        yield path
+
+    def load_manifest(self, manifest_path):
+        done = {}
+        if manifest_path.exists():
+            with manifest_path.open() as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write leaves a partial last line
+                        continue
+                    done[entry['path']] = entry
+        return done
+
+    def is_done(self, path, done):
+        entry = done.get(path)
+        if entry is None:
+            return False
+        stat = os.stat(path)
+        return entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def record(self, manifest, path, digest, canonical):
+        if manifest is None:
+            return
+        stat = os.stat(path)
+        manifest.write(json.dumps({
+            'path': path, 'source_hash': digest, 'canonical': canonical,
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+        }) + '\n')
+        manifest.flush()
+
+    def copy_duplicates(self, manifest, canonical, digest, duplicates, before, after, saved_before, saved_after):
+        for duplicate in duplicates:
+            if not self.dry_run and after < before:
+                shutil.copyfile(canonical, duplicate)
+            saved_before += before
+            saved_after += after
+            self.record(manifest, duplicate, digest, canonical)
+        return saved_before, saved_after
+
+    def repoint_products(self, done):
+        """Point products at the canonical copy of duplicated media files, in one bulk_update"""
+        renames = {}
+        for entry in done.values():
+            path, canonical = entry['path'], entry['canonical']
+            if path != canonical and self.in_media(path) and self.in_media(canonical) and Path(canonical).exists():
+                renames[Path(path).relative_to(self.media_root).as_posix()] = \
+                    Path(canonical).relative_to(self.media_root).as_posix()
+        if not renames:
+            return 0
+
+        now = timezone.now()
+        products = list(Product.objects.filter(image__in=list(renames)).only('id', 'image', 'updated_at'))
+        for product in products:
+            product.image = renames[product.image.name]
+            product.updated_at = now
+        Product.objects.bulk_update(products, ['image', 'updated_at'], batch_size=500)
+
+        if products:
+            page_cache.bump(page_cache.CATALOG)
+            for product in products:
+                schedule_derivatives(Product, product.pk)
+        return len(products)
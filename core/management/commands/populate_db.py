@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from decimal import Decimal
+from core import stock_ledger
 from core.models import Category, Product
 
 
@@ -139,6 +140,7 @@ class Command(BaseCommand):
             )
             if created:
                 self.stdout.write(f'Created product: {product.name}')
+        stock_ledger.open_balances()
 
         # Create admin user
         admin_user, created = User.objects.get_or_create(
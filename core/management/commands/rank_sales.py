@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from core import page_cache
+from core.catalog_index import catalog_index
+from core.sales_ranking import DEFAULT_HALF_LIFE_DAYS, rank_sales
+
+
+class Command(BaseCommand):
+    help = 'Update time-decayed sales scores from orders placed or cancelled since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--half-life-days', type=float, default=DEFAULT_HALF_LIFE_DAYS,
+                            help='Days after which a sale counts half (use --full after changing it)')
+        parser.add_argument('--full', action='store_true', help='Reset and recount the whole order history')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Orders processed per batch')
+
+    def handle(self, *args, **options):
+        added, removed = rank_sales(
+            half_life_days=options['half_life_days'],
+            full=options['full'],
+            chunk_size=options['chunk_size'],
+        )
+        catalog_index.invalidate()
+        page_cache.bump(page_cache.CATALOG)
+        self.stdout.write(self.style.SUCCESS(f'Sales scores updated: {added} orders added, {removed} removed.'))
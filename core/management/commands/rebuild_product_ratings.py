@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from core import page_cache
+from core.catalog_index import catalog_index
+from core.ratings import rebuild_product_ratings
+
+
+class Command(BaseCommand):
+    help = 'Recompute the rating summary stored on every product from its reviews'
+
+    def handle(self, *args, **options):
+        updated = rebuild_product_ratings()
+        catalog_index.invalidate()
+        page_cache.bump(page_cache.CATALOG, page_cache.REVIEWS)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rating summaries ({updated} products with reviews).'))
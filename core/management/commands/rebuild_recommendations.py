@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from core import page_cache
+from core.recommendations import METRICS, rebuild_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Mine order history for "frequently bought together" products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=8, help='Neighbours kept per product')
+        parser.add_argument('--metric', choices=METRICS, default='cosine')
+        parser.add_argument('--min-support', type=int, default=2,
+                            help='Minimum number of orders a pair must share')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Order lines fetched per query')
+        parser.add_argument('--max-basket', type=int, default=50,
+                            help='Ignore pairs from orders with more distinct products than this')
+        parser.add_argument('--max-pairs', type=int, default=2000000,
+                            help='Beyond this many tracked pairs, keep only the most frequent half')
+
+    def handle(self, *args, **options):
+        try:
+            orders, rows = rebuild_recommendations(
+                top_k=options['top_k'],
+                metric=options['metric'],
+                min_support=options['min_support'],
+                chunk_size=options['chunk_size'],
+                max_basket=options['max_basket'],
+                max_pairs=options['max_pairs'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        page_cache.bump(page_cache.CATALOG)
+        self.stdout.write(self.style.SUCCESS(f'Stored {rows} recommendations mined from {orders} orders.'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from core.search import sync_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index and its sync triggers'
+
+    def handle(self, *args, **options):
+        if sync_search_index(connection):
+            self.stdout.write(self.style.SUCCESS('Product search index rebuilt.'))
+        else:
+            self.stdout.write(
+                self.style.WARNING('No search index on this database; search uses the icontains fallback.')
+            )
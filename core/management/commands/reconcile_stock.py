@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import stock_ledger
+
+
+class Command(BaseCommand):
+    help = 'Check product stock and stock snapshots against the stock ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Record adjustments for stock drift and rebuild wrong snapshots')
+        parser.add_argument('--limit', type=int, default=50, help='Mismatches listed per kind')
+
+    def handle(self, *args, **options):
+        drift, snapshot_errors = stock_ledger.reconcile()
+        for product_id, name, stock, ledger in drift[:options['limit']]:
+            self.stdout.write(f'Product {product_id} ({name}): stock {stock}, ledger {ledger}')
+        for snapshot_id, product_id, movement_id, quantity, ledger in snapshot_errors[:options['limit']]:
+            self.stdout.write(
+                f'Snapshot {snapshot_id} of product {product_id} at movement {movement_id}: '
+                f'{quantity}, ledger {ledger}'
+            )
+        if not drift and not snapshot_errors:
+            self.stdout.write(self.style.SUCCESS('Stock, snapshots and ledger agree.'))
+            return
+        summary = f'{len(drift)} products drifted from the ledger, {len(snapshot_errors)} snapshots are wrong'
+        if not options['repair']:
+            raise CommandError(f'{summary}; run with --repair to fix.')
+
+        repaired = stock_ledger.repair_drift([product_id for product_id, _name, _stock, _ledger in drift])
+        rebuilt = stock_ledger.take_snapshots(rebuild=True) if snapshot_errors else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{summary}: recorded {len(repaired)} adjustments, rebuilt {rebuilt} snapshots.'
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.stock_ledger import take_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Snapshot the stock of every product that moved since the last run (run periodically)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop every snapshot and rebuild from the whole ledger')
+
+    def handle(self, *args, **options):
+        taken = take_snapshots(rebuild=options['rebuild'])
+        self.stdout.write(self.style.SUCCESS(f'Stock snapshots taken: {taken}.'))
@@ -0,0 +1,125 @@
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from core import badges
+from core.models import CartItem, Product
+
+
+class Command(BaseCommand):
+    help = 'Fire parallel add-to-cart requests at one cart line and check that no add is lost or oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400, help='Add-to-cart requests in total')
+        parser.add_argument('--workers', type=int, default=32, help='Threads sending them at the same time')
+        parser.add_argument('--quantity', type=int, default=1, help='Quantity per request')
+        parser.add_argument('--product', help='Slug of the product to add (default: the one with most stock)')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['workers'] < 1 or options['quantity'] < 1:
+            raise CommandError('--requests, --workers and --quantity must be positive')
+        product = self.product(options['product'])
+        quantity = options['quantity']
+        user = User.objects.create_user(f'stress-{uuid.uuid4().hex[:12]}', password=uuid.uuid4().hex)
+        session_keys = []
+        try:
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                outcomes, elapsed = self.fire(user, product, options, session_keys)
+            self.report(user, product, quantity, options['requests'], outcomes, elapsed)
+        finally:
+            Session.objects.filter(session_key__in=session_keys).delete()
+            user.delete()
+
+    def product(self, slug):
+        products = Product.objects.filter(stock_quantity__gt=0)
+        product = products.filter(slug=slug).first() if slug else products.order_by('-stock_quantity').first()
+        if product is None:
+            raise CommandError('No such product in stock' if slug else 'No product in stock; run populate_db first')
+        return product
+
+    def fire(self, user, product, options, session_keys):
+        url = reverse('add_to_cart', args=[product.pk])
+        pending = iter(range(options['requests']))
+        lock = threading.Lock()
+        outcomes = Counter()
+        # Every worker sends its first request at the same moment, racing to create the line
+        start = threading.Barrier(options['workers'])
+
+        def worker():
+            client = Client(raise_request_exception=True)
+            client.force_login(user)
+            with lock:
+                session_keys.append(client.session.session_key)
+            start.wait()
+            try:
+                while True:
+                    with lock:
+                        if next(pending, None) is None:
+                            return
+                    try:
+                        response = client.post(
+                            url, {'quantity': options['quantity']}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                        )
+                        if response.status_code != 200:
+                            outcome = f'HTTP {response.status_code}'
+                        else:
+                            outcome = 'added' if response.json()['success'] else 'refused'
+                    except Exception as error:
+                        outcome = type(error).__name__
+                    with lock:
+                        outcomes[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['workers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes, time.perf_counter() - started
+
+    def report(self, user, product, quantity, requests, outcomes, elapsed):
+        item = CartItem.objects.filter(cart__customer__user=user, product=product).first()
+        in_cart = item.quantity if item else 0
+        expected = min(requests, product.stock_quantity // quantity)
+
+        self.stdout.write(
+            f'{requests} adds of {quantity} x {product.name} (stock {product.stock_quantity}) '
+            f'in {elapsed:.2f}s ({requests / elapsed:.0f} req/s)'
+        )
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome:<20} {count}')
+        self.stdout.write(f'  {"in cart":<20} {in_cart}')
+
+        problems = []
+        errors = sum(count for outcome, count in outcomes.items() if outcome not in ('added', 'refused'))
+        if errors:
+            problems.append(f'{errors} requests failed')
+        if in_cart < outcomes['added'] * quantity:
+            problems.append(f'cart holds {in_cart} but {outcomes["added"]} adds of {quantity} succeeded (lost updates)')
+        # A failed request may still have added to the line before failing
+        if in_cart > (outcomes['added'] + errors) * quantity:
+            problems.append(f'cart holds {in_cart}, more than was added')
+        if in_cart > product.stock_quantity:
+            problems.append(f'cart holds {in_cart}, more than the {product.stock_quantity} in stock')
+        if not errors and outcomes['added'] != expected:
+            problems.append(f'{outcomes["added"]} adds succeeded, expected {expected}')
+        if item is not None:
+            counter = badges.cart_items(item.cart_id)
+            if counter != in_cart:
+                problems.append(f'header badge shows {counter}, cart holds {in_cart}')
+        if problems:
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(problem))
+            raise CommandError(f'{len(problems)} problems under concurrent adds')
+        self.stdout.write(self.style.SUCCESS('No lost updates, oversold lines or errors.'))
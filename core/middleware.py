@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.contrib.auth import logout
 
+from . import customer_session
+
 
 class AdminSessionSeparationMiddleware:
     """Keeps admin and customer sessions completely separate.
@@ -44,3 +46,17 @@ class AdminSessionSeparationMiddleware:
             return True
         
         return False
+
+
+class CustomerMiddleware:
+    """Attaches lazy request.customer and request.cart (see core.customer_session).
+
+    Must come after AdminSessionSeparationMiddleware, which may sign the user out.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        customer_session.attach(request)
+        return self.get_response(request)
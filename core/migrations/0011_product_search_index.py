@@ -0,0 +1,161 @@
+# Full-text search index for products, kept in sync by database triggers
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE core_product_fts USING fts5(
+        name, description, category_name,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+]
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER core_product_fts_insert AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_update
+    AFTER UPDATE OF name, description, category_id ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_delete AFTER DELETE ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER core_category_fts_update AFTER UPDATE OF name ON core_category BEGIN
+        UPDATE core_product_fts SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM core_product WHERE category_id = new.id);
+    END
+    """,
+]
+
+SQLITE_POPULATE = [
+    """
+    INSERT INTO core_product_fts (rowid, name, description, category_name)
+    SELECT p.id, p.name, p.description, COALESCE(c.name, '')
+    FROM core_product p LEFT JOIN core_category c ON c.id = p.category_id
+    """,
+]
+
+SQLITE_REVERSE = [
+    'DROP TRIGGER IF EXISTS core_category_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_delete',
+    'DROP TRIGGER IF EXISTS core_product_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_insert',
+    'DROP TABLE IF EXISTS core_product_fts',
+]
+
+POSTGRES_FORWARD = [
+    """
+    CREATE TABLE core_product_search (
+        product_id bigint PRIMARY KEY REFERENCES core_product (id) ON DELETE CASCADE,
+        document tsvector NOT NULL
+    )
+    """,
+    'CREATE INDEX core_product_search_document_idx ON core_product_search USING GIN (document)',
+    """
+    CREATE FUNCTION core_product_search_document(p_name text, p_description text, p_category_id bigint)
+    RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('english', COALESCE(p_name, '')), 'A')
+            || setweight(to_tsvector('english', COALESCE(
+                   (SELECT name FROM core_category WHERE id = p_category_id), '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(p_description, '')), 'C')
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE FUNCTION core_product_search_sync() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO core_product_search (product_id, document)
+        VALUES (NEW.id, core_product_search_document(NEW.name, NEW.description, NEW.category_id))
+        ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER core_product_search_sync
+    AFTER INSERT OR UPDATE OF name, description, category_id ON core_product
+    FOR EACH ROW EXECUTE FUNCTION core_product_search_sync()
+    """,
+    """
+    CREATE FUNCTION core_category_search_sync() RETURNS trigger AS $$
+    BEGIN
+        UPDATE core_product_search s
+        SET document = core_product_search_document(p.name, p.description, p.category_id)
+        FROM core_product p
+        WHERE p.id = s.product_id AND p.category_id = NEW.id;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER core_category_search_sync
+    AFTER UPDATE OF name ON core_category
+    FOR EACH ROW EXECUTE FUNCTION core_category_search_sync()
+    """,
+    """
+    INSERT INTO core_product_search (product_id, document)
+    SELECT id, core_product_search_document(name, description, category_id) FROM core_product
+    """,
+]
+
+POSTGRES_REVERSE = [
+    'DROP TRIGGER IF EXISTS core_category_search_sync ON core_category',
+    'DROP FUNCTION IF EXISTS core_category_search_sync()',
+    'DROP TRIGGER IF EXISTS core_product_search_sync ON core_product',
+    'DROP FUNCTION IF EXISTS core_product_search_sync()',
+    'DROP FUNCTION IF EXISTS core_product_search_document(text, text, bigint)',
+    'DROP TABLE IF EXISTS core_product_search',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement, params=None)
+
+
+def create_search_index(apps, schema_editor):
+    """Create the vendor-specific search index; other databases use the fallback"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            _run(schema_editor, SQLITE_FORWARD)
+        except OperationalError:
+            # SQLite compiled without FTS5: search falls back to icontains.
+            return
+        _run(schema_editor, SQLITE_TRIGGERS + SQLITE_POPULATE)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_FORWARD)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _run(schema_editor, SQLITE_REVERSE)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_advertisement'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
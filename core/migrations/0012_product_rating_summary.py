@@ -0,0 +1,131 @@
+# Generated by Django 4.2.7 on 2025-11-28 10:15
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+# SQLite rebuilds core_product to add a column, and the search triggers from
+# 0011 would block that: drop them first and put them back afterwards. The
+# index rows are keyed by product id and survive the rebuild.
+SQLITE_DROP_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS core_category_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_delete',
+    'DROP TRIGGER IF EXISTS core_product_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_insert',
+]
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER core_product_fts_insert AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_update
+    AFTER UPDATE OF name, description, category_id ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_delete AFTER DELETE ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER core_category_fts_update AFTER UPDATE OF name ON core_category BEGIN
+        UPDATE core_product_fts SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM core_product WHERE category_id = new.id);
+    END
+    """,
+]
+
+
+def _run_on_sqlite_index(schema_editor, statements):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    if 'core_product_fts' not in connection.introspection.table_names():
+        return
+    for statement in statements:
+        schema_editor.execute(statement, params=None)
+
+
+def drop_search_triggers(apps, schema_editor):
+    _run_on_sqlite_index(schema_editor, SQLITE_DROP_TRIGGERS)
+
+
+def reinstall_search_triggers(apps, schema_editor):
+    _run_on_sqlite_index(schema_editor, SQLITE_DROP_TRIGGERS + SQLITE_TRIGGERS)
+
+
+def populate_rating_summary(apps, schema_editor):
+    Product = apps.get_model('core', 'Product')
+    Review = apps.get_model('core', 'Review')
+
+    aggregates = {'review_count': Count('id'), 'rating_sum': Sum('rating')}
+    for stars in range(1, 6):
+        aggregates[f'rating_{stars}_count'] = Count('id', filter=Q(rating=stars))
+    rows = Review.objects.order_by().values('product_id').annotate(**aggregates)
+    for row in rows:
+        product_id = row.pop('product_id')
+        row['rating_sum'] = row['rating_sum'] or 0
+        row['rating_average'] = row['rating_sum'] / row['review_count'] if row['review_count'] else 0
+        Product.objects.filter(pk=product_id).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_product_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_search_triggers, reinstall_search_triggers),
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_average',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_rating_summary, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_search_triggers, drop_search_triggers),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 4.2.7 on 2025-11-29 15:20
+
+from django.db import migrations, models
+
+
+# SQLite rebuilds core_product to add a column, and the search triggers from
+# 0011 would block that: drop them first and put them back afterwards. The
+# index rows are keyed by product id and survive the rebuild.
+SQLITE_DROP_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS core_category_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_delete',
+    'DROP TRIGGER IF EXISTS core_product_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_insert',
+]
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER core_product_fts_insert AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_update
+    AFTER UPDATE OF name, description, category_id ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_delete AFTER DELETE ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER core_category_fts_update AFTER UPDATE OF name ON core_category BEGIN
+        UPDATE core_product_fts SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM core_product WHERE category_id = new.id);
+    END
+    """,
+]
+
+
+def _run_on_sqlite_index(schema_editor, statements):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    if 'core_product_fts' not in connection.introspection.table_names():
+        return
+    for statement in statements:
+        schema_editor.execute(statement, params=None)
+
+
+def drop_search_triggers(apps, schema_editor):
+    _run_on_sqlite_index(schema_editor, SQLITE_DROP_TRIGGERS)
+
+
+def reinstall_search_triggers(apps, schema_editor):
+    _run_on_sqlite_index(schema_editor, SQLITE_DROP_TRIGGERS + SQLITE_TRIGGERS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_product_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('reference_time', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='sales_ranked_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(drop_search_triggers, reinstall_search_triggers),
+        migrations.AddField(
+            model_name='product',
+            name='sales_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.RunPython(reinstall_search_triggers, drop_search_triggers),
+    ]
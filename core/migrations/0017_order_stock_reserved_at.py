@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2025-12-01 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stock_reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -30,22 +30,65 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products', null=True, blank=True)
     product_type = models.CharField(max_length=20, choices=PRODUCT_TYPES)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Resized WebP/JPEG renditions of `image`, written in the background (see core.images)
+    image_derivatives = models.JSONField(default=dict, blank=True)
     is_featured = models.BooleanField(default=False)
     is_bestseller = models.BooleanField(default=False)
     is_new = models.BooleanField(default=False)
     free_delivery = models.BooleanField(default=False)
     stock_quantity = models.PositiveIntegerField(default=0)
+    
+    # Rating summary, maintained incrementally from Review writes (see core.ratings)
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_average = models.FloatField(default=0, db_index=True)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+    
+    # Time-decayed units sold, maintained by the rank_sales command (see core.sales_ranking)
+    sales_score = models.FloatField(default=0, db_index=True)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    RATING_FIELDS = (
+        'review_count', 'rating_sum', 'rating_average',
+        'rating_1_count', 'rating_2_count', 'rating_3_count', 'rating_4_count', 'rating_5_count',
+    )
+    
+    # Columns updated only through atomic F() expressions; a full save() of a
+    # possibly stale instance must not overwrite them. Stock changes go
+    # through the stock ledger (see core.stock_ledger).
+    DERIVED_FIELDS = RATING_FIELDS + ('sales_score', 'image_derivatives', 'stock_quantity')
+    
     class Meta:
         ordering = ['-created_at']
     
     def __str__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DERIVED_FIELDS
+            ]
+        super().save(*args, **kwargs)
+    
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'slug': self.slug})
+    
+    def get_rating_histogram(self):
+        """[(stars, count, percent)] from 5 stars down to 1"""
+        histogram = []
+        for stars in range(5, 0, -1):
+            count = getattr(self, f'rating_{stars}_count')
+            percent = round(100 * count / self.review_count) if self.review_count else 0
+            histogram.append((stars, count, percent))
+        return histogram
 
 
 class Customer(models.Model):
@@ -55,6 +98,12 @@ class Customer(models.Model):
     city = models.CharField(max_length=100, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            # Keyset pagination of the admin customer list
+            models.Index(fields=['-created_at', '-id'], name='customer_created_id_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.user.get_full_name() or self.user.username}"
 
@@ -95,6 +144,14 @@ class Order(models.Model):
     delivery_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     total = models.DecimalField(max_digits=10, decimal_places=2)
     
+    # When this order's items were added to the products' sales scores; cleared
+    # again once a cancelled or returned order has been taken back out.
+    sales_ranked_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    # When this order's items were taken out of stock; cleared when a
+    # cancellation or return puts them back (see core.inventory).
+    stock_reserved_at = models.DateTimeField(null=True, blank=True)
+    
     # Tracking information
     tracking_number = models.CharField(max_length=50, blank=True)
     estimated_delivery = models.DateTimeField(null=True, blank=True)
@@ -104,8 +161,17 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Written only by the sales ranking job and core.inventory; a full save()
+    # of a possibly stale instance must not overwrite them.
+    DERIVED_FIELDS = ('sales_ranked_at', 'stock_reserved_at')
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of the admin order list, with and without a status filter
+            models.Index(fields=['-created_at', '-id'], name='order_created_id_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_id_idx'),
+        ]
     
     def __str__(self):
         return f"Order #{self.order_number}"
@@ -114,6 +180,11 @@ class Order(models.Model):
         if not self.order_number:
             import uuid
             self.order_number = str(uuid.uuid4())[:8].upper()
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DERIVED_FIELDS
+            ]
         super().save(*args, **kwargs)
 
 
@@ -146,6 +217,89 @@ class OrderItem(models.Model):
         return self.quantity * self.price
 
 
+class StockMovement(models.Model):
+    """One change to a product's stock; rows are only ever added (see core.stock_ledger)"""
+    RECEIPT = 'receipt'
+    SALE = 'sale'
+    RETURN = 'return'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [
+        (RECEIPT, 'Receipt'),
+        (SALE, 'Sale'),
+        (RETURN, 'Return'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+    
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_movements')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Signed: receipts and returns add stock, sales take it
+    quantity = models.IntegerField()
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    note = models.CharField(max_length=200, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # A product's movements after a snapshot, and ledger sums per product
+            models.Index(fields=['product', 'id'], name='stockmove_product_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.quantity:+d} {self.product_id}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Stock movements are append-only; record a new movement instead.')
+        super().save(*args, **kwargs)
+
+
+class StockSnapshot(models.Model):
+    """A product's stock after every movement up to movement_id"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_snapshots')
+    movement_id = models.BigIntegerField()
+    quantity = models.IntegerField()
+    # Latest created_at among the movements included, i.e. the moment the
+    # quantity describes
+    as_of = models.DateTimeField()
+    taken_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['product', 'movement_id']
+    
+    def __str__(self):
+        return f"{self.product_id}: {self.quantity} @ {self.as_of}"
+
+
+class RankingCheckpoint(models.Model):
+    """Where an incremental ranking job left off"""
+    name = models.CharField(max_length=50, unique=True)
+    reference_time = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} @ {self.reference_time}"
+
+
+class ProductRecommendation(models.Model):
+    """Precomputed "frequently bought together" neighbours of a product"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_by')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    co_purchases = models.PositiveIntegerField()
+    
+    class Meta:
+        ordering = ['product', 'rank']
+        unique_together = ['product', 'recommended']
+        indexes = [
+            models.Index(fields=['product', 'rank'], name='recommendation_rank_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.product} -> {self.recommended} ({self.score:.3f})"
+
+
 class Review(models.Model):
     RATING_CHOICES = [
         (1, '1 Star'),
@@ -310,11 +464,16 @@ class Cart(models.Model):
     def __str__(self):
         return f"Cart for {self.customer}"
     
+    def summary(self):
+        """Cached item count and subtotal (see core.cart_summary)"""
+        from .cart_summary import cart_summary
+        return cart_summary(self.pk)
+
     def get_total_price(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        return self.summary().subtotal
     
     def get_total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.summary().item_count
 
 
 class CartItem(models.Model):
@@ -325,6 +484,13 @@ class CartItem(models.Model):
     class Meta:
         unique_together = ['cart', 'product']
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets the badge counter move by the change when the item is saved (see signals)
+        instance._loaded_quantity = instance.__dict__.get('quantity')
+        return instance
+    
     def __str__(self):
         return f"{self.quantity}x {self.product.name}"
     
@@ -356,6 +522,7 @@ class Advertisement(models.Model):
     
     # For banners/posters
     image = models.ImageField(upload_to='advertisements/banners/', blank=True, null=True)
+    image_derivatives = models.JSONField(default=dict, blank=True)
     
     # Display settings
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='draft')
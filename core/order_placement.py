@@ -0,0 +1,134 @@
+"""
+Placing orders.
+
+place_order() is the one way an order gets written, for the cart checkout,
+Buy Now and anything else that sells. It runs in a single transaction:
+
+1. insert the order;
+2. lock the ordered products with SELECT ... FOR UPDATE, ordered by id, so
+   two orders sharing products always lock them in the same order and
+   cannot deadlock;
+3. take the stock with core.inventory.reserve() (one conditional UPDATE
+   and one ledger insert for all products);
+4. insert every item, priced from the locked rows, with one bulk_create,
+   fill in the order's totals and add the first tracking entry.
+
+Any failure rolls the whole order back. The number of queries does not
+depend on how many lines the order has. place_cart_order() does the same
+for a cart's lines, locking the cart first so a double-submitted checkout
+places one order, and empties the cart in the same transaction.
+
+OrderItem has no signal handlers, so bulk_create skips nothing. The cart
+lines are deleted with one statement by core.cart_operations.remove_lines(),
+which updates the cart summary and header badge once the order commits.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from . import cart_operations, inventory
+from .inventory import InsufficientStock
+from .models import Cart, CartItem, Order, OrderItem, OrderTracking, Product
+
+
+DELIVERY_FEE = Decimal('50.00')
+FARM_LOCATION = 'Golden Mais Farm, Calubian, Leyte'
+PLACED_MESSAGE = 'Order has been placed successfully. We will start preparing your fresh corn products.'
+
+
+class EmptyOrder(ValueError):
+    """There was nothing to order"""
+
+
+def delivery_fee(delivery_method):
+    return DELIVERY_FEE if delivery_method == 'delivery' else Decimal('0.00')
+
+
+def _lock_products(product_ids):
+    """The products, locked in id order, as {id: product}"""
+    products = (
+        Product.objects.select_for_update().filter(pk__in=product_ids)
+        .only('id', 'name', 'price', 'stock_quantity').order_by('id')
+    )
+    return {product.id: product for product in products}
+
+
+def place_order(customer, lines, delivery_method='pickup', delivery_address='', phone='', notes='',
+                message=PLACED_MESSAGE):
+    """
+    Place an order for (product_id, quantity) `lines` at the products' current prices.
+
+    Raises InsufficientStock (nothing is written) when any product is short
+    or gone, EmptyOrder when there are no lines and ValueError for a
+    quantity below one. Returns the order, with its OrderItems in
+    `order.placed_items`.
+    """
+    quantities = defaultdict(int)
+    for product_id, quantity in lines:
+        if quantity < 1:
+            raise ValueError(f'Quantity of product {product_id} must be positive, not {quantity}.')
+        quantities[product_id] += quantity
+    if not quantities:
+        raise EmptyOrder('Nothing to order.')
+    fee = delivery_fee(delivery_method)
+    with transaction.atomic():
+        # Written first: the totals need the locked prices, and on SQLite a
+        # transaction that reads before its first write can fail with "database
+        # is locked" instead of waiting its turn.
+        order = Order.objects.create(
+            customer=customer,
+            delivery_method=delivery_method,
+            delivery_address=delivery_address,
+            phone=phone,
+            notes=notes,
+            status='pending',
+            subtotal=0,
+            delivery_fee=fee,
+            total=fee,
+            stock_reserved_at=timezone.now(),
+        )
+        products = _lock_products(quantities)
+        missing = sorted(quantities.keys() - products.keys())
+        if missing:
+            raise InsufficientStock([
+                {'product_id': product_id, 'name': f'Product #{product_id}',
+                 'requested': quantities[product_id], 'available': 0}
+                for product_id in missing
+            ])
+        inventory.reserve(order, quantities.items())
+        items = [
+            OrderItem(order=order, product=products[product_id], quantity=quantity, price=products[product_id].price)
+            for product_id, quantity in sorted(quantities.items())
+        ]
+        OrderItem.objects.bulk_create(items)
+        order.subtotal = sum((item.price * item.quantity for item in items), Decimal('0.00'))
+        order.total = order.subtotal + fee
+        Order.objects.filter(pk=order.pk).update(subtotal=order.subtotal, total=order.total)
+        OrderTracking.objects.create(
+            order=order, status='pending', message=message, location=FARM_LOCATION, updated_by='System',
+        )
+    order.placed_items = items
+    return order
+
+
+def place_cart_order(customer, cart, **details):
+    """
+    Order everything in `customer`'s `cart` and empty it, in one transaction.
+
+    Takes the same keyword arguments as place_order(). Raises EmptyOrder
+    when the cart has nothing in it, e.g. because the same checkout was
+    already submitted.
+    """
+    with transaction.atomic():
+        # Locks the cart row, serializing checkouts of the same cart; being a
+        # write, it also takes SQLite's database lock up front (see place_order)
+        Cart.objects.filter(pk=cart.pk).update(updated_at=Now())
+        lines = list(CartItem.objects.filter(cart=cart).values_list('id', 'product_id', 'quantity'))
+        if not lines:
+            raise EmptyOrder('The cart is empty.')
+        order = place_order(customer, [(product_id, quantity) for _id, product_id, quantity in lines], **details)
+        cart_operations.remove_lines(cart.pk, [(line_id, quantity) for line_id, _product_id, quantity in lines])
+    return order
@@ -0,0 +1,252 @@
+"""
+Full-page cache for anonymous storefront pages.
+
+The storefront renders the same HTML for every anonymous visitor, and that HTML
+only changes when an admin edits the catalog, a review is written or an
+advertisement changes. Cached pages are tagged with what they depend on; each
+tag has a version in the cache, and a write bumps the version of the tags it
+affects, which retires every page built from the old version at once.
+Pages showing advertisements also expire at the next ad start/end boundary.
+
+The same tag versions answer conditional requests: a version records when its
+tag last changed, which gives pages and APIs an ETag and Last-Modified without
+touching the database, so revalidating clients get 304s.
+"""
+import hashlib
+import math
+import time
+import uuid
+from functools import wraps
+from urllib.parse import parse_qsl, urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Q
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 600)
+
+# Query parameters that never change what the page shows.
+IGNORED_PARAMS = {'fbclid', 'gclid'}
+
+KEY_PREFIX = 'page_cache'
+ADS_BOUNDARY_KEY = f'{KEY_PREFIX}:ads_boundary'
+
+# Invalidation tags
+CATALOG = 'catalog'
+REVIEWS = 'reviews'
+ADS = 'ads'
+
+
+def product_tag(slug):
+    return f'product:{slug}'
+
+
+def _version_key(tag):
+    return f'{KEY_PREFIX}:version:{tag}'
+
+
+def _new_version():
+    return f'{time.time():.3f}-{uuid.uuid4().hex}'
+
+
+def bump(*tags):
+    """Retire every cached page depending on any of `tags`"""
+    cache.set_many({_version_key(tag): _new_version() for tag in tags}, None)
+    if ADS in tags:
+        cache.delete(ADS_BOUNDARY_KEY)
+
+
+def _versions(version_keys, found):
+    missing = [key for key in version_keys if key not in found]
+    if missing:
+        # First use of a tag: give it a version so entries can match it
+        for key in missing:
+            cache.add(key, _new_version(), None)
+        found.update(cache.get_many(missing))
+    return [found.get(key) for key in version_keys]
+
+
+def tag_versions(tags):
+    """Current version of each tag; anything cached against them is stale once they change"""
+    version_keys = [_version_key(tag) for tag in tags]
+    return _versions(version_keys, cache.get_many(version_keys))
+
+
+def get_tagged(key, tags):
+    """
+    (value, versions): what set_tagged() stored under `key`, or None once any
+    of `tags` has changed since. The value and the tag versions are read in
+    one cache round trip.
+    """
+    version_keys = [_version_key(tag) for tag in tags]
+    found = cache.get_many([key] + version_keys)
+    versions = _versions(version_keys, found)
+    entry = found.get(key)
+    if entry is not None and entry['versions'] == versions:
+        return entry['value'], versions
+    return None, versions
+
+
+def set_tagged(key, value, versions, timeout=TIMEOUT):
+    cache.set(key, {'versions': versions, 'value': value}, timeout)
+
+
+def changed_at(versions):
+    """Unix time at which the newest of `versions` was created"""
+    stamps = []
+    for version in versions:
+        try:
+            stamps.append(float(version.split('-', 1)[0]))
+        except (AttributeError, ValueError):
+            # Unknown format: assume it changed just now
+            stamps.append(time.time())
+    return max(stamps, default=time.time())
+
+
+def normalized_query(request):
+    """The query string with tracking and empty parameters dropped, sorted"""
+    params = [
+        (name, value) for name, value in parse_qsl(request.META.get('QUERY_STRING', ''))
+        if value and name not in IGNORED_PARAMS and not name.startswith('utm_')
+    ]
+    return urlencode(sorted(params))
+
+
+def _page_key(request):
+    raw = f'{request.path}?{normalized_query(request)}'
+    return f'{KEY_PREFIX}:page:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def _is_cacheable_request(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    return not request.user.is_authenticated
+
+
+def _is_cacheable_response(response):
+    return (
+        response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        and not response.has_header('Cache-Control')
+    )
+
+
+def next_ad_boundary():
+    """Seconds until the next active ad starts or ends, or None"""
+    boundary = cache.get(ADS_BOUNDARY_KEY)
+    now = timezone.now()
+    if boundary and boundary <= now:
+        # An ad started or ended: that changes ad content like an edit does
+        bump(ADS)
+        boundary = None
+    if boundary is None:
+        from .models import Advertisement
+
+        upcoming = Advertisement.objects.filter(status='active').aggregate(
+            start=Min('start_date', filter=Q(start_date__gt=now)),
+            end=Min('end_date', filter=Q(end_date__gte=now)),
+        )
+        moments = [moment for moment in upcoming.values() if moment is not None]
+        # False marks "no boundary" so the empty answer is cached too
+        boundary = min(moments) if moments else False
+        cache.set(ADS_BOUNDARY_KEY, boundary, TIMEOUT)
+    if not boundary:
+        return None
+    # Ads stay visible through their end_date, so expire just after it
+    return max(1, math.ceil((boundary - now).total_seconds()) + 1)
+
+
+def cache_page_for_anonymous(tags):
+    """
+    Serve the view from the page cache for anonymous GET/HEAD requests.
+
+    `tags` is a list of tags, or a callable taking the view's kwargs and
+    returning them. A hit returns the stored response without running the
+    view, its templates or any context processor.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _is_cacheable_request(request):
+                return view(request, *args, **kwargs)
+
+            page_tags = tags(**kwargs) if callable(tags) else tags
+            page_key = _page_key(request)
+            version_keys = [_version_key(tag) for tag in page_tags]
+            found = cache.get_many([page_key] + version_keys)
+            versions = _versions(version_keys, found)
+
+            entry = found.get(page_key)
+            if entry is not None and entry['versions'] == versions:
+                content, status, headers = entry['response']
+                response = HttpResponse(content, status=status)
+                for name, value in headers:
+                    response[name] = value
+                response['X-Page-Cache'] = 'hit'
+                return response
+
+            response = view(request, *args, **kwargs)
+            if not _is_cacheable_response(response):
+                return response
+
+            timeout = TIMEOUT
+            if ADS in page_tags:
+                boundary = next_ad_boundary()
+                if boundary is not None:
+                    timeout = min(timeout, boundary)
+            headers = [(name, value) for name, value in response.items() if name != 'X-Page-Cache']
+            cache.set(page_key, {
+                'versions': versions,
+                'response': (response.content, response.status_code, headers),
+            }, timeout)
+            response['X-Page-Cache'] = 'miss'
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional_on_tags(tags, anonymous_only=True):
+    """
+    Answer If-None-Match / If-Modified-Since requests from tag versions.
+
+    The ETag is a digest of the tags' versions and Last-Modified is when the
+    newest of them changed, so a 304 is decided before the view runs any
+    query. Responses carry Cache-Control: no-cache, which makes browsers
+    revalidate instead of guessing how long the page stays fresh. With
+    `anonymous_only`, signed-in users (whose pages show their cart and
+    account) always get the full view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            if anonymous_only and (request.user.is_authenticated or 'messages' in request.COOKIES):
+                return view(request, *args, **kwargs)
+
+            page_tags = tags(**kwargs) if callable(tags) else tags
+            if ADS in page_tags:
+                next_ad_boundary()
+            versions = tag_versions(page_tags)
+            etag = quote_etag(hashlib.md5(':'.join(versions).encode()).hexdigest())
+            last_modified = int(changed_at(versions))
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            if not response.has_header('ETag'):
+                response['ETag'] = etag
+            if not response.has_header('Last-Modified'):
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,177 @@
+"""
+Keyset (cursor) pagination.
+
+Paginator pages with COUNT(*) plus OFFSET, and both get slower the deeper the
+page. Keyset pagination instead remembers the sort key of the last row shown
+and asks for rows "after" it, which an index on the sort columns answers at
+the same cost for every page. Totals are optional and may be estimated from
+the query planner instead of counted.
+"""
+import base64
+import binascii
+import json
+
+from django.db import connections
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    """One page of results plus the cursors for its neighbours"""
+
+    def __init__(self, object_list, next_cursor, previous_cursor, total=None, total_is_estimate=False):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Page a queryset on a unique, indexed ordering such as ('-created_at', '-id').
+
+    The last ordering field must be unique (normally the primary key) so every
+    row has a distinct position. Cursors are opaque URL-safe strings holding
+    the boundary row's sort key and the paging direction.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-created_at', '-id')):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self._fields = [
+            (name.lstrip('-'), name.startswith('-')) for name in self.ordering
+        ]
+
+    # ------------------------------------------------------------------
+    # Cursors
+    # ------------------------------------------------------------------
+
+    def _key(self, obj):
+        return [getattr(obj, field) for field, _descending in self._fields]
+
+    def _encode(self, obj, direction):
+        values = []
+        for value in self._key(obj):
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        payload = json.dumps({'d': direction, 'k': values}, separators=(',', ':'), default=str)
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def _decode(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            direction, values = payload['d'], payload['k']
+        except (binascii.Error, ValueError, KeyError, TypeError):
+            raise InvalidCursor(cursor)
+        if direction not in ('next', 'prev') or len(values) != len(self._fields):
+            raise InvalidCursor(cursor)
+        model = self.queryset.model
+        key = []
+        for (field, _descending), value in zip(self._fields, values):
+            try:
+                key.append(model._meta.get_field(field).to_python(value))
+            except Exception:
+                raise InvalidCursor(cursor)
+        return direction, key
+
+    def _after(self, key, reverse=False):
+        """Q matching rows strictly after `key` in the ordering (or before it)"""
+        # (a, b) after (x, y) means: a after x, or a = x and b after y
+        condition = None
+        equal = Q()
+        for (field, descending), value in zip(self._fields, key):
+            lookup = 'lt' if descending != reverse else 'gt'
+            branch = equal & Q(**{f'{field}__{lookup}': value})
+            condition = branch if condition is None else condition | branch
+            equal &= Q(**{field: value})
+        return condition
+
+    # ------------------------------------------------------------------
+    # Paging
+    # ------------------------------------------------------------------
+
+    def get_page(self, cursor=None, total='none'):
+        """
+        Return the page addressed by `cursor` (the first page when empty or invalid).
+
+        `total` is 'none', 'exact' (COUNT query) or 'estimate' (planner estimate
+        where the database offers one, exact otherwise).
+        """
+        direction, key = 'next', None
+        if cursor:
+            try:
+                direction, key = self._decode(cursor)
+            except InvalidCursor:
+                pass
+
+        queryset = self.queryset
+        backwards = direction == 'prev' and key is not None
+        if key is not None:
+            queryset = queryset.filter(self._after(key, reverse=backwards))
+        if backwards:
+            ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in self.ordering]
+        else:
+            ordering = list(self.ordering)
+
+        # One extra row tells whether another page exists in this direction
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if more or backwards:
+                next_cursor = self._encode(rows[-1], 'next')
+            if key is not None and (more or not backwards):
+                previous_cursor = self._encode(rows[0], 'prev')
+
+        count, estimated = None, False
+        if total == 'exact':
+            count = self.queryset.count()
+        elif total == 'estimate':
+            count, estimated = estimate_count(self.queryset)
+        return KeysetPage(rows, next_cursor, previous_cursor, count, estimated)
+
+
+def estimate_count(queryset):
+    """
+    (rows, is_estimate) for a queryset.
+
+    PostgreSQL reports the planner's row estimate from EXPLAIN, which costs no
+    table scan; other databases fall back to an exact COUNT.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), True
+    return queryset.count(), False
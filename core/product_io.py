@@ -0,0 +1,359 @@
+"""
+Bulk product import and export as CSV or JSON Lines.
+
+Imports stream the file and work in batches. Each batch is validated, looks
+up existing and taken slugs with one query, and is written with one
+bulk_create(update_conflicts=True) upsert keyed on slug: rows with a known
+slug update that product, the rest become new products. Only the columns
+present in the file are updated, so a slug,price file is a price list.
+Stock levels are only imported when asked for (stock=True), since an
+exported file is stale as soon as something sells; a blank stock_quantity
+cell leaves that product's stock alone. They are not upserted: each batch
+records the difference as stock ledger adjustments (see core.stock_ledger).
+
+Exports stream products with .iterator(). Bulk writes skip model signals, so
+the in-process indexes and the page cache are refreshed once at the end.
+"""
+import csv
+import json
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import transaction
+from django.db.models import Q
+from django.utils.text import slugify
+
+from . import page_cache, stock_ledger
+from .autocomplete import autocomplete_index
+from .catalog_index import catalog_index
+from .fuzzy_search import fuzzy_index
+from .images import needs_derivatives, schedule_derivatives
+from .models import Category, Product
+
+
+FORMATS = ('csv', 'jsonl')
+
+COLUMNS = (
+    'slug', 'name', 'description', 'price', 'product_type', 'category', 'stock_quantity',
+    'is_featured', 'is_bestseller', 'is_new', 'free_delivery', 'image',
+)
+BOOLEAN_COLUMNS = ('is_featured', 'is_bestseller', 'is_new', 'free_delivery')
+# A row that creates a product (rather than updating one) needs these
+REQUIRED_FOR_NEW = ('name', 'price', 'product_type')
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'off', ''}
+
+MAX_PRICE = Decimal('99999999.99')
+
+# Clashing names looked up per query (SQLite caps the depth of OR chains)
+SUFFIX_LOOKUP_BATCH = 200
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    @property
+    def written(self):
+        return self.created + self.updated
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+
+def detect_format(filename, default='csv'):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(lines, file_format):
+    """Yield (line number, row dict or None, error message or None)"""
+    if file_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            row.pop(None, None)
+            yield reader.line_num, row, None
+        return
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, f'invalid JSON: {error}'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'expected a JSON object'
+            continue
+        yield number, row, None
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+def _boolean(column, value):
+    if isinstance(value, bool):
+        return value
+    text = _text(value).lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise RowError(f'{column}: expected true/false, got {value!r}')
+
+
+def clean_row(row, categories, stock=False):
+    """
+    Model field values for the known columns of `row`; raises RowError.
+
+    stock_quantity is ignored unless `stock` is true.
+    """
+    row = {_text(key).lower(): value for key, value in row.items()}
+    values = {}
+    for column in COLUMNS:
+        if column not in row or (column == 'stock_quantity' and not stock):
+            continue
+        value = row[column]
+        if column in BOOLEAN_COLUMNS:
+            values[column] = _boolean(column, value)
+        elif column == 'price':
+            try:
+                price = Decimal(_text(value))
+            except InvalidOperation:
+                raise RowError(f'price: {value!r} is not a number')
+            if not price.is_finite() or price < 0 or price > MAX_PRICE or price != price.quantize(Decimal('0.01')):
+                raise RowError(f'price: {value!r} must be between 0 and {MAX_PRICE} with at most 2 decimals')
+            values['price'] = price
+        elif column == 'stock_quantity':
+            if not _text(value):
+                continue
+            try:
+                quantity = int(_text(value))
+            except ValueError:
+                raise RowError(f'stock_quantity: {value!r} is not a whole number')
+            if quantity < 0:
+                raise RowError('stock_quantity: must not be negative')
+            values['stock_quantity'] = quantity
+        elif column == 'product_type':
+            product_type = _text(value)
+            if product_type not in dict(Product.PRODUCT_TYPES):
+                raise RowError(f'product_type: unknown type {product_type!r}')
+            values['product_type'] = product_type
+        elif column == 'category':
+            slug = _text(value)
+            if slug and slug not in categories:
+                raise RowError(f'category: no category with slug {slug!r}')
+            values['category_id'] = categories.get(slug)
+        elif column == 'slug':
+            slug = _text(value)
+            if slug:
+                try:
+                    validate_slug(slug)
+                except ValidationError:
+                    raise RowError(f'slug: {slug!r} is not a valid slug')
+                values['slug'] = slug
+        elif column == 'name':
+            name = _text(value)
+            if not name:
+                raise RowError('name: must not be empty')
+            if len(name) > Product._meta.get_field('name').max_length:
+                raise RowError('name: too long')
+            values['name'] = name
+        else:
+            values[column] = _text(value)
+    return values
+
+
+def _slug_base(name):
+    return slugify(name)[:45] or 'product'
+
+
+def _taken_slugs(slugs=(), bases=()):
+    """
+    Which of `slugs`, `bases` and the -N variants of `bases` exist.
+
+    One indexed IN query; names that clash with an existing slug (rare in a
+    price list) cost one more range query per SUFFIX_LOOKUP_BATCH names.
+    """
+    taken = set(Product.objects.filter(slug__in=set(slugs) | set(bases)).values_list('slug', flat=True))
+    clashes = sorted(taken.intersection(bases))
+    for start in range(0, len(clashes), SUFFIX_LOOKUP_BATCH):
+        # "base-" <= slug < "base." covers every "base-N" and uses the slug index
+        condition = reduce(or_, [
+            Q(slug__gt=f'{base}-', slug__lt=f'{base}.') for base in clashes[start:start + SUFFIX_LOOKUP_BATCH]
+        ])
+        taken.update(Product.objects.filter(condition).values_list('slug', flat=True))
+    return taken
+
+
+def _allocate(bases, taken):
+    slugs = []
+    for base in bases:
+        slug, counter = base, 1
+        while slug in taken:
+            slug = f'{base}-{counter}'
+            counter += 1
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+def unique_slugs(names):
+    """
+    A free slug for each name, looking up the taken ones with one query.
+
+    Clashes get -1, -2, ... suffixes, as admin_product_add always did.
+    """
+    bases = [_slug_base(name) for name in names]
+    return _allocate(bases, _taken_slugs(bases=bases))
+
+
+def _write_batch(batch, result):
+    # A slug listed twice in one batch: the later row wins
+    keyed, creatable = {}, []
+    for number, values in batch:
+        if 'slug' in values:
+            keyed[values['slug']] = (number, values)
+            continue
+        missing = [column for column in REQUIRED_FOR_NEW if column not in values]
+        if missing:
+            result.add_error(number, f'rows without a slug create products and need {", ".join(missing)}')
+        else:
+            creatable.append((number, values))
+
+    bases = [_slug_base(values['name']) for _number, values in creatable]
+    taken = _taken_slugs(keyed, bases)
+    existing = taken & keyed.keys()
+    rows = []
+    for slug, (number, values) in keyed.items():
+        missing = [column for column in REQUIRED_FOR_NEW if column not in values]
+        if slug not in existing and missing:
+            result.add_error(number, f'new product {slug!r} needs {", ".join(missing)}')
+            continue
+        rows.append((number, values))
+    for (number, values), slug in zip(creatable, _allocate(bases, taken | keyed.keys())):
+        rows.append((number, dict(values, slug=slug)))
+
+    # Stock goes through the ledger, after the products exist
+    levels = {values['slug']: values.pop('stock_quantity') for _number, values in rows if 'stock_quantity' in values}
+
+    # One upsert per distinct set of columns, so absent columns keep their values
+    groups = defaultdict(list)
+    for number, values in rows:
+        groups[tuple(sorted(values))].append(values)
+    for fields, group in groups.items():
+        # Only a stock level (existing products only; new ones need a name and price)
+        if fields != ('slug',):
+            update_fields = [field for field in fields if field != 'slug'] + ['updated_at']
+            Product.objects.bulk_create(
+                [Product(**values) for values in group],
+                update_conflicts=True, unique_fields=['slug'], update_fields=update_fields,
+            )
+        for values in group:
+            if values['slug'] in existing:
+                result.updated += 1
+            else:
+                result.created += 1
+    if levels:
+        ids = dict(Product.objects.filter(slug__in=levels).values_list('slug', 'id'))
+        stock_ledger.set_stock({ids[slug]: quantity for slug, quantity in levels.items()}, note='Product import')
+    return [values['slug'] for _number, values in rows if values.get('image')]
+
+
+def refresh_after_bulk_write():
+    """What the Product signals would have done for each row"""
+    catalog_index.invalidate()
+    fuzzy_index.invalidate()
+    autocomplete_index.invalidate()
+    page_cache.bump(page_cache.CATALOG)
+
+
+def import_products(lines, file_format='csv', batch_size=1000, dry_run=False, stock=False):
+    """
+    Upsert products from an iterable of text lines; returns an ImportResult.
+
+    Stock levels in the file are set only when `stock` is true.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f'Unknown format {file_format!r}; expected one of {", ".join(FORMATS)}')
+    result = ImportResult()
+    categories = dict(Category.objects.values_list('slug', 'id'))
+    image_slugs = []
+    with transaction.atomic():
+        batch = []
+        for number, row, error in read_rows(lines, file_format):
+            if error is None:
+                try:
+                    batch.append((number, clean_row(row, categories, stock)))
+                except RowError as row_error:
+                    error = str(row_error)
+            if error is not None:
+                result.add_error(number, error)
+            if len(batch) >= batch_size:
+                image_slugs += _write_batch(batch, result)
+                batch = []
+        if batch:
+            image_slugs += _write_batch(batch, result)
+
+        if dry_run:
+            transaction.set_rollback(True)
+        elif result.written:
+            transaction.on_commit(refresh_after_bulk_write)
+
+    if image_slugs and not dry_run:
+        for start in range(0, len(image_slugs), batch_size):
+            products = Product.objects.filter(slug__in=image_slugs[start:start + batch_size])
+            for product in products.only('id', 'image', 'image_derivatives'):
+                if needs_derivatives(product):
+                    schedule_derivatives(Product, product.pk)
+    return result
+
+
+class _Echo:
+    """File-like object whose write() returns the line, for streaming csv.writer output"""
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset=None, chunk_size=2000):
+    """Yield one dict per product with the import columns"""
+    queryset = Product.objects.all() if queryset is None else queryset
+    fields = [column for column in COLUMNS if column != 'category'] + ['category__slug']
+    for values in queryset.order_by('id').values(*fields).iterator(chunk_size=chunk_size):
+        values['category'] = values.pop('category__slug') or ''
+        values['price'] = str(values['price'])
+        values['image'] = values['image'] or ''
+        yield {column: values[column] for column in COLUMNS}
+
+
+def export_lines(file_format='csv', queryset=None):
+    """Yield the export file line by line"""
+    if file_format not in FORMATS:
+        raise ValueError(f'Unknown format {file_format!r}; expected one of {", ".join(FORMATS)}')
+    if file_format == 'jsonl':
+        for row in export_rows(queryset):
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        return
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for row in export_rows(queryset):
+        yield writer.writerow([
+            ('true' if row[column] else 'false') if column in BOOLEAN_COLUMNS else row[column]
+            for column in COLUMNS
+        ])
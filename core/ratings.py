@@ -0,0 +1,61 @@
+"""
+Maintenance of the denormalized rating summary stored on Product.
+
+Every Review write is turned into a single UPDATE with F() expressions, so
+concurrent reviews never lose increments and product pages read the summary
+without aggregating reviews.
+"""
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from .models import Product, Review
+
+
+RATING_VALUES = (1, 2, 3, 4, 5)
+
+
+def apply_rating_change(product_id, rating, delta):
+    """Add (delta=1) or remove (delta=-1) one rating from a product's summary"""
+    if rating not in RATING_VALUES:
+        return
+    count = F('review_count') + delta
+    total = F('rating_sum') + rating * delta
+    # All right-hand sides see the row's values from before this UPDATE
+    Product.objects.filter(pk=product_id).update(
+        review_count=count,
+        rating_sum=total,
+        rating_average=Coalesce(Cast(total, FloatField()) / NullIf(count, 0), 0.0),
+        **{f'rating_{rating}_count': F(f'rating_{rating}_count') + delta},
+    )
+
+
+def rebuild_product_ratings(batch_size=500):
+    """Recompute every product's rating summary from the reviews table"""
+    aggregates = {
+        'review_count': Count('id'),
+        'rating_sum': Sum('rating'),
+    }
+    for stars in RATING_VALUES:
+        aggregates[f'rating_{stars}_count'] = Count('id', filter=Q(rating=stars))
+
+    stats = {
+        row.pop('product_id'): row
+        for row in Review.objects.order_by().values('product_id').annotate(**aggregates)
+    }
+
+    updated = []
+    with transaction.atomic():
+        Product.objects.update(
+            review_count=0, rating_sum=0, rating_average=0,
+            **{f'rating_{stars}_count': 0 for stars in RATING_VALUES},
+        )
+        products = Product.objects.filter(pk__in=stats.keys()).only('id')
+        for product in products.iterator(chunk_size=batch_size):
+            row = stats[product.id]
+            for field, value in row.items():
+                setattr(product, field, value or 0)
+            product.rating_average = product.rating_sum / product.review_count if product.review_count else 0
+            updated.append(product)
+        Product.objects.bulk_update(updated, Product.RATING_FIELDS, batch_size=batch_size)
+    return len(updated)
@@ -0,0 +1,133 @@
+"""
+"Frequently bought together" recommendations mined from order history.
+
+Order lines are streamed in order_id order and grouped into baskets, so only
+one basket is held at a time. Each basket adds one to the co-occurrence count
+of every product pair in it; together with per-product basket counts this is
+the sparse item-item co-occurrence matrix, stored as a dict of pair counts.
+Pairs are then scored (cosine or lift) and the top K neighbours of every
+product are written to ProductRecommendation, which product pages read with
+one indexed query.
+"""
+import heapq
+import math
+from collections import Counter
+from itertools import combinations
+from operator import itemgetter
+
+from django.db import transaction
+
+from .models import OrderItem, Product, ProductRecommendation
+
+
+METRICS = ('cosine', 'lift')
+
+# Orders in these states never completed, so they say little about taste.
+EXCLUDED_STATUSES = ('cancelled',)
+
+
+def iter_baskets(chunk_size=5000):
+    """Yield the set of product ids in each order, streaming order lines"""
+    rows = (
+        OrderItem.objects.exclude(order__status__in=EXCLUDED_STATUSES)
+        .order_by('order_id').values_list('order_id', 'product_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    current, basket = None, set()
+    for order_id, product_id in rows:
+        if order_id != current:
+            if basket:
+                yield basket
+            current, basket = order_id, set()
+        basket.add(product_id)
+    if basket:
+        yield basket
+
+
+def count_co_purchases(baskets, max_basket=50, max_pairs=2000000):
+    """
+    Count baskets per product and per unordered product pair.
+
+    Baskets larger than `max_basket` (bulk/wholesale orders) are skipped for
+    pairs, since they add quadratically many weak links. If the pair table
+    grows past `max_pairs`, it is cut to the `max_pairs // 2` most frequent
+    pairs so far. That keeps memory bounded, and since the next cut is at
+    least `max_pairs // 2` new pairs away, costs amortized O(1) per pair; the
+    price is undercounting pairs that were rare when a cut happened.
+    """
+    item_counts = Counter()
+    pair_counts = Counter()
+    total = 0
+    for basket in baskets:
+        total += 1
+        item_counts.update(basket)
+        if len(basket) < 2 or len(basket) > max_basket:
+            continue
+        pair_counts.update(combinations(sorted(basket), 2))
+        if max_pairs and len(pair_counts) > max_pairs:
+            pair_counts = Counter(dict(heapq.nlargest(max_pairs // 2, pair_counts.items(), key=itemgetter(1))))
+    return total, item_counts, pair_counts
+
+
+def score_pairs(total, item_counts, pair_counts, metric='cosine', min_support=2):
+    """Yield (product_id, other_id, score, co_purchases) in both directions"""
+    for (a, b), together in pair_counts.items():
+        if together < min_support:
+            continue
+        if metric == 'lift':
+            score = together * total / (item_counts[a] * item_counts[b])
+        else:
+            score = together / math.sqrt(item_counts[a] * item_counts[b])
+        yield a, b, score, together
+        yield b, a, score, together
+
+
+def top_neighbours(scored, top_k=8):
+    """{product_id: [(score, co_purchases, other_id)]} best first"""
+    heaps = {}
+    for product_id, other_id, score, together in scored:
+        heap = heaps.setdefault(product_id, [])
+        # Ties go to the pair bought together more often, then the lower id
+        item = (score, together, -other_id)
+        if len(heap) < top_k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return {
+        product_id: [(score, together, -negated) for score, together, negated in sorted(heap, reverse=True)]
+        for product_id, heap in heaps.items()
+    }
+
+
+def rebuild_recommendations(top_k=8, metric='cosine', min_support=2, chunk_size=5000,
+                            max_basket=50, max_pairs=2000000, batch_size=1000):
+    """Recompute and replace every product's recommendations; returns (orders, rows)"""
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric {metric!r}; expected one of {", ".join(METRICS)}')
+    total, item_counts, pair_counts = count_co_purchases(
+        iter_baskets(chunk_size), max_basket=max_basket, max_pairs=max_pairs,
+    )
+    neighbours = top_neighbours(
+        score_pairs(total, item_counts, pair_counts, metric=metric, min_support=min_support),
+        top_k=top_k,
+    )
+    rows = [
+        ProductRecommendation(
+            product_id=product_id, recommended_id=other_id,
+            rank=rank, score=score, co_purchases=together,
+        )
+        for product_id, ranked in neighbours.items()
+        for rank, (score, together, other_id) in enumerate(ranked, start=1)
+    ]
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(rows, batch_size=batch_size)
+    return total, len(rows)
+
+
+def recommended_products(product, limit=4):
+    """The product's precomputed neighbours, best first"""
+    return list(
+        Product.objects.filter(recommended_by__product=product)
+        .order_by('recommended_by__rank')[:limit]
+    )
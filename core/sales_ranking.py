@@ -0,0 +1,123 @@
+"""
+Time-decayed sales scores ("trending" / bestsellers).
+
+A product's score is the units it sold, each weighted by 2 ** (-age / half
+life), so last week's sales count for more than last season's. Scores are
+kept relative to a reference time stored in a RankingCheckpoint. Moving that
+reference forward multiplies every score by the same decay factor, which
+preserves the ranking. Each run therefore:
+
+1. decays all scores to "now" with one UPDATE,
+2. adds the orders not yet counted (Order.sales_ranked_at is NULL),
+3. takes back out counted orders that have since been cancelled or returned.
+
+Only orders that changed since the last run are read, so the cost does not
+grow with the size of the order history.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.utils import timezone
+
+from .models import Order, OrderItem, Product, RankingCheckpoint
+
+
+CHECKPOINT_NAME = 'sales_score'
+DEFAULT_HALF_LIFE_DAYS = 14
+
+# Orders in these states do not count as sales.
+EXCLUDED_STATUSES = ('cancelled', 'returned')
+
+# Products updated per UPDATE statement (keeps the CASE and parameters small)
+UPDATE_BATCH_SIZE = 200
+
+
+def decay_factor(elapsed_seconds, half_life_days):
+    return 2.0 ** (-elapsed_seconds / (half_life_days * 86400.0))
+
+
+def _order_weights(orders, reference_time, half_life_days):
+    return {
+        order_id: decay_factor((reference_time - created_at).total_seconds(), half_life_days)
+        for order_id, created_at in orders
+    }
+
+
+def _apply_orders(orders, reference_time, half_life_days, sign):
+    """Add (sign=1) or remove (sign=-1) the decayed units of `orders` [(id, created_at)]"""
+    weights = _order_weights(orders, reference_time, half_life_days)
+    deltas = defaultdict(float)
+    items = OrderItem.objects.filter(order_id__in=weights).values_list('order_id', 'product_id', 'quantity')
+    for order_id, product_id, quantity in items:
+        deltas[product_id] += sign * quantity * weights[order_id]
+    deltas = list(deltas.items())
+    for start in range(0, len(deltas), UPDATE_BATCH_SIZE):
+        batch = deltas[start:start + UPDATE_BATCH_SIZE]
+        Product.objects.filter(pk__in=[product_id for product_id, _delta in batch]).update(
+            sales_score=F('sales_score') + Case(
+                *[When(pk=product_id, then=Value(delta)) for product_id, delta in batch],
+                default=Value(0.0), output_field=FloatField(),
+            )
+        )
+    return len(weights)
+
+
+def _chunks(queryset, chunk_size):
+    """(id, created_at) batches; each batch is marked before the next is read"""
+    while True:
+        batch = list(queryset.order_by('id').values_list('id', 'created_at')[:chunk_size])
+        if not batch:
+            return
+        yield batch
+
+
+def rank_sales(half_life_days=DEFAULT_HALF_LIFE_DAYS, full=False, chunk_size=1000, now=None):
+    """
+    Bring every product's sales_score up to date.
+
+    Returns (orders_added, orders_removed). With `full`, all scores and order
+    markers are reset first and the whole history is recounted.
+    """
+    now = now or timezone.now()
+    added = removed = 0
+    with transaction.atomic():
+        checkpoint, created = RankingCheckpoint.objects.select_for_update().get_or_create(
+            name=CHECKPOINT_NAME, defaults={'reference_time': now},
+        )
+        if full:
+            Product.objects.update(sales_score=0)
+            Order.objects.filter(sales_ranked_at__isnull=False).update(sales_ranked_at=None)
+        elif not created and now > checkpoint.reference_time:
+            elapsed = (now - checkpoint.reference_time).total_seconds()
+            Product.objects.filter(sales_score__gt=0).update(
+                sales_score=F('sales_score') * decay_factor(elapsed, half_life_days)
+            )
+
+        pending = Order.objects.filter(sales_ranked_at__isnull=True).exclude(status__in=EXCLUDED_STATUSES)
+        for batch in _chunks(pending, chunk_size):
+            added += _apply_orders(batch, now, half_life_days, 1)
+            Order.objects.filter(pk__in=[order_id for order_id, _created in batch]).update(sales_ranked_at=now)
+
+        withdrawn = Order.objects.filter(sales_ranked_at__isnull=False, status__in=EXCLUDED_STATUSES)
+        for batch in _chunks(withdrawn, chunk_size):
+            removed += _apply_orders(batch, now, half_life_days, -1)
+            Order.objects.filter(pk__in=[order_id for order_id, _created in batch]).update(sales_ranked_at=None)
+
+        # Floating point leftovers from removals should not outrank real sales
+        Product.objects.filter(sales_score__lt=1e-9).exclude(sales_score=0).update(sales_score=0)
+
+        checkpoint.reference_time = now
+        checkpoint.save()
+    return added, removed
+
+
+def top_sellers(queryset=None, limit=3):
+    """
+    Products ordered by sales score; the manual bestseller flag breaks ties.
+
+    Without a queryset, only products that sold or are flagged as bestsellers.
+    """
+    if queryset is None:
+        queryset = Product.objects.filter(Q(sales_score__gt=0) | Q(is_bestseller=True))
+    return queryset.order_by('-sales_score', '-is_bestseller', '-created_at')[:limit]
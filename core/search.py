@@ -0,0 +1,325 @@
+"""
+Ranked full-text product search.
+
+Products are indexed by name, description and category name in a side table
+that database triggers keep in sync with every Product and Category write
+(see migration 0011):
+
+* SQLite: an FTS5 virtual table, ranked with bm25() and highlighted with
+  snippet().
+* PostgreSQL: a weighted tsvector column with a GIN index, ranked with
+  ts_rank_cd() and highlighted with ts_headline().
+
+Any other backend, or a SQLite build without FTS5, falls back to the old
+icontains filters so search keeps working, just unranked.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.text import Truncator
+
+
+SQLITE_TABLE = 'core_product_fts'
+POSTGRES_TABLE = 'core_product_search'
+
+# Private-use characters mark highlights in raw snippets; they are swapped for
+# <mark> tags only after the text has been HTML-escaped.
+_HIGHLIGHT_START = '\ue000'
+_HIGHLIGHT_END = '\ue001'
+
+# SQLite rebuilds a table (dropping its triggers) for many ALTER operations, and
+# refuses to rename core_product while core_category's trigger refers to it. So
+# migrations that alter core_product or core_category drop these triggers first
+# and recreate them afterwards, each with its own copy of the SQL (see 0012).
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER core_product_fts_insert AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_update
+    AFTER UPDATE OF name, description, category_id ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+        INSERT INTO core_product_fts (rowid, name, description, category_name)
+        VALUES (new.id, new.name, new.description,
+                COALESCE((SELECT name FROM core_category WHERE id = new.category_id), ''));
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_delete AFTER DELETE ON core_product BEGIN
+        DELETE FROM core_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER core_category_fts_update AFTER UPDATE OF name ON core_category BEGIN
+        UPDATE core_product_fts SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM core_product WHERE category_id = new.id);
+    END
+    """,
+]
+
+SQLITE_DROP_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS core_category_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_delete',
+    'DROP TRIGGER IF EXISTS core_product_fts_update',
+    'DROP TRIGGER IF EXISTS core_product_fts_insert',
+]
+
+SQLITE_REPOPULATE = [
+    f'DELETE FROM {SQLITE_TABLE}',
+    f"""
+    INSERT INTO {SQLITE_TABLE} (rowid, name, description, category_name)
+    SELECT p.id, p.name, p.description, COALESCE(c.name, '')
+    FROM core_product p LEFT JOIN core_category c ON c.id = p.category_id
+    """,
+]
+
+POSTGRES_REPOPULATE = [
+    f"""
+    INSERT INTO {POSTGRES_TABLE} (product_id, document)
+    SELECT id, core_product_search_document(name, description, category_id) FROM core_product
+    ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document
+    """,
+]
+
+MAX_QUERY_TERMS = 8
+SNIPPET_WORDS = 16
+# The listing filters and counts search matches in the catalog index, so only
+# the best MAX_MATCHES ids of a broad query are handed to it.
+MAX_MATCHES = 1000
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase word tokens of a piece of text"""
+    return _TERM_RE.findall((text or '').lower())
+
+
+def query_terms(query):
+    """Split free text into at most MAX_QUERY_TERMS lowercase word tokens"""
+    return tokenize(query)[:MAX_QUERY_TERMS]
+
+
+def render_snippet(raw):
+    """HTML-escape a raw snippet and turn the highlight markers into <mark>"""
+    text = escape(raw or '')
+    text = text.replace(_HIGHLIGHT_START, '<mark>').replace(_HIGHLIGHT_END, '</mark>')
+    return mark_safe(text)
+
+
+class _SQLiteBackend:
+    def match_expression(self, terms):
+        # Every term must match; each is quoted (so FTS5 syntax is inert) and
+        # prefix-matched so partially typed words still hit.
+        return ' '.join('"%s"*' % term for term in terms)
+
+    def count(self, cursor, terms):
+        cursor.execute(
+            f'SELECT COUNT(*) FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s',
+            [self.match_expression(terms)],
+        )
+        return cursor.fetchone()[0]
+
+    def ranked(self, cursor, terms, limit=None, offset=0, snippets=True):
+        # bm25() weights: name, description, category name. Lower is better.
+        snippet_sql = (
+            f"snippet({SQLITE_TABLE}, 1, %s, %s, '…', {SNIPPET_WORDS})" if snippets else "''"
+        )
+        sql = (
+            f'SELECT rowid, bm25({SQLITE_TABLE}, 10.0, 1.0, 4.0) AS rank, {snippet_sql} '
+            f'FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s ORDER BY rank, rowid'
+        )
+        params = [_HIGHLIGHT_START, _HIGHLIGHT_END] if snippets else []
+        params.append(self.match_expression(terms))
+        if limit is not None:
+            sql += ' LIMIT %s OFFSET %s'
+            params += [limit, offset]
+        cursor.execute(sql, params)
+        return [(row[0], -row[1], row[2]) for row in cursor.fetchall()]
+
+
+class _PostgresBackend:
+    def tsquery(self, terms):
+        return ' & '.join('%s:*' % term for term in terms)
+
+    def count(self, cursor, terms):
+        cursor.execute(
+            f"SELECT COUNT(*) FROM {POSTGRES_TABLE} "
+            f"WHERE document @@ to_tsquery('english', %s)",
+            [self.tsquery(terms)],
+        )
+        return cursor.fetchone()[0]
+
+    def ranked(self, cursor, terms, limit=None, offset=0, snippets=True):
+        snippet_sql = (
+            "ts_headline('english', p.description, q, %s)" if snippets else "''"
+        )
+        sql = (
+            f"SELECT s.product_id, ts_rank_cd(s.document, q, 32) AS rank, {snippet_sql} "
+            f"FROM {POSTGRES_TABLE} s "
+            f"JOIN core_product p ON p.id = s.product_id, "
+            f"to_tsquery('english', %s) q "
+            f"WHERE s.document @@ q ORDER BY rank DESC, s.product_id"
+        )
+        params = []
+        if snippets:
+            params.append(
+                f'StartSel={_HIGHLIGHT_START}, StopSel={_HIGHLIGHT_END}, '
+                f'MaxWords={SNIPPET_WORDS}, MinWords=6, ShortWord=2'
+            )
+        params.append(self.tsquery(terms))
+        if limit is not None:
+            sql += ' LIMIT %s OFFSET %s'
+            params += [limit, offset]
+        cursor.execute(sql, params)
+        return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+
+def sync_search_index(connection):
+    """
+    (Re)install the SQLite triggers and repopulate the index from the catalog.
+
+    Safe to run at any time; a no-op on databases without a search index.
+    """
+    tables = set(connection.introspection.table_names())
+    if connection.vendor == 'sqlite' and SQLITE_TABLE in tables:
+        statements = SQLITE_DROP_TRIGGERS + SQLITE_TRIGGERS + SQLITE_REPOPULATE
+    elif connection.vendor == 'postgresql' and POSTGRES_TABLE in tables:
+        statements = POSTGRES_REPOPULATE
+    else:
+        return False
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    return True
+
+
+_BACKENDS = {
+    ('sqlite', SQLITE_TABLE): _SQLiteBackend,
+    ('postgresql', POSTGRES_TABLE): _PostgresBackend,
+}
+
+
+class SearchResults:
+    """
+    Lazily evaluated, paginatable search results.
+
+    Paginator only needs count() and slicing, so a page costs one COUNT over
+    the index plus one ranked LIMIT/OFFSET query and one in_bulk() fetch.
+    Returned products carry `search_rank` and `search_snippet` attributes.
+    """
+
+    def __init__(self, search, query):
+        self.search = search
+        self.query = query
+        self.terms = query_terms(query)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.search.count(self.terms)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = index.start or 0
+            limit = None if index.stop is None else max(index.stop - start, 0)
+            return self.search.page(self.terms, limit=limit, offset=start)
+        return self.search.page(self.terms, limit=1, offset=index)[0]
+
+    def __iter__(self):
+        return iter(self[0:None])
+
+
+class ProductSearch:
+    """Entry point used by views: picks the backend once per process"""
+
+    def __init__(self):
+        self._backend = None
+        self._resolved = False
+
+    @property
+    def backend(self):
+        if not self._resolved:
+            tables = set(connection.introspection.table_names())
+            for (vendor, table), backend_class in _BACKENDS.items():
+                if connection.vendor == vendor and table in tables:
+                    self._backend = backend_class()
+            self._resolved = True
+        return self._backend
+
+    def results(self, query):
+        return SearchResults(self, query)
+
+    def matching_ids(self, query, limit=MAX_MATCHES):
+        """Up to `limit` matching product ids, best match first"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        if self.backend is None:
+            return list(self._fallback_queryset(terms).values_list('id', flat=True)[:limit])
+        with connection.cursor() as cursor:
+            rows = self.backend.ranked(cursor, terms, limit=limit, snippets=False)
+        return [row[0] for row in rows]
+
+    def count(self, terms):
+        if not terms:
+            return 0
+        if self.backend is None:
+            return self._fallback_queryset(terms).count()
+        with connection.cursor() as cursor:
+            return self.backend.count(cursor, terms)
+
+    def page(self, terms, limit=None, offset=0):
+        from .models import Product
+
+        if not terms or limit == 0:
+            return []
+        if self.backend is None:
+            queryset = self._fallback_queryset(terms)
+            stop = None if limit is None else offset + limit
+            products = list(queryset[offset:stop])
+            for product in products:
+                product.search_rank = 0
+                product.search_snippet = escape(
+                    Truncator(product.description).words(SNIPPET_WORDS)
+                )
+            return products
+
+        with connection.cursor() as cursor:
+            rows = self.backend.ranked(cursor, terms, limit=limit, offset=offset)
+        products = Product.objects.select_related('category').in_bulk([row[0] for row in rows])
+        results = []
+        for product_id, rank, snippet in rows:
+            product = products.get(product_id)
+            if product is None:
+                continue
+            product.search_rank = rank
+            product.search_snippet = render_snippet(snippet)
+            results.append(product)
+        return results
+
+    def _fallback_queryset(self, terms):
+        from .models import Product
+
+        queryset = Product.objects.all()
+        for term in terms:
+            queryset = queryset.filter(
+                Q(name__icontains=term) |
+                Q(description__icontains=term) |
+                Q(category__name__icontains=term)
+            )
+        return queryset.distinct().order_by('-created_at')
+
+
+product_search = ProductSearch()
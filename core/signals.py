@@ -0,0 +1,209 @@
+"""
+Model signal handlers that keep derived, in-process data structures in sync
+with database writes.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .autocomplete import autocomplete_index
+from .catalog_index import catalog_index
+from .fuzzy_search import fuzzy_index
+from .models import Advertisement, CartItem, Category, Contact, ContactReply, Product, Review
+from . import badges, cart_summary, fragment_cache, images, page_cache
+from .ratings import apply_rating_change
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    def apply():
+        catalog_index.update_product(instance.pk)
+        fuzzy_index.update_product(instance)
+        autocomplete_index.update_product(instance)
+        page_cache.bump(page_cache.CATALOG)
+    transaction.on_commit(apply)
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    product_id = instance.id
+
+    def apply():
+        catalog_index.remove_product(product_id)
+        fuzzy_index.remove_product(product_id)
+        autocomplete_index.remove_product(product_id)
+        page_cache.bump(page_cache.CATALOG)
+    transaction.on_commit(apply)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    def apply():
+        catalog_index.update_category(instance)
+        autocomplete_index.update_category(instance)
+        # Category names are part of every product's vocabulary
+        fuzzy_index.invalidate()
+        fragment_cache.invalidate()
+        page_cache.bump(page_cache.CATALOG)
+    transaction.on_commit(apply)
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    category_id = instance.id
+
+    def apply():
+        catalog_index.remove_category(category_id)
+        autocomplete_index.remove_category(category_id)
+        # Its name was part of the vocabulary of the products filed under it
+        fuzzy_index.invalidate()
+        fragment_cache.invalidate()
+        page_cache.bump(page_cache.CATALOG)
+    transaction.on_commit(apply)
+
+
+@receiver(pre_save, sender=Review)
+def review_before_save(sender, instance, **kwargs):
+    # Remember what the row held so an edit can move the rating between buckets
+    instance._rating_before = None
+    if instance.pk:
+        instance._rating_before = (
+            Review.objects.filter(pk=instance.pk).values_list('product_id', 'rating').first()
+        )
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, **kwargs):
+    before = getattr(instance, '_rating_before', None)
+    after = (instance.product_id, instance.rating)
+    if not created and before == after:
+        return
+    with transaction.atomic():
+        if before is not None:
+            apply_rating_change(before[0], before[1], -1)
+        apply_rating_change(after[0], after[1], 1)
+    for product_id in {after[0], before[0] if before else after[0]}:
+        transaction.on_commit(lambda product_id=product_id: catalog_index.update_product(product_id))
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    apply_rating_change(instance.product_id, instance.rating, -1)
+    product_id = instance.product_id
+    transaction.on_commit(lambda: catalog_index.update_product(product_id))
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def review_changed(sender, instance, **kwargs):
+    product_id = instance.product_id
+
+    def apply():
+        slug = Product.objects.filter(pk=product_id).values_list('slug', flat=True).first()
+        tags = [page_cache.REVIEWS]
+        if slug:
+            tags.append(page_cache.product_tag(slug))
+        page_cache.bump(*tags)
+    transaction.on_commit(apply)
+
+
+@receiver(post_save, sender=Advertisement)
+@receiver(post_delete, sender=Advertisement)
+def advertisement_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: page_cache.bump(page_cache.ADS))
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def cart_item_changed(sender, instance, **kwargs):
+    cart_id = instance.cart_id
+    # Drop it now for the rest of this request, and again once the write is
+    # visible in case another request cached the old totals meanwhile.
+    cart_summary.invalidate(cart_id)
+    transaction.on_commit(lambda: cart_summary.invalidate(cart_id))
+
+
+@receiver(pre_save, sender=CartItem)
+def cart_item_before_save(sender, instance, **kwargs):
+    # What the row held, so the cart badge counter can move by the difference
+    if instance._state.adding:
+        instance._quantity_before = 0
+    elif getattr(instance, '_loaded_quantity', None) is not None:
+        instance._quantity_before = instance._loaded_quantity
+    else:
+        instance._quantity_before = (
+            CartItem.objects.filter(pk=instance.pk).values_list('quantity', flat=True).first() or 0
+        )
+
+
+@receiver(post_save, sender=CartItem)
+def cart_item_saved(sender, instance, **kwargs):
+    cart_id, delta = instance.cart_id, instance.quantity - instance._quantity_before
+    instance._loaded_quantity = instance.quantity
+    transaction.on_commit(lambda: badges.cart_items_changed(cart_id, delta))
+
+
+@receiver(post_delete, sender=CartItem)
+def cart_item_deleted(sender, instance, **kwargs):
+    cart_id = instance.cart_id
+    quantity = getattr(instance, '_loaded_quantity', None) or instance.quantity
+    transaction.on_commit(lambda: badges.cart_items_changed(cart_id, -quantity))
+
+
+def _is_unread(is_admin, is_read):
+    return is_admin and not is_read
+
+
+@receiver(pre_save, sender=ContactReply)
+def contact_reply_before_save(sender, instance, **kwargs):
+    instance._unread_before = False
+    if instance.pk:
+        before = ContactReply.objects.filter(pk=instance.pk).values_list('is_admin', 'is_read').first()
+        instance._unread_before = bool(before) and _is_unread(*before)
+
+
+@receiver(post_save, sender=ContactReply)
+def contact_reply_saved(sender, instance, **kwargs):
+    delta = int(_is_unread(instance.is_admin, instance.is_read)) - int(instance._unread_before)
+    if not delta:
+        return
+    contact = instance.contact
+    if badges.is_feedback_response(contact.subject):
+        return
+    user_id = contact.user_id
+    transaction.on_commit(lambda: badges.unread_replies_changed(user_id, delta))
+
+
+@receiver(post_delete, sender=ContactReply)
+def contact_reply_deleted(sender, instance, **kwargs):
+    if not _is_unread(instance.is_admin, instance.is_read):
+        return
+    # Gone when the whole conversation is deleted; contact_deleted resets the counter then
+    contact = Contact.objects.filter(pk=instance.contact_id).values_list('user_id', 'subject').first()
+    if contact is None or badges.is_feedback_response(contact[1]):
+        return
+    user_id = contact[0]
+    transaction.on_commit(lambda: badges.unread_replies_changed(user_id, -1))
+
+
+@receiver(post_save, sender=Contact)
+def contact_saved(sender, instance, created, update_fields=None, **kwargs):
+    # The subject decides whether replies count; recount if it may have changed
+    if created or (update_fields is not None and not {'subject', 'user'} & set(update_fields)):
+        return
+    user_id = instance.user_id
+    transaction.on_commit(lambda: badges.reset_unread_replies(user_id))
+
+
+@receiver(post_delete, sender=Contact)
+def contact_deleted(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: badges.reset_unread_replies(user_id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Advertisement)
+def image_saved(sender, instance, **kwargs):
+    if images.needs_derivatives(instance):
+        pk = instance.pk
+        transaction.on_commit(lambda: images.schedule_derivatives(sender, pk))
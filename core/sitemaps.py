@@ -0,0 +1,184 @@
+"""
+Generated sitemap.xml.
+
+The sitemap lists the storefront pages, every category listing, the
+promotions page (with its active banners) and every product. Products are
+read in primary-key order with .iterator(), so memory stays flat however large
+the catalog is. Past URLS_PER_SITEMAP URLs, /sitemap.xml becomes a sitemap
+index pointing at /sitemap-<n>.xml pages.
+
+Rendered sitemaps are cached against the page cache's catalog and ads tags, so
+they are rebuilt only after the catalog or the advertisements change; a miss
+is streamed to the crawler while it is being cached.
+"""
+import hashlib
+import math
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, Q
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
+
+from . import page_cache
+from .models import Advertisement, Category, Product
+
+
+# Protocol limit per sitemap file
+URLS_PER_SITEMAP = 50000
+CHUNK_SIZE = 2000
+TIMEOUT = getattr(settings, 'SITEMAP_CACHE_TIMEOUT', 60 * 60 * 24)
+TAGS = (page_cache.CATALOG, page_cache.ADS)
+
+# (url name, changefreq, priority)
+STATIC_PAGES = (
+    ('home', 'daily', '1.0'),
+    ('products', 'daily', '0.9'),
+    ('about', 'monthly', '0.8'),
+    ('contact', 'monthly', '0.8'),
+)
+
+SLUG_MARKER = 'sitemap-slug'
+
+URLSET_OPEN = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" '
+    'xmlns:image="http://www.google.com/schemas/sitemap-image/1.1">\n'
+)
+URLSET_CLOSE = '</urlset>\n'
+
+
+def _lastmod(moment):
+    return moment.isoformat(timespec='seconds') if moment else None
+
+
+def url_entry(loc, lastmod=None, changefreq=None, priority=None, images=()):
+    parts = [f'<url><loc>{escape(loc)}</loc>']
+    if lastmod:
+        parts.append(f'<lastmod>{lastmod}</lastmod>')
+    if changefreq:
+        parts.append(f'<changefreq>{changefreq}</changefreq>')
+    if priority:
+        parts.append(f'<priority>{priority}</priority>')
+    for image in images:
+        parts.append(f'<image:image><image:loc>{escape(image)}</image:loc></image:image>')
+    parts.append('</url>\n')
+    return ''.join(parts)
+
+
+def _leading_entries(base):
+    """Every entry before the products; small enough to build in one go"""
+    entries = [
+        url_entry(base + reverse(name), changefreq=changefreq, priority=priority)
+        for name, changefreq, priority in STATIC_PAGES
+    ]
+    products_url = base + reverse('products')
+    categories = Category.objects.annotate(lastmod=Max('products__updated_at')).order_by('id')
+    for category in categories:
+        entries.append(url_entry(
+            f'{products_url}?{urlencode({"category_slug": category.slug})}',
+            lastmod=_lastmod(category.lastmod), changefreq='daily', priority='0.7',
+        ))
+
+    now = timezone.now()
+    promotions = list(
+        Advertisement.objects.filter(status='active')
+        .filter(Q(start_date__isnull=True) | Q(start_date__lte=now))
+        .filter(Q(end_date__isnull=True) | Q(end_date__gte=now))
+        .order_by('display_order').only('id', 'ad_type', 'image', 'updated_at')
+    )
+    entries.append(url_entry(
+        base + reverse('advertisements_page'),
+        lastmod=_lastmod(max((ad.updated_at for ad in promotions), default=None)),
+        changefreq='daily', priority='0.6',
+        images=[base + ad.image.url for ad in promotions if ad.ad_type == 'banner' and ad.image],
+    ))
+    return entries
+
+
+def _product_entries(base, offset, limit):
+    """Rendered entries for products [offset, offset + limit) in id order"""
+    products = Product.objects.order_by('id')
+    if offset:
+        # Seek to the first id on the page through the primary key index
+        first_id = products.values_list('id', flat=True)[offset:offset + 1].first()
+        if first_id is None:
+            return
+        products = products.filter(id__gte=first_id)
+    # Same URL as Product.get_absolute_url(), without reversing it per product
+    prefix, suffix = (base + reverse('product_detail', kwargs={'slug': SLUG_MARKER})).split(SLUG_MARKER)
+    rows = products.values_list('slug', 'updated_at')[:limit].iterator(chunk_size=CHUNK_SIZE)
+    for slug, updated_at in rows:
+        yield url_entry(
+            prefix + slug + suffix,
+            lastmod=_lastmod(updated_at), changefreq='weekly', priority='0.8',
+        )
+
+
+def url_count():
+    return len(STATIC_PAGES) + Category.objects.count() + 1 + Product.objects.count()
+
+
+def page_count(total):
+    return max(1, math.ceil(total / URLS_PER_SITEMAP))
+
+
+def iter_urlset(base, page=1):
+    """Stream the <urlset> holding the `page`th block of URLS_PER_SITEMAP URLs"""
+    yield URLSET_OPEN
+    start = (page - 1) * URLS_PER_SITEMAP
+    leading = _leading_entries(base)
+    entries = leading[start:start + URLS_PER_SITEMAP]
+    if entries:
+        yield ''.join(entries)
+    remaining = URLS_PER_SITEMAP - len(entries)
+    chunk = []
+    for entry in _product_entries(base, max(0, start - len(leading)), remaining):
+        chunk.append(entry)
+        if len(chunk) >= 500:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    yield URLSET_CLOSE
+
+
+def iter_index(base, pages):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for page in range(1, pages + 1):
+        loc = base + reverse('sitemap_page', kwargs={'page': page})
+        yield f'<sitemap><loc>{escape(loc)}</loc></sitemap>\n'
+    yield '</sitemapindex>\n'
+
+
+def cache_key(base, name):
+    versions = ':'.join(page_cache.tag_versions(TAGS))
+    digest = hashlib.md5(f'{base}:{versions}'.encode()).hexdigest()
+    return f'sitemap:{digest}:{name}'
+
+
+def cache_timeout():
+    """Until the next ad starts or ends, since that changes the promotions entry"""
+    boundary = page_cache.next_ad_boundary()
+    return TIMEOUT if boundary is None else min(TIMEOUT, boundary)
+
+
+def cached_count(base):
+    key = cache_key(base, 'count')
+    total = cache.get(key)
+    if total is None:
+        total = url_count()
+        cache.set(key, total, cache_timeout())
+    return total
+
+
+def stream_and_cache(chunks, key):
+    """Yield `chunks` and cache their concatenation once they are all out"""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    cache.set(key, ''.join(parts), cache_timeout())
@@ -0,0 +1,286 @@
+"""
+Append-only stock ledger.
+
+Every change to a product's stock is a StockMovement: a signed quantity and
+a kind (receipt, sale, return or adjustment), tied to the order or admin
+behind it where there is one. record() writes a batch of movements with one
+bulk_create and adds their net change per product to Product.stock_quantity
+with one UPDATE, in one transaction. The column therefore always equals the
+sum of the product's ledger, and stays the O(1) "stock now" read used by the
+storefront and core.inventory.
+
+History comes from StockSnapshot rows, each a product's balance as of a
+movement id. take_snapshots() (run periodically by the snapshot_stock
+command) rolls every product that moved since the last run forward from its
+previous snapshot. stock_at() answers "how many at time T" from the last
+snapshot before T plus the few movements after it, never the whole ledger.
+reconcile() checks stock_quantity and every snapshot against the ledger.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, Exists, F, IntegerField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
+
+from . import page_cache
+from .models import Product, StockMovement, StockSnapshot
+
+
+# Products updated per UPDATE statement (keeps the CASE and parameters small)
+UPDATE_BATCH_SIZE = 200
+INSERT_BATCH_SIZE = 1000
+
+# A batch touching more products than this (an import, a stock count) bumps
+# the catalog tag, which product pages also carry, instead of a tag per product
+PRODUCT_TAG_LIMIT = 100
+
+# Movements younger than this wait for the next snapshot, so one whose
+# transaction is still committing cannot be skipped
+SNAPSHOT_LAG = timedelta(minutes=1)
+
+OPENING_NOTE = 'Opening balance'
+RECONCILIATION_NOTE = 'Reconciliation'
+
+
+class InsufficientStock(Exception):
+    """Some products are short; nothing was taken"""
+    def __init__(self, shortages):
+        self.shortages = shortages
+        # Empty when the stock came back between the UPDATE and the re-read
+        super().__init__('; '.join(
+            f'{shortage["name"]}: only {shortage["available"]} in stock' for shortage in shortages
+        ) or 'Stock changed while the order was being placed; please try again.')
+
+
+def _case(values):
+    return Case(
+        *[When(pk=product_id, then=Value(value)) for product_id, value in values],
+        default=Value(0), output_field=IntegerField(),
+    )
+
+
+def _apply(deltas, require_stock):
+    """Add the signed {product_id: delta}; returns how many products changed"""
+    changed = 0
+    deltas = list(deltas.items())
+    for start in range(0, len(deltas), UPDATE_BATCH_SIZE):
+        batch = deltas[start:start + UPDATE_BATCH_SIZE]
+        products = Product.objects.filter(pk__in=[product_id for product_id, _delta in batch])
+        taken = [(product_id, -delta) for product_id, delta in batch if delta < 0]
+        if require_stock and taken:
+            products = products.filter(stock_quantity__gte=_case(taken))
+        changed += products.update(stock_quantity=F('stock_quantity') + _case(batch), updated_at=Now())
+    return changed
+
+
+def _shortages(deltas):
+    products = Product.objects.only('id', 'name', 'stock_quantity').in_bulk(list(deltas))
+    shortages = []
+    for product_id, delta in sorted(deltas.items()):
+        product = products.get(product_id)
+        available = product.stock_quantity if product else 0
+        if available + delta < 0 or product is None:
+            shortages.append({
+                'product_id': product_id,
+                'name': product.name if product else f'Product #{product_id}',
+                'requested': -delta,
+                'available': available,
+            })
+    return shortages
+
+
+def _stock_changed(deltas):
+    """
+    Once committed, retire the cached pages of the products in {product_id: delta}.
+
+    Listings and the home page only show whether a product is in stock, so
+    they are retired (through the catalog tag) when one sells out or comes
+    back, not on every sale.
+    """
+    if len(deltas) > PRODUCT_TAG_LIMIT:
+        transaction.on_commit(lambda: page_cache.bump(page_cache.CATALOG))
+        return
+
+    def apply():
+        tags, crossed_zero = [], False
+        rows = Product.objects.filter(pk__in=deltas).values_list('id', 'slug', 'stock_quantity')
+        for product_id, slug, stock in rows:
+            tags.append(page_cache.product_tag(slug))
+            crossed_zero = crossed_zero or (stock > 0) != (stock - deltas[product_id] > 0)
+        if crossed_zero:
+            tags.append(page_cache.CATALOG)
+        page_cache.bump(*tags)
+    transaction.on_commit(apply)
+
+
+def record(movements, require_stock=False):
+    """
+    Append unsaved StockMovements and apply them to stock, atomically.
+
+    With `require_stock`, a batch that would take any product below zero
+    raises InsufficientStock and writes nothing. Returns the saved movements.
+    """
+    movements = [movement for movement in movements if movement.quantity]
+    if not movements:
+        return []
+    deltas = defaultdict(int)
+    for movement in movements:
+        deltas[movement.product_id] += movement.quantity
+    with transaction.atomic():
+        short = _apply(deltas, require_stock) != len(deltas)
+        if short:
+            transaction.set_rollback(True)
+        else:
+            StockMovement.objects.bulk_create(movements, batch_size=INSERT_BATCH_SIZE)
+    if short:
+        raise InsufficientStock(_shortages(deltas))
+    _stock_changed(dict(deltas))
+    return movements
+
+
+def set_stock(levels, kind=StockMovement.ADJUSTMENT, note='', user=None):
+    """Bring products to {product_id: quantity} with one movement each for the difference"""
+    with transaction.atomic():
+        # Locked, so a sale landing meanwhile cannot make the difference stale
+        current = dict(
+            Product.objects.select_for_update().filter(pk__in=levels).values_list('id', 'stock_quantity')
+        )
+        return record([
+            StockMovement(
+                product_id=product_id, kind=kind, quantity=quantity - current[product_id],
+                note=note, created_by=user,
+            )
+            for product_id, quantity in levels.items()
+            if product_id in current
+        ])
+
+
+def open_balances(products=None):
+    """
+    Record the stock of products that have none in the ledger yet.
+
+    For products created with stock outside the ledger (seed data, older
+    rows); the stock itself is left as it is. Returns the movements written.
+    """
+    products = Product.objects.all() if products is None else products
+    rows = (
+        products.filter(stock_quantity__gt=0)
+        .filter(~Exists(StockMovement.objects.filter(product=OuterRef('pk'))))
+        .values_list('id', 'stock_quantity')
+    )
+    movements = [
+        StockMovement(product_id=product_id, kind=StockMovement.ADJUSTMENT, quantity=quantity, note=OPENING_NOTE)
+        for product_id, quantity in rows.iterator(chunk_size=INSERT_BATCH_SIZE)
+    ]
+    return StockMovement.objects.bulk_create(movements, batch_size=INSERT_BATCH_SIZE)
+
+
+def _latest_snapshots(product_ids):
+    latest = StockSnapshot.objects.filter(product_id=OuterRef('product_id')).order_by('-movement_id')
+    snapshots = {}
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), UPDATE_BATCH_SIZE):
+        rows = StockSnapshot.objects.filter(
+            product_id__in=product_ids[start:start + UPDATE_BATCH_SIZE],
+            movement_id=Subquery(latest.values('movement_id')[:1]),
+        )
+        snapshots.update((snapshot.product_id, snapshot) for snapshot in rows)
+    return snapshots
+
+
+def take_snapshots(rebuild=False, now=None):
+    """Snapshot every product whose stock moved since the last run; returns how many were taken"""
+    now = now or timezone.now()
+    with transaction.atomic():
+        if rebuild:
+            StockSnapshot.objects.all().delete()
+        start = StockSnapshot.objects.aggregate(latest=Max('movement_id'))['latest'] or 0
+        end = StockMovement.objects.filter(
+            id__gt=start, created_at__lte=now - SNAPSHOT_LAG,
+        ).aggregate(latest=Max('id'))['latest']
+        if end is None:
+            return 0
+        totals = list(
+            StockMovement.objects.filter(id__gt=start, id__lte=end)
+            .values('product_id').annotate(total=Sum('quantity'), last=Max('created_at'))
+            .order_by('product_id')
+        )
+        previous = _latest_snapshots(row['product_id'] for row in totals)
+        snapshots = []
+        for row in totals:
+            before = previous.get(row['product_id'])
+            snapshots.append(StockSnapshot(
+                product_id=row['product_id'], movement_id=end,
+                quantity=(before.quantity if before else 0) + row['total'],
+                as_of=max(before.as_of, row['last']) if before else row['last'],
+            ))
+        StockSnapshot.objects.bulk_create(snapshots, batch_size=INSERT_BATCH_SIZE)
+    return len(snapshots)
+
+
+def stock_at(product_id, when):
+    """A product's stock at `when`: its last snapshot by then plus the movements since"""
+    snapshot = (
+        StockSnapshot.objects.filter(product_id=product_id, as_of__lte=when)
+        .order_by('-movement_id').only('quantity', 'movement_id').first()
+    )
+    base, after = (snapshot.quantity, snapshot.movement_id) if snapshot else (0, 0)
+    moved = StockMovement.objects.filter(
+        product_id=product_id, id__gt=after, created_at__lte=when,
+    ).aggregate(total=Sum('quantity'))['total']
+    return base + (moved or 0)
+
+
+def _ledger_total(product, **filters):
+    """Subquery summing the movements of the `product` reference"""
+    movements = StockMovement.objects.filter(product_id=product, **filters).order_by()
+    return Coalesce(Subquery(
+        movements.values('product_id').annotate(total=Sum('quantity')).values('total')
+    ), 0)
+
+
+def stock_drift(products=None):
+    """(product_id, name, stock_quantity, ledger total) for products whose stock disagrees with the ledger"""
+    products = Product.objects.all() if products is None else products
+    return list(
+        products.annotate(ledger=_ledger_total(OuterRef('pk'))).exclude(stock_quantity=F('ledger'))
+        .order_by('id').values_list('id', 'name', 'stock_quantity', 'ledger')
+    )
+
+
+def snapshot_errors():
+    """(snapshot id, product_id, movement_id, quantity, ledger total) for snapshots the ledger disagrees with"""
+    return list(
+        StockSnapshot.objects.annotate(
+            ledger=_ledger_total(OuterRef('product_id'), id__lte=OuterRef('movement_id')),
+        ).exclude(quantity=F('ledger'))
+        .order_by('product_id', 'movement_id').values_list('id', 'product_id', 'movement_id', 'quantity', 'ledger')
+    )
+
+
+def reconcile():
+    """(stock drift, snapshot errors); both empty when everything agrees with the ledger"""
+    return stock_drift(), snapshot_errors()
+
+
+def repair_drift(product_ids, user=None):
+    """
+    Record adjustments so the ledger of `product_ids` sums to their stock again.
+
+    The stock the storefront sold against is taken as the truth; the ledger
+    gains one movement per product for the difference. Returns the movements.
+    """
+    with transaction.atomic():
+        # Locked, so no sale moves the stock between reading and recording it
+        products = Product.objects.select_for_update().filter(pk__in=product_ids)
+        products = Product.objects.filter(pk__in=list(products.values_list('id', flat=True)))
+        movements = [
+            StockMovement(
+                product_id=product_id, kind=StockMovement.ADJUSTMENT, quantity=stock - ledger,
+                note=RECONCILIATION_NOTE, created_by=user,
+            )
+            for product_id, _name, stock, ledger in stock_drift(products)
+        ]
+        return StockMovement.objects.bulk_create(movements, batch_size=INSERT_BATCH_SIZE)
@@ -0,0 +1,12 @@
+from django import template
+
+from core.fragment_cache import render_product_cards
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def product_cards(context, products, variant, slot=None):
+    """Render a grid's product cards from the fragment cache: {% product_cards products 'listing' %}"""
+    return render_product_cards(products, variant, user=context.get('user'), slot=slot)
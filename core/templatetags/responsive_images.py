@@ -0,0 +1,44 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+
+register = template.Library()
+
+
+def _srcset(renditions):
+    return ', '.join(
+        f'{default_storage.url(name)} {width}w'
+        for width, name in sorted(renditions.items(), key=lambda item: int(item[0]))
+    )
+
+
+@register.simple_tag
+def responsive_image(obj, alt='', sizes='100vw', fallback_width=640, **attrs):
+    """
+    <picture> with WebP and JPEG srcsets for an object's `image`.
+
+    Falls back to a plain <img> of the original upload until its derivatives
+    have been generated: {% responsive_image product alt=product.name sizes="50vw" class="w-full" %}
+    """
+    image = obj.image
+    if not image:
+        return ''
+    extra = format_html_join('', ' {}="{}"', sorted(attrs.items()))
+    manifest = getattr(obj, 'image_derivatives', None) or {}
+    if manifest.get('source') != image.name or not manifest.get('jpeg'):
+        return format_html('<img src="{}" alt="{}" loading="lazy"{}>', image.url, alt, extra)
+
+    jpeg = manifest['jpeg']
+    widths = sorted(int(width) for width in jpeg)
+    # Browsers without srcset support get a mid-sized rendition
+    fallback = max([width for width in widths if width <= fallback_width] or widths[:1])
+    height = round(manifest['height'] * fallback / manifest['width'])
+    return format_html(
+        '<picture class="contents">'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" loading="lazy" decoding="async"{}>'
+        '</picture>',
+        _srcset(manifest.get('webp', {})), sizes,
+        default_storage.url(jpeg[str(fallback)]), _srcset(jpeg), sizes, fallback, height, alt, extra,
+    )
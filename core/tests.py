@@ -0,0 +1,1031 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from PIL import Image
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    badges, cart_operations, cart_summary, fragment_cache, images, inventory, product_io, sitemaps, stock_ledger,
+)
+from .autocomplete import AutocompleteIndex, autocomplete_index
+from .catalog_index import CatalogIndex, catalog_index
+from .fuzzy_search import FuzzyIndex, fuzzy_index
+from .models import Cart, CartItem, Customer, Order, Product, Review, StockMovement
+from .order_placement import place_cart_order, place_order
+from .pagination import KeysetPaginator
+from .ratings import rebuild_product_ratings
+from .recommendations import count_co_purchases, rebuild_recommendations, recommended_products
+from .sales_ranking import rank_sales, top_sellers
+from .search import product_search
+from .stock_ledger import InsufficientStock
+
+
+def make_product(slug, stock):
+    return Product.objects.create(
+        name=slug.replace('-', ' ').title(), slug=slug, description='', price=Decimal('25.00'),
+        product_type='fresh-corn', stock_quantity=stock,
+    )
+
+
+def image_bytes(size, image_format='JPEG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (230, 180, 40)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def run_concurrently(count, function):
+    """Call `function()` from `count` threads at once; returns the results or raised exceptions"""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        try:
+            results[index] = function()
+        except Exception as error:
+            results[index] = error
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class CatalogIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog_index.invalidate()
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+        catalog_index.ensure_built()
+        self.client.force_login(User.objects.create_user('catalog-admin', is_staff=True))
+
+    def edit(self, product, price):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('admin_product_edit', args=[product.pk]), {
+                'name': product.name, 'description': '', 'price': price, 'product_type': product.product_type,
+                'stock_quantity': '5', 'original_stock_quantity': '5',
+            })
+
+    def test_admin_edit_updates_the_built_index(self):
+        response = self.edit(self.corn, '12.50')
+
+        self.assertRedirects(response, reverse('admin_products'), fetch_redirect_response=False)
+        self.assertEqual(catalog_index.filter_ids(sort='price-low-high'), [self.corn.pk, self.chips.pk])
+        self.assertEqual(catalog_index.filter_ids(price_range=(Decimal('10'), Decimal('20'))), [self.corn.pk])
+
+    def test_admin_edit_rejects_an_invalid_price(self):
+        response = self.edit(self.corn, 'cheap')
+
+        self.assertRedirects(
+            response, reverse('admin_product_edit', args=[self.corn.pk]), fetch_redirect_response=False,
+        )
+        self.assertEqual(Product.objects.get(pk=self.corn.pk).price, Decimal('25.00'))
+
+    def reprice(self, product, price):
+        Product.objects.filter(pk=product.pk).update(price=Decimal(price))
+
+    def cheap_ids(self, index):
+        return index.filter_ids(price_range=(None, Decimal('10')))
+
+    def test_other_processes_rebuild_after_a_change(self):
+        other = CatalogIndex()
+        other.ensure_built()
+        self.reprice(self.corn, '5.00')
+        catalog_index.update_product(self.corn.pk)
+
+        self.assertEqual(self.cheap_ids(other), [self.corn.pk])
+
+    def test_simultaneous_changes_are_not_lost(self):
+        other = CatalogIndex()
+        other.ensure_built()
+        self.reprice(self.corn, '5.00')
+        other.update_product(self.corn.pk)
+        # This process never saw the other one's change, so it must rebuild
+        self.reprice(self.chips, '1.00')
+        catalog_index.update_product(self.chips.pk)
+
+        self.assertEqual(self.cheap_ids(catalog_index), [self.chips.pk, self.corn.pk])
+        self.assertEqual(self.cheap_ids(other), [self.chips.pk, self.corn.pk])
+
+    def test_a_change_made_while_building_triggers_a_rebuild(self):
+        index = CatalogIndex()
+        add = index._add
+
+        def add_during_a_change(entry):
+            add(entry)
+            if entry.id == self.corn.pk:
+                self.reprice(self.corn, '5.00')
+                catalog_index.update_product(self.corn.pk)
+        index._add = add_during_a_change
+        index.build()
+        del index._add
+
+        self.assertEqual(self.cheap_ids(index), [self.corn.pk])
+
+    def test_review_moves_the_rating_ordering(self):
+        customer = Customer.objects.create(user=User.objects.create_user('reviewer'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=self.chips, customer=customer, rating=5, comment='Crunchy')
+
+        self.assertEqual(catalog_index.filter_ids(sort='top-rated'), [self.chips.pk, self.corn.pk])
+        self.assertEqual(catalog_index.filter_ids(min_rating=4), [self.chips.pk])
+
+
+class FuzzyIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        fuzzy_index.invalidate()
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+        fuzzy_index.ensure_built()
+
+    def rename(self, product, name, index=fuzzy_index):
+        Product.objects.filter(pk=product.pk).update(name=name)
+        index.update_product(Product.objects.get(pk=product.pk))
+
+    def test_misspelt_words_match_and_are_corrected(self):
+        self.assertEqual(fuzzy_index.search_ids('swet corm'), [self.corn.pk, self.chips.pk])
+        self.assertEqual(fuzzy_index.suggest('swet chps'), 'sweet chips')
+        self.assertIsNone(fuzzy_index.suggest('sweet corn'))
+
+    def test_simultaneous_changes_are_not_lost(self):
+        other = FuzzyIndex()
+        other.ensure_built()
+        self.rename(self.corn, 'Purple Corn', index=other)
+        # This process never saw the other one's change, so it must rebuild
+        self.rename(self.chips, 'Violet Chips')
+
+        for index in (fuzzy_index, other):
+            self.assertEqual(index.search_ids('purple'), [self.corn.pk])
+            self.assertEqual(index.search_ids('violet'), [self.chips.pk])
+
+    def test_a_change_made_while_building_triggers_a_rebuild(self):
+        index = FuzzyIndex()
+        add = index._add
+
+        def add_during_a_change(product_id, *fields):
+            add(product_id, *fields)
+            if product_id == self.corn.pk:
+                self.rename(self.corn, 'Purple Corn')
+        index._add = add_during_a_change
+        index.build()
+        del index._add
+
+        self.assertEqual(index.search_ids('purple'), [self.corn.pk])
+
+
+class AutocompleteIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        autocomplete_index.invalidate()
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+        autocomplete_index.ensure_built()
+
+    def rename(self, product, name, index=autocomplete_index):
+        Product.objects.filter(pk=product.pk).update(name=name)
+        index.update_product(Product.objects.get(pk=product.pk))
+
+    def names(self, prefix, index=autocomplete_index):
+        return sorted(completion.name for completion in index.complete(prefix) if completion.kind == 'product')
+
+    def test_endpoint_completes_word_starts_without_queries(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('search_autocomplete'), {'q': 'cor'})
+        products = [result['name'] for result in response.json()['results'] if result['type'] == 'product']
+        self.assertEqual(sorted(products), ['Corn Chips', 'Sweet Corn'])
+
+    def test_simultaneous_changes_are_not_lost(self):
+        other = AutocompleteIndex()
+        other.ensure_built()
+        self.rename(self.corn, 'Purple Corn', index=other)
+        # This process never saw the other one's change, so it must rebuild
+        self.rename(self.chips, 'Violet Chips')
+
+        for index in (autocomplete_index, other):
+            self.assertEqual(self.names('pur', index), ['Purple Corn'])
+            self.assertEqual(self.names('vio', index), ['Violet Chips'])
+
+    def test_a_change_made_while_building_triggers_a_rebuild(self):
+        index = AutocompleteIndex()
+        add = index._add
+
+        def add_during_a_change(entry):
+            add(entry)
+            if (entry.kind, entry.id) == ('product', self.corn.pk):
+                self.rename(self.corn, 'Purple Corn')
+        index._add = add_during_a_change
+        index.build()
+        del index._add
+
+        self.assertEqual(self.names('pur', index), ['Purple Corn'])
+
+
+class RatingSummaryTests(TestCase):
+    def setUp(self):
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+        self.customers = [
+            Customer.objects.create(user=User.objects.create_user(f'reviewer-{number}')) for number in range(3)
+        ]
+
+    def summary(self, product):
+        product = Product.objects.get(pk=product.pk)
+        return product.review_count, product.rating_sum, product.rating_average, product.rating_5_count
+
+    def test_review_writes_keep_the_summary_current(self):
+        first = Review.objects.create(product=self.corn, customer=self.customers[0], rating=5, comment='Sweet')
+        Review.objects.create(product=self.corn, customer=self.customers[1], rating=2, comment='Dry')
+        self.assertEqual(self.summary(self.corn), (2, 7, 3.5, 1))
+
+        first.rating = 3
+        first.save()
+        self.assertEqual(self.summary(self.corn), (2, 5, 2.5, 0))
+
+        first.product = self.chips
+        first.save()
+        self.assertEqual(self.summary(self.corn), (1, 2, 2.0, 0))
+        self.assertEqual(self.summary(self.chips), (1, 3, 3.0, 0))
+
+        first.delete()
+        self.assertEqual(self.summary(self.chips), (0, 0, 0.0, 0))
+
+    def test_rebuild_matches_the_reviews(self):
+        Review.objects.create(product=self.corn, customer=self.customers[0], rating=5, comment='Sweet')
+        Review.objects.create(product=self.corn, customer=self.customers[1], rating=4, comment='Good')
+        Product.objects.filter(pk=self.corn.pk).update(review_count=9, rating_sum=1, rating_average=0.1)
+
+        rebuild_product_ratings()
+
+        self.assertEqual(self.summary(self.corn), (2, 9, 4.5, 1))
+        self.assertEqual(self.summary(self.chips), (0, 0, 0.0, 0))
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog_index.invalidate()
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+
+    def test_matching_ids_are_capped(self):
+        self.assertEqual(sorted(product_search.matching_ids('corn')), sorted([self.corn.pk, self.chips.pk]))
+        self.assertEqual(len(product_search.matching_ids('corn', limit=1)), 1)
+
+    def test_listing_shows_the_matches(self):
+        response = self.client.get(reverse('products'), {'search': 'chips'})
+
+        self.assertEqual([product.pk for product in response.context['products']], [self.chips.pk])
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.corn = make_product('sweet-corn', 5)
+        self.url = reverse('product_detail', args=[self.corn.slug])
+
+    def test_anonymous_pages_are_served_from_the_cache_until_the_catalog_changes(self):
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'hit')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=self.corn.pk).save()
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'miss')
+
+    def test_signed_in_users_get_the_full_view(self):
+        self.client.get(self.url)
+        self.client.force_login(User.objects.create_user('shopper'))
+
+        self.assertFalse(self.client.get(self.url).has_header('X-Page-Cache'))
+
+
+class ProductCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+
+    def render(self, *products, **options):
+        with mock.patch.object(fragment_cache, 'get_template', wraps=fragment_cache.get_template) as get_template:
+            html = fragment_cache.render_product_cards(products, 'search', **options)
+        return html, get_template.called
+
+    def test_cards_are_rendered_once(self):
+        html, rendered = self.render(self.corn, self.chips)
+        self.assertTrue(rendered)
+        self.assertIn('Corn Chips', html)
+
+        self.assertEqual(self.render(self.corn, self.chips), (html, False))
+
+    def test_saving_a_product_renders_its_card_again(self):
+        self.render(self.corn)
+        self.corn.name = 'Purple Corn'
+        self.corn.save()
+
+        html, rendered = self.render(self.corn)
+        self.assertTrue(rendered)
+        self.assertIn('Purple Corn', html)
+
+    def test_slots_are_filled_per_request(self):
+        self.corn.search_snippet = '<b>sweet</b>'
+        self.render(self.corn, slot='search_snippet')
+        self.corn.search_snippet = 'golden'
+
+        html, rendered = self.render(self.corn, slot='search_snippet')
+        self.assertFalse(rendered)
+        self.assertIn('golden', html)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.corn = make_product('sweet-corn', 5)
+        self.url = reverse('product_detail', args=[self.corn.slug])
+
+    def test_a_matching_etag_gets_a_304_without_queries(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('no-cache', first['Cache-Control'])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_a_catalog_change_gives_a_new_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=self.corn.pk).save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_json_apis_answer_conditional_requests(self):
+        url = reverse('advertisements_carousel')
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.corn = make_product('sweet-corn', 100)
+        self.chips = make_product('corn-chips', 100)
+        self.husks = make_product('corn-husks', 100)
+        self.customer = Customer.objects.create(user=User.objects.create_user('buyer'))
+
+    def order(self, *products, status=None):
+        order = place_order(self.customer, [(product.pk, 1) for product in products])
+        if status:
+            Order.objects.filter(pk=order.pk).update(status=status)
+
+    def test_products_bought_together_are_recommended(self):
+        self.order(self.corn, self.chips)
+        self.order(self.corn, self.chips)
+        self.order(self.corn, self.husks)
+        for _ in range(3):
+            self.order(self.corn, self.husks, status='cancelled')
+
+        self.assertEqual(rebuild_recommendations(), (3, 2))
+        self.assertEqual(recommended_products(self.corn), [self.chips])
+        self.assertEqual(recommended_products(self.chips), [self.corn])
+        self.assertEqual(recommended_products(self.husks), [])
+
+    def test_large_baskets_add_no_pairs(self):
+        total, items, pairs = count_co_purchases([{1, 2}, {1, 2, 3, 4}], max_basket=3)
+
+        self.assertEqual((total, items[1], items[4]), (2, 2, 1))
+        self.assertEqual(pairs, {(1, 2): 1})
+
+
+class SalesRankingTests(TestCase):
+    def setUp(self):
+        self.corn = make_product('sweet-corn', 100)
+        self.chips = make_product('corn-chips', 100)
+        customer = Customer.objects.create(user=User.objects.create_user('buyer'))
+        self.corn_order = place_order(customer, [(self.corn.pk, 4)])
+        place_order(customer, [(self.chips.pk, 2)])
+        self.now = timezone.now()
+
+    def scores(self):
+        return [
+            round(score, 3) for score in
+            Product.objects.filter(pk__in=[self.corn.pk, self.chips.pk]).order_by('id').values_list('sales_score', flat=True)
+        ]
+
+    def test_scores_decay_and_follow_cancellations(self):
+        self.assertEqual(rank_sales(now=self.now), (2, 0))
+        self.assertEqual(self.scores(), [4.0, 2.0])
+        self.assertEqual(list(top_sellers()), [self.corn, self.chips])
+        # Nothing new to count
+        self.assertEqual(rank_sales(now=self.now), (0, 0))
+
+        later = self.now + timedelta(days=14)
+        self.assertEqual(rank_sales(half_life_days=14, now=later), (0, 0))
+        self.assertEqual(self.scores(), [2.0, 1.0])
+
+        Order.objects.filter(pk=self.corn_order.pk).update(status='cancelled')
+        self.assertEqual(rank_sales(half_life_days=14, now=later), (0, 1))
+        self.assertEqual(self.scores(), [0.0, 1.0])
+        self.assertEqual(list(top_sellers()), [self.chips])
+
+    def test_full_recount_matches_incremental_runs(self):
+        rank_sales(now=self.now)
+        Product.objects.filter(pk=self.corn.pk).update(sales_score=99)
+
+        self.assertEqual(rank_sales(full=True, now=self.now), (2, 0))
+        self.assertEqual(self.scores(), [4.0, 2.0])
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media.name, IMAGE_DERIVATIVES_SYNC=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.corn = make_product('sweet-corn', 5)
+
+    def upload(self, name, size):
+        self.corn.image = SimpleUploadedFile(name, image_bytes(size), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.corn.save()
+        return Product.objects.get(pk=self.corn.pk)
+
+    def test_uploads_get_resized_renditions(self):
+        product = self.upload('corn.jpg', (1000, 500))
+
+        manifest = product.image_derivatives
+        self.assertEqual((manifest['source'], manifest['width'], manifest['height']), (product.image.name, 1000, 500))
+        self.assertEqual(sorted(manifest['webp'], key=int), ['320', '640', '960', '1000'])
+        with Image.open(f"{self.media.name}/{manifest['jpeg']['320']}") as rendition:
+            self.assertEqual(rendition.size, (320, 160))
+        self.assertFalse(images.needs_derivatives(product))
+
+        html = Template('{% load responsive_images %}{% responsive_image product alt="Corn" %}').render(
+            Context({'product': product}),
+        )
+        self.assertIn('image/webp', html)
+        self.assertIn('width="640" height="320"', html)
+
+    def test_identical_uploads_reuse_the_renditions(self):
+        first = self.upload('corn.jpg', (400, 400)).image_derivatives
+        second = self.upload('corn-again.jpg', (400, 400)).image_derivatives
+
+        self.assertNotEqual(first['source'], second['source'])
+        self.assertEqual(first['jpeg'], second['jpeg'])
+
+
+class OptimizeImagesTests(TransactionTestCase):
+    # Not a TestCase: the command closes the connection before forking workers
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media.name, IMAGE_DERIVATIVES_SYNC=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.original = os.path.join(self.media.name, 'banner.jpg')
+        Image.frombytes('RGB', (2400, 1200), os.urandom(2400 * 1200 * 3)).save(self.original, quality=100)
+        os.makedirs(os.path.join(self.media.name, 'products'))
+        self.copy = os.path.join(self.media.name, 'products', 'copy.jpg')
+        shutil.copyfile(self.original, self.copy)
+        self.corn = make_product('sweet-corn', 5)
+        Product.objects.filter(pk=self.corn.pk).update(image='products/copy.jpg')
+
+    def optimize(self):
+        output = io.StringIO()
+        call_command(
+            'optimize_images', self.media.name, workers=1,
+            manifest=os.path.join(self.media.name, 'manifest.jsonl'), stdout=output,
+        )
+        return output.getvalue()
+
+    def test_duplicates_are_optimized_once_and_products_repointed(self):
+        size = os.path.getsize(self.original)
+        self.assertIn('1 products repointed', self.optimize())
+
+        self.assertLess(os.path.getsize(self.original), size)
+        self.assertEqual(os.path.getsize(self.copy), os.path.getsize(self.original))
+        with Image.open(self.original) as optimized:
+            self.assertEqual(optimized.size, (1920, 960))
+        self.assertEqual(Product.objects.get(pk=self.corn.pk).image.name, 'banner.jpg')
+        # Files in the manifest are skipped on the next run
+        self.assertIn('0 images to process', self.optimize())
+
+
+class SitemapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [make_product(f'corn-{number}', 5) for number in range(7)]
+
+    def fetch(self, url):
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content.decode()
+
+    def product_urls(self, content):
+        return [line for line in content.splitlines() if '/product/' in line]
+
+    def test_sitemap_is_streamed_once_then_served_from_the_cache(self):
+        response, content = self.fetch(reverse('sitemap'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(len(self.product_urls(content)), 7)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('sitemap'))
+        self.assertEqual(response.content.decode(), content)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product('purple-corn', 5)
+        self.assertIn('/product/purple-corn/', self.fetch(reverse('sitemap'))[1])
+
+    def test_large_catalogs_get_a_sitemap_index(self):
+        with mock.patch.object(sitemaps, 'URLS_PER_SITEMAP', 5):
+            total = sitemaps.url_count()
+            pages = sitemaps.page_count(total)
+            _response, index = self.fetch(reverse('sitemap'))
+            self.assertIn('<sitemapindex', index)
+            self.assertEqual(index.count('<sitemap>'), pages)
+
+            urls = []
+            for page in range(1, pages + 1):
+                _response, content = self.fetch(reverse('sitemap_page', args=[page]))
+                self.assertLessEqual(content.count('<url>'), 5)
+                urls += self.product_urls(content)
+            self.assertEqual(len(urls), 7)
+            self.assertEqual(len(set(urls)), 7)
+            self.assertEqual(self.client.get(reverse('sitemap_page', args=[pages + 1])).status_code, 404)
+
+
+class AdminOrdersPaginationTests(TestCase):
+    def setUp(self):
+        product = make_product('sweet-corn', 100)
+        customer = Customer.objects.create(user=User.objects.create_user('buyer'))
+        self.orders = [place_order(customer, [(product.pk, 1)]) for _ in range(12)]
+        self.client.force_login(User.objects.create_user('orders-admin', is_staff=True))
+
+    def test_pages_follow_the_cursor_and_show_the_total(self):
+        first = self.client.get(reverse('admin_orders'))
+        self.assertContains(first, 'Showing 10 of 12 total orders')
+        self.assertEqual([order.pk for order in first.context['orders']], [order.pk for order in self.orders[:1:-1]])
+
+        second = self.client.get(reverse('admin_orders'), {'cursor': first.context['orders'].next_cursor})
+        self.assertEqual([order.pk for order in second.context['orders']], [self.orders[1].pk, self.orders[0].pk])
+        self.assertFalse(second.context['orders'].has_next())
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        self.products = [make_product(f'corn-{number}', 5) for number in range(7)]
+        # Ties on created_at are ordered by id
+        Product.objects.filter(pk__in=[product.pk for product in self.products]).update(created_at=timezone.now())
+        self.paginator = KeysetPaginator(
+            Product.objects.filter(slug__startswith='corn-'), 3, ordering=('-created_at', '-id'),
+        )
+        self.expected = [product.pk for product in reversed(self.products)]
+
+    def ids(self, page):
+        return [product.pk for product in page]
+
+    def test_pages_forward_and_back_through_ties(self):
+        pages = [self.paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([self.ids(page) for page in pages], [self.expected[:3], self.expected[3:6], self.expected[6:]])
+        self.assertFalse(pages[0].has_previous())
+
+        back = self.paginator.get_page(pages[2].previous_cursor)
+        self.assertEqual(self.ids(back), self.expected[3:6])
+        self.assertEqual(self.ids(self.paginator.get_page(back.previous_cursor)), self.expected[:3])
+
+    def test_a_bad_cursor_gives_the_first_page(self):
+        page = self.paginator.get_page('not-a-cursor', total='exact')
+
+        self.assertEqual(self.ids(page), self.expected[:3])
+        self.assertEqual((page.total, page.total_is_estimate), (7, False))
+
+
+class HeaderBadgeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper')
+        self.cart = Cart.objects.create(customer=Customer.objects.create(user=self.user))
+        self.corn = make_product('sweet-corn', 10)
+
+    def add(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            CartItem.objects.create(cart=self.cart, product=self.corn, quantity=quantity)
+
+    def test_counts_come_from_the_cache_after_the_first_read(self):
+        self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (0, 0))
+        with self.assertNumQueries(0):
+            self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (0, 0))
+
+    def test_cart_writes_move_the_cached_counter(self):
+        badges.header_counts(self.user.pk, self.cart.pk)
+        self.add(3)
+        with self.assertNumQueries(0):
+            self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (3, 0))
+
+    def test_a_backend_without_atomic_increments_recounts(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location,
+            }}):
+                badges.header_counts(self.user.pk, self.cart.pk)
+                self.add(3)
+                self.assertIsNone(cache.get(badges._cart_key(self.cart.pk)))
+                self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (3, 0))
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cart = Cart.objects.create(customer=Customer.objects.create(user=User.objects.create_user('shopper')))
+        self.corn = make_product('sweet-corn', 10)
+        self.chips = make_product('corn-chips', 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            CartItem.objects.create(cart=self.cart, product=self.corn, quantity=2)
+            CartItem.objects.create(cart=self.cart, product=self.chips, quantity=1)
+
+    def test_totals_come_from_one_query_then_the_cache(self):
+        with self.assertNumQueries(1):
+            summary = cart_summary.cart_summary(self.cart.pk)
+        self.assertEqual(summary, (3, Decimal('75.00'), 2))
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_summary.cart_summary(self.cart.pk), summary)
+
+    def test_cart_and_price_changes_refresh_the_totals(self):
+        cart_summary.cart_summary(self.cart.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            CartItem.objects.filter(product=self.chips).get().delete()
+        self.assertEqual(cart_summary.cart_summary(self.cart.pk), (2, Decimal('50.00'), 1))
+
+        # A bulk price change sends no CartItem signal; the catalog tag covers it
+        with self.captureOnCommitCallbacks(execute=True):
+            product_io.import_products(io.StringIO('slug,price\nsweet-corn,10.00\n'))
+        self.assertEqual(cart_summary.cart_summary(self.cart.pk), (2, Decimal('20.00'), 1))
+
+
+class CustomerSessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('newcomer')
+        self.client.force_login(self.user)
+        self.corn = make_product('sweet-corn', 10)
+
+    def test_browsing_creates_no_customer_or_cart(self):
+        for name in ('home', 'products', 'cart', 'profile', 'my_orders_all'):
+            self.assertEqual(self.client.get(reverse(name)).status_code, 200, name)
+        self.client.get(reverse('product_detail', args=[self.corn.slug]))
+
+        self.assertFalse(Customer.objects.filter(user=self.user).exists())
+        self.assertFalse(Cart.objects.exists())
+
+    def test_adding_to_the_cart_creates_them(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('add_to_cart', args=[self.corn.pk]), {'quantity': 2})
+
+        cart = Cart.objects.get(customer__user=self.user)
+        self.assertEqual(list(cart.items.values_list('quantity', flat=True)), [2])
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['request'].cart, cart)
+
+
+class CartOperationsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper')
+        self.customer = Customer.objects.create(user=self.user)
+        self.cart = Cart.objects.create(customer=self.customer)
+        self.corn = make_product('sweet-corn', 10)
+        self.chips = make_product('corn-chips', 10)
+
+    def test_checkout_removes_only_the_ordered_lines(self):
+        other_cart = Cart.objects.create(customer=Customer.objects.create(user=User.objects.create_user('other')))
+        CartItem.objects.create(cart=other_cart, product=self.corn, quantity=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_operations.add_item(self.cart.pk, self.corn.pk, 2)
+            cart_operations.add_item(self.cart.pk, self.chips.pk, 3)
+        self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (5, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            place_cart_order(self.customer, self.cart)
+
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+        self.assertEqual(CartItem.objects.filter(cart=other_cart).count(), 1)
+        self.assertEqual(cart_summary.cart_summary(self.cart.pk), cart_summary.EMPTY)
+        self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (0, 0))
+
+    def batch(self, operations):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('cart_batch'), json.dumps({'operations': operations}), content_type='application/json',
+            ).json()
+
+    def lines(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_batch_applies_every_operation_at_once(self):
+        self.client.force_login(self.user)
+        CartItem.objects.create(cart=self.cart, product=self.chips, quantity=4)
+
+        response = self.batch([
+            {'op': 'add', 'product_id': self.corn.pk, 'quantity': 2},
+            {'op': 'add', 'product_id': self.corn.pk},
+            {'op': 'remove', 'product_id': self.chips.pk},
+        ])
+
+        self.assertEqual(response, {'success': True, 'cart_total': 75.0, 'cart_count': 3})
+        self.assertEqual(self.lines(), {self.corn.pk: 3})
+        self.assertEqual(badges.header_counts(self.user.pk, self.cart.pk), (3, 0))
+
+    def test_a_short_line_rejects_the_whole_batch(self):
+        self.client.force_login(self.user)
+
+        response = self.batch([
+            {'op': 'set', 'product_id': self.corn.pk, 'quantity': 2},
+            {'op': 'set', 'product_id': self.chips.pk, 'quantity': 11},
+        ])
+
+        self.assertFalse(response['success'])
+        self.assertEqual(response['errors'][0]['product_id'], self.chips.pk)
+        self.assertEqual(self.lines(), {})
+
+    def test_reorder_is_clamped_to_the_stock_left(self):
+        order = place_order(self.customer, [(self.corn.pk, 2), (self.chips.pk, 8)])
+        Product.objects.filter(pk=self.chips.pk).update(stock_quantity=1)
+
+        summary, adjustments = cart_operations.reorder(self.cart, order)
+
+        self.assertEqual(self.lines(), {self.corn.pk: 2, self.chips.pk: 1})
+        self.assertEqual(summary.item_count, 3)
+        self.assertEqual([(line['product_id'], line['quantity']) for line in adjustments], [(self.chips.pk, 1)])
+
+
+class ConcurrencyTestCase(TransactionTestCase):
+    """Tests that write from several threads, each with its own connection"""
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('An in-memory SQLite test database cannot be shared between threads.')
+
+
+class ConcurrentCartTests(ConcurrencyTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.customer = Customer.objects.create(user=User.objects.create_user('shopper'))
+        self.cart = Cart.objects.create(customer=self.customer)
+        self.corn = make_product('sweet-corn', 5)
+
+    def test_parallel_adds_never_oversell_or_duplicate_lines(self):
+        results = run_concurrently(8, lambda: cart_operations.add_item(self.cart.pk, self.corn.pk, 1))
+
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        self.assertEqual(sorted(result for result in results if result is not None), [1, 2, 3, 4, 5])
+        self.assertEqual(list(CartItem.objects.filter(cart=self.cart).values_list('quantity', flat=True)), [5])
+
+
+class ConcurrentCheckoutTests(ConcurrencyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(user=User.objects.create_user('buyer'))
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 3)
+        stock_ledger.open_balances()
+
+    def test_parallel_orders_never_take_more_than_the_stock(self):
+        results = run_concurrently(8, lambda: place_order(self.customer, [(self.corn.pk, 1), (self.chips.pk, 1)]))
+
+        placed = [result for result in results if isinstance(result, Order)]
+        refused = [result for result in results if isinstance(result, InsufficientStock)]
+        self.assertEqual((len(placed), len(refused)), (3, 5))
+        self.assertEqual(Order.objects.count(), 3)
+        stock = dict(Product.objects.filter(pk__in=[self.corn.pk, self.chips.pk]).values_list('id', 'stock_quantity'))
+        self.assertEqual(stock, {self.corn.pk: 2, self.chips.pk: 0})
+        # The ledger sums to the same stock for every product
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+
+
+class ProductImportTests(TestCase):
+    def setUp(self):
+        self.corn = make_product('sweet-corn', 5)
+        stock_ledger.open_balances()
+
+    def import_csv(self, text, **options):
+        with self.captureOnCommitCallbacks(execute=True):
+            return product_io.import_products(io.StringIO(text), **options)
+
+    def test_a_price_list_only_updates_prices(self):
+        result = self.import_csv('slug,price\nsweet-corn,12.50\n')
+
+        self.assertEqual((result.created, result.updated, result.errors), (0, 1, []))
+        corn = Product.objects.get(pk=self.corn.pk)
+        self.assertEqual((corn.name, corn.price, corn.stock_quantity), ('Sweet Corn', Decimal('12.50'), 5))
+
+    def test_rows_create_products_with_free_slugs(self):
+        result = self.import_csv(
+            '{"name": "Sweet Corn", "price": "30.00", "product_type": "fresh-corn"}\n'
+            '{"slug": "new-corn", "price": "3.00"}\n',
+            file_format='jsonl',
+        )
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual(Product.objects.get(slug='sweet-corn-1').price, Decimal('30.00'))
+        self.assertEqual(result.errors, [(2, "new product 'new-corn' needs name, product_type")])
+        self.assertFalse(Product.objects.filter(slug='new-corn').exists())
+
+    def test_stock_is_only_imported_when_asked_for(self):
+        text = 'slug,stock_quantity\nsweet-corn,9\n'
+        self.import_csv(text)
+        self.assertEqual(Product.objects.get(pk=self.corn.pk).stock_quantity, 5)
+
+        self.import_csv(text, stock=True)
+        self.assertEqual(Product.objects.get(pk=self.corn.pk).stock_quantity, 9)
+        self.import_csv('slug,stock_quantity\nsweet-corn,\n', stock=True)
+        self.assertEqual(Product.objects.get(pk=self.corn.pk).stock_quantity, 9)
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+
+    def test_an_export_imports_back_unchanged(self):
+        exported = ''.join(product_io.export_lines('jsonl'))
+        before = list(Product.objects.order_by('id').values_list('slug', 'name', 'price', 'stock_quantity'))
+
+        result = self.import_csv(exported, file_format='jsonl')
+
+        self.assertEqual((result.created, result.updated, result.errors), (0, len(before), []))
+        self.assertEqual(list(Product.objects.order_by('id').values_list('slug', 'name', 'price', 'stock_quantity')), before)
+
+
+class LoadDataTests(TestCase):
+    def generate(self):
+        call_command(
+            'generate_load_data', customers=20, products=15, orders=60, reviews=30, contacts=5, tickets=5,
+            feedback=5, ads=3, days=30, batch_size=7, stdout=io.StringIO(),
+        )
+
+    def test_generated_data_is_consistent(self):
+        self.generate()
+
+        self.assertEqual(Product.objects.filter(slug__startswith='load-product-').count(), 15)
+        self.assertEqual(Customer.objects.filter(user__username__startswith='load_').count(), 20)
+        self.assertEqual(Order.objects.filter(customer__user__username__startswith='load_').count(), 60)
+        self.assertFalse(Product.objects.filter(stock_quantity__lt=0).exists())
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+        summaries = list(Product.objects.order_by('id').values_list('review_count', 'rating_sum'))
+        rebuild_product_ratings()
+        self.assertEqual(list(Product.objects.order_by('id').values_list('review_count', 'rating_sum')), summaries)
+
+    def test_refuses_to_run_twice(self):
+        self.generate()
+        with self.assertRaises(CommandError):
+            self.generate()
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        call_command(
+            'generate_load_data', customers=5, products=10, orders=10, reviews=5, contacts=1, tickets=1,
+            feedback=1, ads=1, days=10, stdout=io.StringIO(),
+        )
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.results = os.path.join(self.directory.name, 'results.json')
+
+    def benchmark(self, *args, **options):
+        output = io.StringIO()
+        call_command(
+            'benchmark', 'product_detail', 'cart', *args, iterations=2, warmup=1, alloc_iterations=1,
+            stdout=output, **options,
+        )
+        return output.getvalue()
+
+    def test_results_are_recorded_and_rolled_back(self):
+        orders = Order.objects.count()
+        self.assertIn('Benchmarked 2 scenarios', self.benchmark(output=self.results))
+
+        with open(self.results) as results:
+            report = json.load(results)
+        self.assertEqual(sorted(report['results']), ['cart', 'product_detail'])
+        self.assertGreater(report['results']['cart']['queries_max'], 0)
+        self.assertEqual(Order.objects.count(), orders)
+
+    def test_more_queries_than_the_baseline_fail(self):
+        self.benchmark(output=self.results)
+        with open(self.results) as results:
+            report = json.load(results)
+        report['results']['cart']['queries_max'] -= 1
+        with open(self.results, 'w') as results:
+            json.dump(report, results)
+
+        with self.assertRaisesMessage(CommandError, '1 regressions'):
+            self.benchmark(baseline=self.results, threshold=100)
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.corn = make_product('sweet-corn', 5)
+        self.chips = make_product('corn-chips', 1)
+        stock_ledger.open_balances()
+
+    def stock(self, product):
+        return Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+
+    def test_record_refuses_a_short_batch_and_writes_nothing(self):
+        movements_before = StockMovement.objects.count()
+        with self.assertRaises(InsufficientStock) as raised:
+            stock_ledger.record([
+                StockMovement(product=self.corn, kind=StockMovement.SALE, quantity=-2),
+                StockMovement(product=self.chips, kind=StockMovement.SALE, quantity=-3),
+            ], require_stock=True)
+
+        self.assertEqual(raised.exception.shortages, [{
+            'product_id': self.chips.pk, 'name': self.chips.name, 'requested': 3, 'available': 1,
+        }])
+        self.assertEqual(self.stock(self.corn), 5)
+        self.assertEqual(self.stock(self.chips), 1)
+        self.assertEqual(StockMovement.objects.count(), movements_before)
+
+    def test_release_puts_stock_back_once(self):
+        customer = Customer.objects.create(user=User.objects.create_user('buyer'))
+        order = place_order(customer, [(self.corn.pk, 2), (self.chips.pk, 1)])
+        self.assertEqual(self.stock(self.corn), 3)
+        self.assertEqual(self.stock(self.chips), 0)
+
+        stale = Order.objects.get(pk=order.pk)
+        self.assertTrue(inventory.release(order))
+        self.assertFalse(inventory.release(order))
+        self.assertFalse(inventory.release(stale))
+
+        self.assertEqual(self.stock(self.corn), 5)
+        self.assertEqual(self.stock(self.chips), 1)
+        self.assertEqual(order.stock_movements.filter(kind=StockMovement.RETURN).count(), 2)
+
+    def test_set_stock_records_the_difference(self):
+        movements = stock_ledger.set_stock({self.corn.pk: 8, self.chips.pk: 1}, note='Stock count')
+
+        self.assertEqual([(movement.product_id, movement.quantity) for movement in movements], [(self.corn.pk, 3)])
+        self.assertEqual(movements[0].note, 'Stock count')
+        self.assertEqual(self.stock(self.corn), 8)
+        self.assertEqual(self.stock(self.chips), 1)
+
+        stock_ledger.set_stock({self.chips.pk: 0})
+        self.assertEqual(self.stock(self.chips), 0)
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+
+    def test_quick_stock_form_writes_to_the_ledger(self):
+        admin = User.objects.create_user('stock-admin', is_staff=True)
+        self.client.force_login(admin)
+        url = reverse('admin_quick_stock_update')
+
+        self.client.post(url, {'product_id': self.corn.pk, 'operation': 'add', 'quantity': 4})
+        self.client.post(url, {'product_id': self.chips.pk, 'operation': 'set', 'quantity': 6})
+        self.client.post(url, {'product_id': self.chips.pk, 'operation': 'set', 'quantity': -1})
+
+        self.assertEqual(self.stock(self.corn), 9)
+        self.assertEqual(self.stock(self.chips), 6)
+        movements = StockMovement.objects.filter(created_by=admin).order_by('id')
+        self.assertEqual(
+            [(movement.product_id, movement.kind, movement.quantity) for movement in movements],
+            [(self.corn.pk, StockMovement.RECEIPT, 4), (self.chips.pk, StockMovement.ADJUSTMENT, 5)],
+        )
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+
+    def test_reconcile_after_open_balances(self):
+        husks = make_product('corn-husks', 7)
+        self.assertEqual(stock_ledger.reconcile(), ([(husks.pk, husks.name, 7, 0)], []))
+
+        stock_ledger.open_balances()
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+        # Already opened: nothing more to record
+        self.assertEqual(stock_ledger.open_balances(), [])
+
+        stock_ledger.record([StockMovement(product=husks, kind=StockMovement.SALE, quantity=-2)])
+        stock_ledger.take_snapshots(now=StockMovement.objects.latest('id').created_at + stock_ledger.SNAPSHOT_LAG)
+        self.assertEqual(stock_ledger.reconcile(), ([], []))
+        self.assertEqual(stock_ledger.stock_at(husks.pk, StockMovement.objects.latest('id').created_at), 5)
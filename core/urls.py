@@ -27,6 +27,8 @@ urlpatterns = [
     path('direct-checkout/', views.direct_checkout, name='direct_checkout'),
     path('update-cart-item/<int:item_id>/', views.update_cart_item, name='update_cart_item'),
     path('remove-from-cart/<int:item_id>/', views.remove_from_cart, name='remove_from_cart'),
+    path('cart/batch/', views.cart_batch, name='cart_batch'),
+    path('reorder/<str:order_number>/', views.reorder, name='reorder'),
     path('checkout/', views.checkout, name='checkout'),
     path('order-success/<int:order_id>/', views.order_success, name='order_success'),
     path('track-order/<str:order_number>/', views.track_order, name='track_order'),
@@ -53,6 +55,8 @@ urlpatterns = [
     path('admin-product-edit/<int:product_id>/', views.admin_product_edit, name='admin_product_edit'),
     path('admin-product-view/<int:product_id>/', views.admin_product_view, name='admin_product_view'),
     path('admin-product-quick-stock/', views.admin_quick_stock_update, name='admin_quick_stock_update'),
+    path('admin-products-import/', views.admin_products_import, name='admin_products_import'),
+    path('admin-products-export/', views.admin_products_export, name='admin_products_export'),
     path('admin-categories/', views.admin_categories, name='admin_categories'),
     path('admin-category-add/', views.admin_category_add, name='admin_category_add'),
     path('admin-category-edit/<int:category_id>/', views.admin_category_edit, name='admin_category_edit'),
@@ -84,4 +88,9 @@ urlpatterns = [
     # Advertisement API (Public)
     path('api/advertisements/carousel/', views.advertisements_carousel, name='advertisements_carousel'),
     path('api/advertisements/videos/', views.advertisements_videos, name='advertisements_videos'),
+    path('api/search/autocomplete/', views.search_autocomplete, name='search_autocomplete'),
+    
+    # Sitemap
+    path('sitemap.xml', views.sitemap, name='sitemap'),
+    path('sitemap-<int:page>.xml', views.sitemap, name='sitemap_page'),
 ]
@@ -6,18 +6,52 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
-from django.http import JsonResponse, HttpResponse, Http404
-from django.db.models import Q, Avg, Sum
-from django.db import models
+from django.http import JsonResponse, HttpResponse, Http404, StreamingHttpResponse
+from django.db.models import Q, Sum
+from django.db import models, transaction
+from django.core.cache import cache
 from django.utils import timezone
 from django.utils import timezone
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import io
 import json
-from .models import Product, Customer, Cart, CartItem, Order, OrderItem, Contact, ContactReply, Review, OrderTracking, Category, CustomerSupport, SupportMessage, CustomerFeedback, Advertisement
+from .models import Product, Customer, CartItem, Order, OrderItem, Contact, ContactReply, Review, OrderTracking, Category, CustomerSupport, SupportMessage, CustomerFeedback, Advertisement, StockMovement
 # Payment imports - will be enabled after migration
 # from .payment_service import get_payment_service
 from .forms import ContactForm, CustomUserCreationForm, AddToCartForm, ReviewForm, AdminRegistrationForm, AdvertisementForm
 from .decorators import admin_required
+from .autocomplete import (
+    DEFAULT_LIMIT as AUTOCOMPLETE_LIMIT,
+    MAX_LIMIT as AUTOCOMPLETE_MAX_LIMIT,
+    autocomplete_index,
+)
+from . import badges
+from . import cart_operations
+from .cart_operations import CartOperationError
+from .cart_summary import cart_summary
+from .catalog_index import (
+    PRICE_BUCKETS,
+    RATING_THRESHOLDS,
+    catalog_index,
+    load_products,
+    parse_min_rating,
+    parse_price_range,
+)
+from .customer_session import save_cart, save_customer
+from .fuzzy_search import fuzzy_index
+from . import inventory
+from .inventory import InsufficientStock
+from . import order_placement
+from .order_placement import EmptyOrder
+from . import stock_ledger
+from .page_cache import ADS, CATALOG, REVIEWS, cache_page_for_anonymous, conditional_on_tags, product_tag
+from .pagination import KeysetPaginator
+from . import product_io
+from .product_io import unique_slugs
+from .recommendations import recommended_products
+from .sales_ranking import top_sellers
+from .search import MAX_MATCHES, product_search
+from . import sitemaps
 import random
 import string
 
@@ -28,11 +62,12 @@ def _is_feedback_response_subject(subject):
         return False
     return subject.strip().lower().startswith(FEEDBACK_RESPONSE_SUBJECT_PREFIX)
 
+@cache_page_for_anonymous([CATALOG, ADS])
 def home(request):
     """Homepage view with featured products and combos"""
-    featured_products = Product.objects.filter(is_featured=True)[:3]
-    combo_deals = Product.objects.filter(product_type='bundles')[:3]
-    seasonal_items = Product.objects.filter(product_type='fresh-corn')[:3]
+    featured_products = top_sellers(Product.objects.filter(is_featured=True))
+    combo_deals = top_sellers(Product.objects.filter(product_type='bundles'))
+    seasonal_items = top_sellers(Product.objects.filter(product_type='fresh-corn'))
     
     # Get active advertisements
     from django.utils import timezone
@@ -55,10 +90,11 @@ def home(request):
     return render(request, 'core/home.html', context)
 
 
+@cache_page_for_anonymous([CATALOG, REVIEWS])
 def about(request):
     """About page view"""
     featured_reviews = Review.objects.filter(is_featured=True)[:3]
-    bestselling_products = Product.objects.filter(is_bestseller=True)[:3]
+    bestselling_products = top_sellers()
     
     context = {
         'featured_reviews': featured_reviews,
@@ -67,51 +103,71 @@ def about(request):
     return render(request, 'core/about.html', context)
 
 
+@conditional_on_tags([CATALOG, REVIEWS])
+@cache_page_for_anonymous([CATALOG, REVIEWS])
 def products(request):
     """Products listing page with filtering and sorting"""
-    products_list = Product.objects.all()
-    categories = Category.objects.all()
+    categories = catalog_index.categories()
     
     # Filtering
     category_filter = request.GET.get('category')
+    category_slug = request.GET.get('category_slug')
     price_filter = request.GET.get('price')
-    sort_by = request.GET.get('sort', 'newest')
+    rating_filter = request.GET.get('rating')
     free_delivery = request.GET.get('free_delivery')
     search_query = request.GET.get('search')
+    sort_by = request.GET.get('sort') or ('relevance' if search_query else 'newest')
     
-    if category_filter and category_filter != 'all':
-        products_list = products_list.filter(product_type=category_filter)
-    
-    if price_filter and price_filter != 'all':
-        if price_filter == '100-500':
-            products_list = products_list.filter(price__gte=100, price__lte=500)
-    
-    if free_delivery:
-        products_list = products_list.filter(free_delivery=True)
+    filters = {
+        'product_type': category_filter if category_filter and category_filter != 'all' else None,
+        'price_range': parse_price_range(price_filter),
+        'min_rating': parse_min_rating(rating_filter),
+        'free_delivery': bool(free_delivery),
+    }
+    if category_slug and category_slug != 'all':
+        filters['category_id'] = catalog_index.category_id_for_slug(category_slug) or 0
     
+    ranked_ids = None
+    search_suggestion = None
     if search_query:
-        products_list = products_list.filter(
-            Q(name__icontains=search_query) | 
-            Q(description__icontains=search_query)
-        )
-    
-    # Sorting
-    if sort_by == 'newest':
-        products_list = products_list.order_by('-created_at')
-    elif sort_by == 'bestseller':
-        products_list = products_list.order_by('-is_bestseller', '-created_at')
-    elif sort_by == 'price-low-high':
-        products_list = products_list.order_by('price')
-    elif sort_by == 'price-high-low':
-        products_list = products_list.order_by('-price')
+        ranked_ids = product_search.matching_ids(search_query)
+        if not ranked_ids:
+            # Fall back to typo-tolerant matching
+            search_suggestion = fuzzy_index.suggest(search_query)
+            ranked_ids = fuzzy_index.search_ids(search_query, limit=MAX_MATCHES)
+        filters['ids'] = ranked_ids
+    
+    # Filtering, sorting and counting happen in the in-memory catalog index
+    product_ids = catalog_index.filter_ids(sort=sort_by, **filters)
+    if ranked_ids is not None and sort_by == 'relevance':
+        matches = set(product_ids)
+        product_ids = [product_id for product_id in ranked_ids if product_id in matches]
+    counts = catalog_index.facet_counts(**filters)
+    # (value, label, matching products) per filter option, for the filter bar
+    facets = {
+        'product_types': [
+            (value, label, counts['product_type'][value]) for value, label in Product.PRODUCT_TYPES
+        ],
+        'categories': [
+            (category.slug, category.name, counts['category'].get(category.id, 0)) for category in categories
+        ],
+        'prices': [(bucket, label, counts['price'][bucket]) for bucket, label in PRICE_BUCKETS],
+        'ratings': [(str(threshold), f'{threshold}★ & up', counts['rating'][threshold])
+                    for threshold in RATING_THRESHOLDS],
+        'free_delivery': counts['free_delivery'],
+        'total': counts['total'],
+    }
     
-    # Pagination
-    paginator = Paginator(products_list, 9)
+    # Pagination (only the current page is loaded from the database)
+    paginator = Paginator(product_ids, 9)
     page_number = request.GET.get('page')
     products = paginator.get_page(page_number)
+    products.object_list = load_products(products.object_list)
     
     # Featured combos
-    featured_combos = Product.objects.filter(product_type='bundles', is_featured=True)[:2]
+    featured_combos = load_products(
+        catalog_index.filter_ids(product_type='bundles', featured=True)[:2]
+    )
     
     # Customer reviews
     customer_reviews = Review.objects.filter(is_featured=True)[:3]
@@ -119,26 +175,38 @@ def products(request):
     context = {
         'products': products,
         'categories': categories,
+        'facets': facets,
         'featured_combos': featured_combos,
         'customer_reviews': customer_reviews,
         'current_category': category_filter,
+        'current_category_slug': category_slug,
         'current_price': price_filter,
+        'current_rating': rating_filter,
+        'current_free_delivery': bool(free_delivery),
         'current_sort': sort_by,
         'search_query': search_query,
+        'search_suggestion': search_suggestion,
     }
     return render(request, 'core/products.html', context)
 
 
+@conditional_on_tags(lambda slug: [CATALOG, product_tag(slug)])
+@cache_page_for_anonymous(lambda slug: [CATALOG, product_tag(slug)])
 def product_detail(request, slug):
     """Individual product detail page"""
     product = get_object_or_404(Product, slug=slug)
-    reviews = product.reviews.all()[:5]
-    related_products = Product.objects.filter(
-        category=product.category
-    ).exclude(id=product.id)[:4]
+    reviews = product.reviews.select_related('customer__user')[:5]
     
-    # Calculate average rating
-    avg_rating = reviews.aggregate(Avg('rating'))['rating__avg']
+    # Frequently bought together, falling back to the same category
+    related_products = recommended_products(product, limit=4)
+    bought_together = bool(related_products)
+    if not bought_together:
+        related_products = Product.objects.filter(
+            category=product.category
+        ).exclude(id=product.id)[:4]
+    
+    # Rating summary is maintained on the product itself
+    avg_rating = product.rating_average if product.review_count else None
     
     # Forms
     add_to_cart_form = AddToCartForm()
@@ -148,6 +216,7 @@ def product_detail(request, slug):
         'product': product,
         'reviews': reviews,
         'related_products': related_products,
+        'bought_together': bought_together,
         'avg_rating': avg_rating,
         'add_to_cart_form': add_to_cart_form,
         'review_form': review_form,
@@ -226,7 +295,8 @@ def contact_conversation(request, contact_id):
     replies = contact.replies.select_related('sender').all()
     
     # Mark admin replies as read when the customer views them
-    contact.replies.filter(is_admin=True, is_read=False).update(is_read=True)
+    marked = contact.replies.filter(is_admin=True, is_read=False).update(is_read=True)
+    badges.unread_replies_changed(request.user.id, -marked)
     
     if request.method == 'POST':
         message_text = request.POST.get('message', '').strip()
@@ -312,59 +382,39 @@ def customer_login(request):
 def add_to_cart(request, product_id):
     """Add product to cart"""
     product = get_object_or_404(Product, id=product_id)
-    customer, created = Customer.objects.get_or_create(user=request.user)
     
     if request.method == 'POST':
         form = AddToCartForm(request.POST)
         if form.is_valid():
             quantity = form.cleaned_data['quantity']
+            is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
             
-            # Validate stock availability
-            if quantity > product.stock_quantity:
-                error_msg = f'Only {product.stock_quantity} in stock for {product.name}.'
-                is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+            # More than the whole stock is refused before a customer and cart are created for it
+            added = None
+            if quantity <= product.stock_quantity:
+                cart = save_cart(request)
+                # One upsert adds to the line and checks stock, so parallel adds all count
+                added = cart_operations.add_item(cart.pk, product.pk, quantity)
+            if added is None:
+                in_cart = CartItem.objects.filter(
+                    cart__customer_id=request.customer.pk, product=product,
+                ).values_list('quantity', flat=True).first()
+                available = max(product.stock_quantity - (in_cart or 0), 0)
+                if in_cart:
+                    error_msg = f'Cannot add {quantity}. Only {available} more available.'
+                else:
+                    error_msg = f'Only {product.stock_quantity} in stock for {product.name}.'
                 
                 if is_ajax:
                     return JsonResponse({
                         'success': False,
                         'error': error_msg,
-                        'max_quantity': product.stock_quantity
+                        'max_quantity': available
                     })
                 else:
                     messages.error(request, error_msg)
                     return redirect('product_detail', slug=product.slug)
             
-            # Get or create cart
-            cart, created = Cart.objects.get_or_create(customer=customer)
-            
-            # Get or create cart item
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart,
-                product=product,
-                defaults={'quantity': quantity}
-            )
-            
-            if not created:
-                # Check if total quantity would exceed stock
-                new_total = cart_item.quantity + quantity
-                if new_total > product.stock_quantity:
-                    error_msg = f'Cannot add {quantity}. Only {product.stock_quantity - cart_item.quantity} more available.'
-                    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-                    
-                    if is_ajax:
-                        return JsonResponse({
-                            'success': False,
-                            'error': error_msg,
-                            'max_quantity': product.stock_quantity - cart_item.quantity
-                        })
-                    else:
-                        messages.error(request, error_msg)
-                        return redirect('product_detail', slug=product.slug)
-                
-                cart_item.quantity += quantity
-                cart_item.save()
-            
-            is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
             if not is_ajax:
                 messages.success(request, f'{product.name} added to cart!')
             
@@ -373,7 +423,7 @@ def add_to_cart(request, product_id):
                 return JsonResponse({
                     'success': True,
                     'message': f'{product.name} added to cart!',
-                    'cart_count': cart.get_total_items()
+                    'cart_count': badges.cart_items(cart.pk)
                 })
             
             # Check if user wants to stay on current page
@@ -386,7 +436,7 @@ def add_to_cart(request, product_id):
 @login_required
 def profile(request):
     """Display profile info and allow account deletion"""
-    customer = getattr(request.user, 'customer', None)
+    customer = request.customer if request.customer.pk else None
 
     if request.method == 'POST' and request.POST.get('action') == 'delete_account':
         user = request.user
@@ -404,7 +454,6 @@ def profile(request):
 def buy_now(request, product_id):
     """Direct checkout for a single product (TikTok-style)"""
     product = get_object_or_404(Product, id=product_id)
-    customer, created = Customer.objects.get_or_create(user=request.user)
     
     if request.method == 'POST':
         form = AddToCartForm(request.POST)
@@ -434,12 +483,12 @@ def buy_now(request, product_id):
 @login_required
 def cart_view(request):
     """Shopping cart view"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    cart, created = Cart.objects.get_or_create(customer=customer)
+    cart = request.cart
     
     context = {
         'cart': cart,
-        'cart_items': cart.items.all(),
+        'cart_items': cart.items.select_related('product') if cart.pk else CartItem.objects.none(),
+        'cart_summary': cart.summary(),
     }
     return render(request, 'core/cart.html', context)
 
@@ -448,7 +497,9 @@ def cart_view(request):
 @require_POST
 def update_cart_item(request, item_id):
     """Update cart item quantity"""
-    cart_item = get_object_or_404(CartItem, id=item_id, cart__customer__user=request.user)
+    cart_item = get_object_or_404(
+        CartItem.objects.select_related('product'), id=item_id, cart__customer__user=request.user,
+    )
     quantity = int(request.POST.get('quantity', 1))
     
     # Validate stock availability
@@ -471,13 +522,13 @@ def update_cart_item(request, item_id):
     
     # Handle AJAX requests
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        cart = cart_item.cart if quantity > 0 else cart_item.cart
+        summary = cart_summary(cart_item.cart_id)
         return JsonResponse({
             'success': True,
             'new_quantity': quantity if quantity > 0 else 0,
             'item_total': float(cart_item.get_total_price()) if quantity > 0 else 0,
-            'cart_total': float(cart.get_total_price()),
-            'cart_count': cart.get_total_items(),
+            'cart_total': float(summary.subtotal),
+            'cart_count': summary.item_count,
             'removed': quantity <= 0
         })
     
@@ -489,30 +540,77 @@ def update_cart_item(request, item_id):
 def remove_from_cart(request, item_id):
     """Remove item from cart"""
     cart_item = get_object_or_404(CartItem, id=item_id, cart__customer__user=request.user)
-    cart = cart_item.cart
     cart_item.delete()
     
     # Handle AJAX requests
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        summary = cart_summary(cart_item.cart_id)
         return JsonResponse({
             'success': True,
-            'cart_total': float(cart.get_total_price()),
-            'cart_count': cart.get_total_items(),
+            'cart_total': float(summary.subtotal),
+            'cart_count': summary.item_count,
             'removed': True
         })
     
     return redirect('cart')
 
 
+@login_required
+@require_POST
+def cart_batch(request):
+    """Apply several cart changes in one request.
+
+    Body: {"operations": [{"op": "add"|"set"|"remove", "product_id": 1, "quantity": 2}, ...]}
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Request body must be JSON.'}, status=400)
+    try:
+        operations = cart_operations.parse_operations(data.get('operations') if isinstance(data, dict) else None)
+    except CartOperationError as error:
+        return JsonResponse({'success': False, 'error': str(error)}, status=400)
+
+    try:
+        summary, _adjustments = cart_operations.apply_operations(save_cart(request), operations)
+    except CartOperationError as error:
+        return JsonResponse({'success': False, 'error': str(error), 'errors': error.errors})
+    return JsonResponse({
+        'success': True,
+        'cart_total': float(summary.subtotal),
+        'cart_count': summary.item_count,
+    })
+
+
+@login_required
+@require_POST
+def reorder(request, order_number):
+    """Put every item of a previous order back into the cart"""
+    order = get_object_or_404(Order, order_number=order_number, customer_id=request.customer.pk)
+    summary, adjustments = cart_operations.reorder(save_cart(request), order)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({
+            'success': True,
+            'cart_total': float(summary.subtotal),
+            'cart_count': summary.item_count,
+            'adjustments': adjustments,
+        })
+    for adjustment in adjustments:
+        messages.warning(request, adjustment['message'])
+    messages.success(request, f'Items from order #{order.order_number} were added to your cart.')
+    return redirect('cart')
+
+
 @login_required
 def add_review(request, product_id):
     """Add product review"""
     product = get_object_or_404(Product, id=product_id)
-    customer, created = Customer.objects.get_or_create(user=request.user)
     
     if request.method == 'POST':
         form = ReviewForm(request.POST)
         if form.is_valid():
+            customer = save_customer(request)
             review = form.save(commit=False)
             review.product = product
             review.customer = customer
@@ -534,19 +632,25 @@ def add_review(request, product_id):
 
 def search(request):
     """Search products"""
-    query = request.GET.get('q', '')
-    products = Product.objects.none()
+    query = request.GET.get('q', '').strip()
+    products = None
+    suggestion = None
+    close_matches = []
     
     if query:
-        products = Product.objects.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query) |
-            Q(category__name__icontains=query)
-        ).distinct()
+        paginator = Paginator(product_search.results(query), 12)
+        products = paginator.get_page(request.GET.get('page'))
+        
+        # Nothing matched exactly: offer a spelling correction and near matches
+        if paginator.count == 0:
+            suggestion = fuzzy_index.suggest(query)
+            close_matches = load_products(fuzzy_index.search_ids(query, limit=12))
     
     context = {
         'products': products,
         'query': query,
+        'suggestion': suggestion,
+        'close_matches': close_matches,
     }
     return render(request, 'core/search_results.html', context)
 
@@ -689,24 +793,31 @@ def admin_products(request):
     return render(request, 'admin/products.html', context)
 
 
+def _posted_price(request):
+    """The form's price as a Decimal, or None after flashing an error"""
+    try:
+        price = Decimal(request.POST.get('price') or '')
+    except InvalidOperation:
+        price = None
+    if price is None or not price.is_finite() or price < 0 or price > product_io.MAX_PRICE:
+        messages.error(request, 'Please enter a valid price.')
+        return None
+    return price.quantize(Decimal('0.01'))
+
+
 @admin_required
 def admin_product_add(request):
     """Admin add new product view"""
     categories = Category.objects.all()
     
     if request.method == 'POST':
+        price = _posted_price(request)
+        if price is None:
+            return redirect('admin_product_add')
+
         # Create new product
-        from django.utils.text import slugify
-        
         name = request.POST.get('name')
-        slug = slugify(name)
-        
-        # Ensure unique slug
-        original_slug = slug
-        counter = 1
-        while Product.objects.filter(slug=slug).exists():
-            slug = f"{original_slug}-{counter}"
-            counter += 1
+        slug = unique_slugs([name])[0]
         
         # Handle category
         category_id = request.POST.get('category')
@@ -714,19 +825,24 @@ def admin_product_add(request):
         if category_id:
             category = Category.objects.get(id=category_id)
         
-        product = Product.objects.create(
-            name=name,
-            slug=slug,
-            description=request.POST.get('description'),
-            price=request.POST.get('price'),
-            stock_quantity=request.POST.get('stock_quantity'),
-            product_type=request.POST.get('product_type'),
-            category=category,
-            is_featured='is_featured' in request.POST,
-            is_bestseller='is_bestseller' in request.POST,
-            is_new='is_new' in request.POST,
-            free_delivery='free_delivery' in request.POST,
-        )
+        with transaction.atomic():
+            product = Product.objects.create(
+                name=name,
+                slug=slug,
+                description=request.POST.get('description'),
+                price=price,
+                product_type=request.POST.get('product_type'),
+                category=category,
+                is_featured='is_featured' in request.POST,
+                is_bestseller='is_bestseller' in request.POST,
+                is_new='is_new' in request.POST,
+                free_delivery='free_delivery' in request.POST,
+            )
+            # The opening stock is the product's first ledger movement
+            stock_ledger.record([StockMovement(
+                product=product, kind=StockMovement.RECEIPT, quantity=int(request.POST.get('stock_quantity') or 0),
+                note='New product', created_by=request.user,
+            )])
         
         # Handle image upload
         if 'image' in request.FILES:
@@ -743,6 +859,49 @@ def admin_product_add(request):
     return render(request, 'admin/product_add.html', context)
 
 
+@admin_required
+def admin_products_import(request):
+    """Bulk create/update products from an uploaded CSV or JSON Lines file"""
+    result = None
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        if not upload:
+            messages.error(request, 'Please choose a CSV or JSON Lines file to import.')
+        else:
+            file_format = request.POST.get('format') or product_io.detect_format(upload.name)
+            lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            result = product_io.import_products(
+                lines, file_format=file_format, dry_run='dry_run' in request.POST,
+                stock='stock' in request.POST,
+            )
+            if 'dry_run' in request.POST:
+                messages.info(request, f'Dry run: {result.written} products would be imported ({result.created} new, {result.updated} updated).')
+            else:
+                messages.success(request, f'Imported {result.written} products ({result.created} new, {result.updated} updated).')
+            if result.errors:
+                messages.warning(request, f'{len(result.errors)} rows were skipped; see the list below.')
+    
+    context = {
+        'result': result,
+        'errors': result.errors[:100] if result else [],
+        'columns': product_io.COLUMNS,
+        'formats': product_io.FORMATS,
+    }
+    return render(request, 'admin/products_import.html', context)
+
+
+@admin_required
+def admin_products_export(request):
+    """Download every product as CSV or JSON Lines"""
+    file_format = request.GET.get('format', 'csv')
+    if file_format not in product_io.FORMATS:
+        raise Http404
+    content_type = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(product_io.export_lines(file_format), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="products.{file_format}"'
+    return response
+
+
 @admin_required
 def admin_product_edit(request, product_id):
     """Admin product edit view"""
@@ -750,11 +909,14 @@ def admin_product_edit(request, product_id):
     categories = Category.objects.all()
     
     if request.method == 'POST':
+        price = _posted_price(request)
+        if price is None:
+            return redirect('admin_product_edit', product_id=product.id)
+
         # Update product fields
         product.name = request.POST.get('name')
         product.description = request.POST.get('description')
-        product.price = request.POST.get('price')
-        product.stock_quantity = request.POST.get('stock_quantity')
+        product.price = price
         product.product_type = request.POST.get('product_type')
         
         # Handle category
@@ -774,7 +936,12 @@ def admin_product_edit(request, product_id):
         if 'image' in request.FILES:
             product.image = request.FILES['image']
         
-        product.save()
+        with transaction.atomic():
+            # save() leaves stock_quantity alone; a changed stock field is a ledger adjustment
+            product.save()
+            stock_quantity = int(request.POST.get('stock_quantity') or 0)
+            if str(stock_quantity) != request.POST.get('original_stock_quantity'):
+                stock_ledger.set_stock({product.pk: stock_quantity}, note='Product edit', user=request.user)
         messages.success(request, f'Product "{product.name}" updated successfully!')
         return redirect('admin_products')
     
@@ -791,11 +958,11 @@ def admin_product_view(request, product_id):
     """Admin product view (detailed view for admin)"""
     product = get_object_or_404(Product, id=product_id)
     
-    # Get product reviews
-    reviews = Review.objects.filter(product=product).order_by('-created_at')
+    # Get the latest product reviews
+    reviews = Review.objects.filter(product=product).select_related('customer__user').order_by('-created_at')[:5]
     
-    # Calculate average rating
-    avg_rating = reviews.aggregate(Avg('rating'))['rating__avg']
+    # Rating summary is maintained on the product itself
+    avg_rating = product.rating_average if product.review_count else None
     
     context = {
         'product': product,
@@ -824,34 +991,37 @@ def admin_quick_stock_update(request):
         messages.error(request, 'Please provide a valid quantity (0 or higher).')
         return redirect('admin_dashboard')
 
-    product = get_object_or_404(Product, id=product_id)
+    product = get_object_or_404(Product.objects.only('id', 'name'), id=product_id)
 
+    # Recorded in the stock ledger; the stock column moves with it in the same transaction
     if operation == 'add':
-        product.stock_quantity = product.stock_quantity + quantity
+        stock_ledger.record([StockMovement(
+            product=product, kind=StockMovement.RECEIPT, quantity=quantity,
+            note='Quick stock update', created_by=request.user,
+        )])
         action = 'added to'
     else:
-        product.stock_quantity = quantity
+        stock_ledger.set_stock({product.pk: quantity}, note='Quick stock update', user=request.user)
         action = 'updated for'
 
-    product.save(update_fields=['stock_quantity'])
-    messages.success(request, f'Stock {action} {product.name}: now {product.stock_quantity} items available.')
+    stock_quantity = Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+    messages.success(request, f'Stock {action} {product.name}: now {stock_quantity} items available.')
     return redirect('admin_dashboard')
 
 
 @admin_required
 def admin_orders(request):
     """Admin orders management"""
-    orders = Order.objects.all().order_by('-created_at')
+    orders = Order.objects.select_related('customer__user')
     
     # Filter by status
     status_filter = request.GET.get('status')
     if status_filter:
         orders = orders.filter(status=status_filter)
     
-    # Pagination
-    paginator = Paginator(orders, 10)
-    page_number = request.GET.get('page')
-    orders = paginator.get_page(page_number)
+    # Keyset pagination keeps deep pages as cheap as the first one
+    paginator = KeysetPaginator(orders, 10, ordering=('-created_at', '-id'))
+    orders = paginator.get_page(request.GET.get('cursor'), total='estimate')
     
     context = {
         'orders': orders,
@@ -893,10 +1063,9 @@ def admin_customers(request):
             Q(user__last_name__icontains=normalized_query)
         )
     
-    # Pagination
-    paginator = Paginator(customers, 10)
-    page_number = request.GET.get('page')
-    customers = paginator.get_page(page_number)
+    # Keyset pagination keeps deep pages as cheap as the first one
+    paginator = KeysetPaginator(customers.select_related('user'), 10, ordering=('-created_at', '-id'))
+    customers = paginator.get_page(request.GET.get('cursor'))
     
     # Metrics for floating cards
     total_customers_count = Customer.objects.count()
@@ -1151,16 +1320,27 @@ def update_order_status(request, order_id):
                 from datetime import datetime
                 order.delivered_at = datetime.now()
             
-            order.save()
-            
-            # Create tracking update
-            OrderTracking.objects.create(
-                order=order,
-                status=new_status,
-                message=tracking_message or f'Order status updated to {order.get_status_display()}',
-                location=location,
-                updated_by=request.user.get_full_name() or request.user.username
-            )
+            try:
+                with transaction.atomic():
+                    # Cancelled and returned orders give their stock back; reopening one takes it again
+                    if new_status in inventory.RELEASING_STATUSES:
+                        inventory.release(order)
+                    elif old_status in inventory.RELEASING_STATUSES:
+                        inventory.reserve_order(order)
+                    
+                    order.save()
+                    
+                    # Create tracking update
+                    OrderTracking.objects.create(
+                        order=order,
+                        status=new_status,
+                        message=tracking_message or f'Order status updated to {order.get_status_display()}',
+                        location=location,
+                        updated_by=request.user.get_full_name() or request.user.username
+                    )
+            except InsufficientStock as error:
+                messages.error(request, f'Cannot reopen order #{order.order_number}: {error}')
+                return redirect('admin_orders')
             
             messages.success(request, f'Order #{order.order_number} status updated from {old_status} to {new_status}')
     
@@ -1177,17 +1357,20 @@ def cancel_order(request, order_id):
         if order.status not in ('delivered', 'cancelled'):
             old_status = order.status
             order.status = 'cancelled'
-            order.save()
-            
-            # Create tracking update
             cancellation_reason = request.POST.get('cancellation_reason', 'Order cancelled by admin')
-            OrderTracking.objects.create(
-                order=order,
-                status='cancelled',
-                message=cancellation_reason,
-                location='Golden Mais Farm, Calubian, Leyte',
-                updated_by=request.user.get_full_name() or request.user.username
-            )
+            with transaction.atomic():
+                order.save()
+                # Put the items back on the shelf
+                inventory.release(order)
+                
+                # Create tracking update
+                OrderTracking.objects.create(
+                    order=order,
+                    status='cancelled',
+                    message=cancellation_reason,
+                    location='Golden Mais Farm, Calubian, Leyte',
+                    updated_by=request.user.get_full_name() or request.user.username
+                )
             
             messages.success(request, f'Order #{order.order_number} has been cancelled.')
         else:
@@ -1199,15 +1382,17 @@ def cancel_order(request, order_id):
 @login_required
 def checkout(request):
     """Checkout view"""
-    customer, _ = Customer.objects.get_or_create(user=request.user)
-    cart, _ = Cart.objects.get_or_create(customer=customer)
-    cart_items = cart.items.select_related('product').all()
+    customer = request.customer
+    cart = request.cart
+    summary = cart.summary()
 
-    if not cart_items.exists():
+    if not summary.line_count:
         messages.warning(request, 'Your cart is empty!')
         return redirect('cart')
 
-    subtotal = sum(item.product.price * item.quantity for item in cart_items)
+    cart_items = cart.items.select_related('product').all()
+
+    subtotal = summary.subtotal
 
     def _checkout_context(**overrides):
         base_context = {
@@ -1231,19 +1416,38 @@ def checkout(request):
         notes = request.POST.get('notes', '')
         payment_method = request.POST.get('payment_method', 'cash')
         payment_confirmed = request.POST.get('payment_confirmed') == 'true'
+        digital_payment = payment_method in ('gcash', 'maya')
 
-        # Validate stock availability for all items
-        stock_errors = []
-        for cart_item in cart_items:
-            if cart_item.quantity > cart_item.product.stock_quantity:
-                stock_errors.append(
-                    f"{cart_item.product.name}: Only {cart_item.product.stock_quantity} in stock, "
-                    f"but you ordered {cart_item.quantity}."
+        # Update customer phone if provided
+        if not digital_payment and phone and phone != customer.phone:
+            customer.phone = phone
+            customer.save()
+
+        # Charged at the prices of the cart's rows as they are ordered, not a cached total
+        try:
+            order = order_placement.place_cart_order(
+                customer, cart,
+                delivery_method=delivery_method,
+                delivery_address=delivery_address,
+                phone=phone,
+                notes=notes,
+                message=(
+                    'Order placed. Awaiting payment via GCash/PayMaya. Please send payment to the provided number.'
+                    if digital_payment else order_placement.PLACED_MESSAGE
+                ),
+            )
+        except EmptyOrder:
+            messages.warning(request, 'Your cart is empty!')
+            return redirect('cart')
+        except InsufficientStock as error:
+            for shortage in error.shortages:
+                messages.error(
+                    request,
+                    f"{shortage['name']}: Only {shortage['available']} in stock, "
+                    f"but you ordered {shortage['requested']}."
                 )
-        
-        if stock_errors:
-            for error in stock_errors:
-                messages.error(request, error)
+            if not error.shortages:
+                messages.error(request, str(error))
             context = _checkout_context(
                 preselected_payment=payment_method,
                 selected_delivery_method=delivery_method,
@@ -1253,97 +1457,26 @@ def checkout(request):
             )
             return render(request, 'core/checkout.html', context)
 
-        if payment_method in ('gcash', 'maya'):
+        if digital_payment:
             # Redirect to GCash/PayMaya with phone number and order details
             order_items_text = '\n'.join([
-                f"- {item.product.name}: {item.quantity}x ₱{item.product.price}"
-                for item in cart_items
+                f"- {item.product.name}: {item.quantity}x ₱{item.price}"
+                for item in order.placed_items
             ])
-            delivery_fee = Decimal('50.00') if delivery_method == 'delivery' else Decimal('0.00')
-            total = subtotal + delivery_fee
-            
-            message = f"Golden Mais Order:\n{order_items_text}\nDelivery: ₱{delivery_fee}\nTotal: ₱{total}"
+            message = (
+                f"Golden Mais Order:\n{order_items_text}\nDelivery: ₱{order.delivery_fee}\nTotal: ₱{order.total}"
+            )
             phone_number = "09631186511"
             
             # For GCash/PayMaya, redirect to messaging app with order details
             import urllib.parse
             encoded_message = urllib.parse.quote(message)
             
-            # Create order first to track the payment attempt
-            order = Order.objects.create(
-                customer=customer,
-                delivery_method=delivery_method,
-                delivery_address=delivery_address,
-                phone=phone,
-                notes=notes,
-                status='pending',
-                subtotal=subtotal,
-                delivery_fee=delivery_fee,
-                total=total
-            )
-            
-            for cart_item in cart_items:
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    quantity=cart_item.quantity,
-                    price=cart_item.product.price
-                )
-            
-            OrderTracking.objects.create(
-                order=order,
-                status='pending',
-                message='Order placed. Awaiting payment via GCash/PayMaya. Please send payment to the provided number.',
-                location='Golden Mais Farm, Calubian, Leyte',
-                updated_by='System'
-            )
-            
-            # Clear cart
-            cart_items.delete()
-            
             messages.success(request, f'Order #{order.order_number} created! Please send payment via GCash/PayMaya.')
             
             # Redirect to messaging (SMS/WhatsApp)
             return redirect(f'https://wa.me/{phone_number}?text={encoded_message}')
 
-        # Update customer phone if provided
-        if phone and phone != customer.phone:
-            customer.phone = phone
-            customer.save()
-
-        delivery_fee = Decimal('50.00') if delivery_method == 'delivery' else Decimal('0.00')
-        total = subtotal + delivery_fee
-
-        order = Order.objects.create(
-            customer=customer,
-            delivery_method=delivery_method,
-            delivery_address=delivery_address,
-            phone=phone,
-            notes=notes,
-            status='pending',
-            subtotal=subtotal,
-            delivery_fee=delivery_fee,
-            total=total
-        )
-
-        for cart_item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price=cart_item.product.price
-            )
-
-        OrderTracking.objects.create(
-            order=order,
-            status='pending',
-            message='Order has been placed successfully. We will start preparing your fresh corn products.',
-            location='Golden Mais Farm, Calubian, Leyte',
-            updated_by='System'
-        )
-
-        cart_items.delete()
-
         messages.success(request, f'Order #{order.order_number} placed successfully!')
         return redirect('order_success', order_id=order.id)
 
@@ -1354,7 +1487,7 @@ def checkout(request):
 @login_required
 def direct_checkout(request):
     """Direct checkout for Buy Now functionality (TikTok-style)"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
+    customer = request.customer
     
     # Get buy now item from session
     buy_now_item = request.session.get('buy_now_item')
@@ -1365,6 +1498,7 @@ def direct_checkout(request):
     product = get_object_or_404(Product, id=buy_now_item['product_id'])
     
     if request.method == 'POST':
+        customer = save_customer(request)
         # Get form data
         delivery_method = request.POST.get('delivery_method', 'pickup')
         delivery_address = request.POST.get('delivery_address', '')
@@ -1377,40 +1511,19 @@ def direct_checkout(request):
             customer.phone = phone
             customer.save()
         
-        # Calculate totals
-        subtotal = Decimal(str(buy_now_item['total']))
-        delivery_fee = Decimal('50.00') if delivery_method == 'delivery' else Decimal('0.00')
-        total = subtotal + delivery_fee
-        
-        # Create order
-        order = Order.objects.create(
-            customer=customer,
-            delivery_method=delivery_method,
-            delivery_address=delivery_address,
-            phone=phone,
-            notes=notes,
-            status='pending',
-            subtotal=subtotal,
-            delivery_fee=delivery_fee,
-            total=total
-        )
-        
-        # Create order item
-        OrderItem.objects.create(
-            order=order,
-            product=product,
-            quantity=buy_now_item['quantity'],
-            price=Decimal(str(buy_now_item['price']))
-        )
-        
-        # Create initial tracking entry
-        OrderTracking.objects.create(
-            order=order,
-            status='pending',
-            message='Order has been placed successfully. We will start preparing your fresh corn products.',
-            location='Golden Mais Farm, Calubian, Leyte',
-            updated_by='System'
-        )
+        # Buy Now skips the cart; the order takes the stock with it, at today's price
+        try:
+            order = order_placement.place_order(
+                customer, [(product.id, buy_now_item['quantity'])],
+                delivery_method=delivery_method,
+                delivery_address=delivery_address,
+                phone=phone,
+                notes=notes,
+            )
+        except InsufficientStock as error:
+            available = error.shortages[0]['available'] if error.shortages else product.stock_quantity
+            messages.error(request, f'Only {available} in stock for {product.name}.')
+            return redirect('product_detail', slug=product.slug)
         
         # Clear session
         del request.session['buy_now_item']
@@ -1420,7 +1533,7 @@ def direct_checkout(request):
     
     # Calculate totals for display
     subtotal = Decimal(str(buy_now_item['total']))
-    delivery_fee = Decimal('50.00')  # Default delivery fee
+    delivery_fee = order_placement.DELIVERY_FEE  # Default delivery fee
     total_with_delivery = subtotal + delivery_fee
     
     context = {
@@ -1439,8 +1552,7 @@ def direct_checkout(request):
 @login_required
 def order_success(request, order_id):
     """Order success page"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    order = get_object_or_404(Order, id=order_id, customer=customer)
+    order = get_object_or_404(Order, id=order_id, customer_id=request.customer.pk)
     
     context = {
         'order': order,
@@ -1451,8 +1563,7 @@ def order_success(request, order_id):
 @login_required
 def track_order(request, order_number):
     """Order tracking page with progress timeline"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    order = get_object_or_404(Order, order_number=order_number, customer=customer)
+    order = get_object_or_404(Order, order_number=order_number, customer_id=request.customer.pk)
     
     # Get all tracking updates ordered by newest first
     tracking_updates = order.tracking_updates.all().order_by('-created_at')
@@ -1504,10 +1615,10 @@ def track_order_public(request):
 @login_required
 def my_orders(request, status_filter='all'):
     """My Orders page with status filtering (like Shopee)"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
+    customer_id = request.customer.pk
     
     # Get all orders for the customer
-    orders = Order.objects.filter(customer=customer)
+    orders = Order.objects.filter(customer_id=customer_id)
     
     # Filter by status category
     if status_filter == 'to_pay':
@@ -1531,18 +1642,18 @@ def my_orders(request, status_filter='all'):
     
     # Get counts for each status category
     status_counts = {
-        'to_pay': Order.objects.filter(customer=customer, status__in=['pending', 'confirmed']).count(),
-        'to_ship': Order.objects.filter(customer=customer, status__in=['processing', 'ready_for_pickup']).count(),
-        'to_receive': Order.objects.filter(customer=customer, status='shipped').count(),
-        'completed': Order.objects.filter(customer=customer, status='delivered').count(),
-        'returned': Order.objects.filter(customer=customer, status='returned').count(),
-        'cancelled': Order.objects.filter(customer=customer, status='cancelled').count(),
+        'to_pay': Order.objects.filter(customer_id=customer_id, status__in=['pending', 'confirmed']).count(),
+        'to_ship': Order.objects.filter(customer_id=customer_id, status__in=['processing', 'ready_for_pickup']).count(),
+        'to_receive': Order.objects.filter(customer_id=customer_id, status='shipped').count(),
+        'completed': Order.objects.filter(customer_id=customer_id, status='delivered').count(),
+        'returned': Order.objects.filter(customer_id=customer_id, status='returned').count(),
+        'cancelled': Order.objects.filter(customer_id=customer_id, status='cancelled').count(),
     }
     
-    # Pagination
-    paginator = Paginator(orders, 10)
-    page_number = request.GET.get('page')
-    orders = paginator.get_page(page_number)
+    # Keyset pagination keeps deep pages as cheap as the first one; the tabs
+    # already show the counts, so no total is needed
+    paginator = KeysetPaginator(orders, 10, ordering=('-created_at', '-id'))
+    orders = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'orders': orders,
@@ -1556,8 +1667,7 @@ def my_orders(request, status_filter='all'):
 @login_required
 def customer_support(request):
     """Customer support dashboard"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    tickets = CustomerSupport.objects.filter(customer=customer)\
+    tickets = CustomerSupport.objects.filter(customer_id=request.customer.pk)\
         .prefetch_related('messages__sender')\
         .order_by('-updated_at')
     tickets = list(tickets)
@@ -1578,9 +1688,8 @@ def customer_support(request):
 @login_required
 def create_support_ticket(request):
     """Create new support ticket"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    
     if request.method == 'POST':
+        customer = save_customer(request)
         subject = request.POST.get('subject')
         description = request.POST.get('description')
         priority = request.POST.get('priority', 'medium')
@@ -1608,8 +1717,7 @@ def create_support_ticket(request):
 @login_required
 def support_ticket_detail(request, ticket_number):
     """Support ticket detail and messaging"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
-    ticket = get_object_or_404(CustomerSupport, ticket_number=ticket_number, customer=customer)
+    ticket = get_object_or_404(CustomerSupport, ticket_number=ticket_number, customer_id=request.customer.pk)
     
     if request.method == 'POST':
         message_text = request.POST.get('message')
@@ -1640,9 +1748,10 @@ def support_ticket_detail(request, ticket_number):
 @login_required
 def customer_feedback(request):
     """Customer feedback form"""
-    customer, created = Customer.objects.get_or_create(user=request.user)
+    customer_id = request.customer.pk
     
     if request.method == 'POST':
+        customer = save_customer(request)
         feedback_type = request.POST.get('feedback_type')
         subject = request.POST.get('subject')
         message = request.POST.get('message')
@@ -1663,9 +1772,9 @@ def customer_feedback(request):
         messages.success(request, 'Thank you for your feedback!')
         return redirect('customer_feedback')
     
-    orders = Order.objects.filter(customer=customer).order_by('-created_at')[:10]
+    orders = Order.objects.filter(customer_id=customer_id).order_by('-created_at')[:10]
     
-    feedback_entries = CustomerFeedback.objects.filter(customer=customer).order_by('-created_at')
+    feedback_entries = CustomerFeedback.objects.filter(customer_id=customer_id).order_by('-created_at')
     context = {
         'orders': orders,
         'feedback_entries': feedback_entries,
@@ -2053,6 +2162,7 @@ def get_active_advertisements(ad_type=None):
     return ads
 
 
+@conditional_on_tags([ADS], anonymous_only=False)
 def advertisements_carousel(request):
     """API endpoint to get banner advertisements for carousel"""
     banners = get_active_advertisements(ad_type='banner')[:10]
@@ -2071,6 +2181,7 @@ def advertisements_carousel(request):
     return JsonResponse(data)
 
 
+@conditional_on_tags([ADS], anonymous_only=False)
 def advertisements_videos(request):
     """API endpoint to get video advertisements"""
     videos = get_active_advertisements(ad_type='video')[:10]
@@ -2101,3 +2212,48 @@ def advertisements_page(request):
     }
     return render(request, 'core/advertisements.html', context)
 
+
+def search_autocomplete(request):
+    """API endpoint for search-as-you-type product and category completions"""
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', AUTOCOMPLETE_LIMIT)), AUTOCOMPLETE_MAX_LIMIT)
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    
+    data = {
+        'query': query,
+        'results': [
+            {
+                'type': completion.kind,
+                'id': completion.id,
+                'name': completion.name,
+                'url': completion.url,
+            }
+            for completion in autocomplete_index.complete(query, limit=max(limit, 1))
+        ]
+    }
+    return JsonResponse(data)
+
+
+def sitemap(request, page=None):
+    """sitemap.xml, served from cache; large catalogs get a sitemap index of numbered pages"""
+    base = f'{request.scheme}://{request.get_host()}'
+    pages = sitemaps.page_count(sitemaps.cached_count(base))
+    if page is None:
+        name = 'index' if pages > 1 else 'page-1'
+    elif pages > 1 and 1 <= page <= pages:
+        name = f'page-{page}'
+    else:
+        raise Http404
+    
+    key = sitemaps.cache_key(base, name)
+    content = cache.get(key)
+    if content is not None:
+        return HttpResponse(content, content_type='application/xml')
+    
+    if name == 'index':
+        chunks = sitemaps.iter_index(base, pages)
+    else:
+        chunks = sitemaps.iter_urlset(base, page or 1)
+    return StreamingHttpResponse(sitemaps.stream_and_cache(chunks, key), content_type='application/xml')
@@ -35,6 +35,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'core.middleware.AdminSessionSeparationMiddleware',
+    'core.middleware.CustomerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -91,6 +92,33 @@ else:
         }
     }
 
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Concurrent requests wait for SQLite's write lock rather than failing with "database is locked"
+    DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 20
+    # A file rather than the in-memory default, so the concurrency tests can
+    # open one connection per thread
+    DATABASES['default'].setdefault('TEST', {}).setdefault('NAME', BASE_DIR / 'test_db.sqlite3')
+
+# The in-process indexes, page cache tags, cart summaries and header badge
+# counters of every gunicorn worker and management command are kept in step
+# through this cache, so production needs a shared one: set REDIS_URL
+# (`manage.py check --deploy` fails without it). Otherwise each process has
+# its own memory cache, which is enough for a single development server.
+redis_url = os.getenv('REDIS_URL', '').strip()
+if redis_url:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': redis_url,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -135,6 +163,12 @@ LOGOUT_REDIRECT_URL = '/'
 # Admin URLs
 ADMIN_LOGIN_URL = '/admin/login/'
 
+# Seconds an anonymous storefront page may be served from the page cache
+PAGE_CACHE_TIMEOUT = 600
+
+# Background threads that encode responsive image renditions after uploads
+IMAGE_DERIVATIVE_WORKERS = 2
+
 # Session configuration
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_AGE = 1209600  # 2 weeks
@@ -12,8 +12,7 @@ urlpatterns = [
     path('', include('core.urls')),
     # Google Search Console verification
     path('google4d1a4abd9adf2e93.html', TemplateView.as_view(template_name='google4d1a4abd9adf2e93.html', content_type='text/html')),
-    # Sitemap and robots
-    path('sitemap.xml', TemplateView.as_view(template_name='sitemap.xml', content_type='application/xml')),
+    # Robots (the sitemap is generated by core.views.sitemap)
     path('robots.txt', TemplateView.as_view(template_name='robots.txt', content_type='text/plain')),
 ]
 